@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import string
+from abc import ABC, abstractmethod
+from collections import defaultdict, namedtuple
+from typing import List
+from sqlalchemy.future import select
+from config import (
+    SHORT_CODE_STRATEGY, SHORT_CODE_LENGTH, SHORT_CODE_BLOCK_SOURCE, SHORT_CODE_BLOCK_SIZE, SHORT_CODE_MAX_ATTEMPTS,
+    LINK_DEDUP_ENABLED,
+)
+from database import async_session_maker, dialect_insert
+from models import Link, link_code_block_seq
+from utils import generate_short_code, link_digest
+
+logger = logging.getLogger(__name__)
+
+BASE62_ALPHABET = string.digits + string.ascii_letters
+# Outside the short_code: namespace of cached links, where a redirect to
+# /blocks would overwrite the counter with a cached 404.
+CODE_BLOCK_KEY = "short_code_blocks"
+LEGACY_CODE_BLOCK_KEY = "short_code:blocks"
+LINK_COLUMNS = ("original_url", "expires_at", "owner_id", "category", "is_public")
+
+# Keeps a multi-row INSERT well below the bind parameter limits of the drivers.
+INSERT_CHUNK_SIZE = 1000
+
+# created is False when an equivalent existing link was returned instead.
+InsertResult = namedtuple("InsertResult", ["link", "error", "created"], defaults=(True,))
+
+
+def encode_base62(number: int) -> str:
+    if number == 0:
+        return BASE62_ALPHABET[0]
+    digits = []
+    while number:
+        number, rem = divmod(number, 62)
+        digits.append(BASE62_ALPHABET[rem])
+    return "".join(reversed(digits))
+
+
+class CodeAllocator(ABC):
+    @abstractmethod
+    async def allocate(self, count: int = 1) -> List[str]:
+        ...
+
+
+class RandomCodeAllocator(CodeAllocator):
+    # Collisions are left to the unique index on short_code; see insert_links.
+    def __init__(self, length: int = SHORT_CODE_LENGTH):
+        self.length = length
+
+    async def allocate(self, count: int = 1) -> List[str]:
+        return [generate_short_code(self.length) for _ in range(count)]
+
+
+class RangeCodeAllocator(CodeAllocator):
+    # Reserves blocks of ids from a shared counter and hands them out locally,
+    # base62 encoded. Ids start at 62 ** (length - 1) so codes are never
+    # shorter than the configured length.
+    def __init__(self, reserve_block, block_size: int = SHORT_CODE_BLOCK_SIZE, length: int = SHORT_CODE_LENGTH):
+        self.reserve_block = reserve_block
+        self.block_size = block_size
+        self.offset = 62 ** (length - 1)
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def allocate(self, count: int = 1) -> List[str]:
+        codes = []
+        async with self._lock:
+            while len(codes) < count:
+                if self._next >= self._end:
+                    self._next = await self.reserve_block(self.block_size)
+                    self._end = self._next + self.block_size
+                    logger.info("Reserved short code block %d-%d", self._next, self._end - 1)
+                take = min(count - len(codes), self._end - self._next)
+                codes.extend(encode_base62(self.offset + n) for n in range(self._next, self._next + take))
+                self._next += take
+        return codes
+
+
+# Starts the counter from the legacy key when that still holds a number, so
+# blocks issued before the rename are not handed out again.
+RESERVE_BLOCK_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    local legacy = tonumber(redis.call('GET', KEYS[2]) or '')
+    if legacy then
+        redis.call('SET', KEYS[1], legacy)
+    end
+end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+"""
+
+
+async def reserve_redis_block(size: int) -> int:
+    from main import redis_client
+    end = await redis_client.eval(RESERVE_BLOCK_SCRIPT, 2, CODE_BLOCK_KEY, LEGACY_CODE_BLOCK_KEY, size)
+    return int(end) - size
+
+
+async def reserve_sequence_block(size: int) -> int:
+    async with async_session_maker() as db:
+        block = await db.scalar(select(link_code_block_seq.next_value()))
+    return block * size
+
+
+_allocator = None
+
+
+def get_allocator() -> CodeAllocator:
+    global _allocator
+    if _allocator is None:
+        if SHORT_CODE_STRATEGY == "range":
+            reserve = reserve_redis_block if SHORT_CODE_BLOCK_SOURCE == "redis" else reserve_sequence_block
+            _allocator = RangeCodeAllocator(reserve)
+        elif SHORT_CODE_STRATEGY == "random":
+            _allocator = RandomCodeAllocator()
+        else:
+            raise ValueError(f"Unknown SHORT_CODE_STRATEGY: {SHORT_CODE_STRATEGY}")
+    return _allocator
+
+
+async def _links_by_digest(db, digests) -> dict:
+    if not digests:
+        return {}
+    result = await db.execute(select(Link.__table__).filter(Link.url_digest.in_(digests)))
+    return {row["url_digest"]: dict(row) for row in result.mappings()}
+
+
+# Digest lookups grouped by the shard each digest is routed to.
+async def _sharded_links_by_digest(shards, digests) -> dict:
+    groups = defaultdict(list)
+    for digest in digests:
+        groups[shards.shard_set.index_for_code(digest)].append(digest)
+    found = await asyncio.gather(*(
+        shards.run_committed(index, _links_by_digest, group) for index, group in groups.items()
+    ))
+    return {digest: link for links in found for digest, link in links.items()}
+
+
+async def _insert_values(db, values) -> list:
+    rows = []
+    for start in range(0, len(values), INSERT_CHUNK_SIZE):
+        stmt = (
+            dialect_insert(db, Link.__table__)
+            .values(values[start:start + INSERT_CHUNK_SIZE])
+            .on_conflict_do_nothing()
+            .returning(*Link.__table__.c)
+        )
+        rows.extend(dict(row) for row in (await db.execute(stmt)).mappings())
+    return rows
+
+
+# Generated codes for rows that must land on a given shard (None: any shard).
+# With several shards, codes are drawn until one routes to each target;
+# codes routed elsewhere are discarded. Returns None where none was found.
+async def _codes_for_shards(allocator, shard_set, targets) -> list:
+    if len(shard_set) == 1:
+        return await allocator.allocate(len(targets))
+    codes = [None] * len(targets)
+    anywhere = [j for j, target in enumerate(targets) if target is None]
+    for j, code in zip(anywhere, await allocator.allocate(len(anywhere))):
+        codes[j] = code
+    missing = [j for j, target in enumerate(targets) if target is not None]
+    for _ in range(SHORT_CODE_MAX_ATTEMPTS):
+        if not missing:
+            break
+        drawn = shard_set.group_codes(await allocator.allocate(len(missing) * len(shard_set)))
+        still_missing = []
+        for j in missing:
+            if drawn[targets[j]]:
+                codes[j] = drawn[targets[j]].pop()
+            else:
+                still_missing.append(j)
+        missing = still_missing
+    return codes
+
+
+# Inserts all rows with one multi-row INSERT ... ON CONFLICT DO NOTHING per
+# shard and attempt. Rows whose generated code collided are retried with
+# fresh codes, rows whose custom alias is taken are reported as errors. Each
+# row goes to the shard its short code routes to, in a transaction of its own
+# that is committed before the results are looked at.
+#
+# With LINK_DEDUP_ENABLED rows without an alias get a url_digest; an existing
+# link with the same digest is returned instead of inserting. A row skipped by
+# the untargeted ON CONFLICT is looked up by digest again, so a concurrent
+# request that inserted the same link first wins and both return its row.
+# Links with a digest are placed on the shard the digest routes to, which
+# keeps equivalent links on one shard and its unique index effective.
+async def insert_links(shards, rows: List[dict], aliases: List[str]) -> List[InsertResult]:
+    shard_set = shards.shard_set
+    results = [None] * len(rows)
+    digests = [None] * len(rows)
+    if LINK_DEDUP_ENABLED:
+        digests = [
+            None if aliases[i] else link_digest(
+                row["original_url"], row.get("owner_id"), row.get("category"), row.get("expires_at"),
+                row.get("is_public"),
+            )
+            for i, row in enumerate(rows)
+        ]
+    # Equivalent rows of one request share the result of the first of them.
+    leaders = {}
+    followers = {}
+    for i, digest in enumerate(digests):
+        if digest is None:
+            continue
+        if digest in leaders:
+            followers[i] = leaders[digest]
+        else:
+            leaders[digest] = i
+    for digest, link in (await _sharded_links_by_digest(shards, list(leaders))).items():
+        results[leaders[digest]] = InsertResult(link, None, False)
+    pending = [i for i in range(len(rows)) if results[i] is None and i not in followers]
+    allocator = get_allocator()
+    for _ in range(SHORT_CODE_MAX_ATTEMPTS):
+        if not pending:
+            break
+        to_generate = [i for i in pending if not aliases[i]]
+        targets = [shard_set.index_for_code(digests[i]) if digests[i] else None for i in to_generate]
+        generated = dict(zip(to_generate, await _codes_for_shards(allocator, shard_set, targets)))
+        by_code = {}
+        retry = []
+        # Custom aliases claim their codes before generated ones.
+        for i in sorted(pending, key=lambda i: not aliases[i]):
+            code = aliases[i] or generated[i]
+            if code is None:
+                retry.append(i)
+                continue
+            if code in by_code:
+                if aliases[i]:
+                    results[i] = InsertResult(None, "Custom alias already exists")
+                else:
+                    retry.append(i)
+                continue
+            by_code[code] = i
+        values = defaultdict(list)
+        for code, i in by_code.items():
+            values[shard_set.index_for_code(code)].append(
+                {**{col: rows[i].get(col) for col in LINK_COLUMNS}, "url_digest": digests[i], "short_code": code}
+            )
+        inserted = await asyncio.gather(*(
+            shards.run_committed(index, _insert_values, shard_values) for index, shard_values in values.items()
+        ))
+        for row in (row for shard_rows in inserted for row in shard_rows):
+            results[by_code.pop(row["short_code"])] = InsertResult(row, None)
+        existing = await _sharded_links_by_digest(shards, [digests[i] for i in by_code.values() if digests[i]])
+        for i in by_code.values():
+            if aliases[i]:
+                results[i] = InsertResult(None, "Custom alias already exists")
+            elif digests[i] in existing:
+                results[i] = InsertResult(existing[digests[i]], None, False)
+            else:
+                retry.append(i)
+        pending = retry
+    for i in pending:
+        logger.error("Could not allocate a unique short code after %d attempts", SHORT_CODE_MAX_ATTEMPTS)
+        results[i] = InsertResult(None, "Could not allocate a unique short code")
+    for i, leader in followers.items():
+        results[i] = results[leader]._replace(created=False)
+    return results
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+from urllib.parse import urlparse
+from sqlalchemy import insert, func
+from sqlalchemy.future import select
+from config import CLICK_STREAM_MAXLEN, CLICK_BUFFER_SIZE, CLICK_INGEST_INTERVAL, CLICK_INGEST_BATCH_SIZE
+from database import dialect_insert
+from models import Link, ClickEvent, ClickRollup, ClickBreakdown
+
+logger = logging.getLogger(__name__)
+
+CLICK_STREAM_KEY = "clicks"
+CLICK_GROUP = "analytics"
+# Entries a consumer has held unacknowledged this long are taken over by others.
+CLICK_CLAIM_IDLE_MS = 60000
+
+# Holds events while Redis is unreachable; the oldest are dropped when full.
+_local_events = deque(maxlen=CLICK_BUFFER_SIZE)
+
+AGENT_FAMILIES = (
+    ("bot", ("bot", "crawl", "spider", "slurp")),
+    ("edge", ("edg/",)),
+    ("opera", ("opr/", "opera")),
+    ("chrome", ("chrome/", "crios/")),
+    ("firefox", ("firefox/", "fxios/")),
+    ("safari", ("safari/",)),
+    ("curl", ("curl/",)),
+)
+
+
+def referrer_host(referrer: str) -> str:
+    if not referrer:
+        return "direct"
+    return (urlparse(referrer).hostname or "unknown")[:255]
+
+
+def agent_family(user_agent: str) -> str:
+    if not user_agent:
+        return "unknown"
+    ua = user_agent.lower()
+    for family, markers in AGENT_FAMILIES:
+        if any(marker in ua for marker in markers):
+            return family
+    return "other"
+
+
+async def record_click(redis_client, link_id: int, referrer: str, user_agent: str):
+    event = {"l": link_id, "t": f"{time.time():.3f}", "r": referrer_host(referrer), "a": agent_family(user_agent)}
+    try:
+        await redis_client.xadd(CLICK_STREAM_KEY, event, maxlen=CLICK_STREAM_MAXLEN, approximate=True)
+    except Exception:
+        _local_events.append(event)
+
+
+async def drain_local_events(redis_client):
+    if not _local_events:
+        return 0
+    events = list(_local_events)
+    _local_events.clear()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for event in events:
+            pipe.xadd(CLICK_STREAM_KEY, event, maxlen=CLICK_STREAM_MAXLEN, approximate=True)
+        await pipe.execute()
+    except Exception:
+        _local_events.extendleft(reversed(events))
+        raise
+    return len(events)
+
+
+async def run_local_drain(redis_client):
+    while True:
+        await asyncio.sleep(CLICK_INGEST_INTERVAL)
+        try:
+            drained = await drain_local_events(redis_client)
+            if drained:
+                logger.info("Pushed %d buffered click events to Redis", drained)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Click events still buffered locally (%d): %s", len(_local_events), e)
+
+
+def _decode(fields: dict) -> dict:
+    return {k.decode() if isinstance(k, bytes) else k: v.decode() if isinstance(v, bytes) else v
+            for k, v in fields.items()}
+
+
+def _hour(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _day(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+async def _ensure_group(redis_client):
+    try:
+        await redis_client.xgroup_create(CLICK_STREAM_KEY, CLICK_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def _store_events(session_maker, events):
+    link_ids = {event["link_id"] for event in events}
+    async with session_maker() as db:
+        existing = set((await db.execute(select(Link.id).filter(Link.id.in_(link_ids)))).scalars().all())
+        events = [event for event in events if event["link_id"] in existing]
+        if not events:
+            return 0
+        rollups = Counter()
+        breakdowns = Counter()
+        for event in events:
+            rollups[(event["link_id"], "hour", _hour(event["clicked_at"]))] += 1
+            rollups[(event["link_id"], "day", _day(event["clicked_at"]))] += 1
+            day = _day(event["clicked_at"])
+            breakdowns[(event["link_id"], day, "referrer", event["referrer"])] += 1
+            breakdowns[(event["link_id"], day, "user_agent", event["user_agent"])] += 1
+        await db.execute(insert(ClickEvent.__table__), events)
+        stmt = dialect_insert(db, ClickRollup.__table__).values([
+            {"link_id": link_id, "granularity": granularity, "bucket": bucket, "clicks": clicks}
+            for (link_id, granularity, bucket), clicks in rollups.items()
+        ])
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["link_id", "granularity", "bucket"],
+            set_={"clicks": ClickRollup.__table__.c.clicks + stmt.excluded.clicks},
+        ))
+        stmt = dialect_insert(db, ClickBreakdown.__table__).values([
+            {"link_id": link_id, "day": day, "dimension": dimension, "value": value, "clicks": clicks}
+            for (link_id, day, dimension, value), clicks in breakdowns.items()
+        ])
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=["link_id", "day", "dimension", "value"],
+            set_={"clicks": ClickBreakdown.__table__.c.clicks + stmt.excluded.clicks},
+        ))
+        await db.commit()
+    return len(events)
+
+
+# Reads the click stream through a consumer group, stores the raw events and
+# folds them into the rollup tables, then acknowledges them. Entries left
+# unacknowledged by a crashed run, of this or of a vanished consumer, are
+# processed first, so delivery is at-least-once. Events are stored on the
+# shard of their link and acknowledged per shard, so a failing shard leaves
+# only its own entries pending.
+async def ingest_clicks(redis_client, shard_set, batch_size: int = CLICK_INGEST_BATCH_SIZE):
+    await _ensure_group(redis_client)
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+    try:
+        await redis_client.xautoclaim(CLICK_STREAM_KEY, CLICK_GROUP, consumer, CLICK_CLAIM_IDLE_MS,
+                                      count=batch_size, justid=True)
+    except Exception as e:
+        logger.warning("Could not claim stale click events: %s", e)
+    stored = 0
+    read = 0
+    start_id = "0"
+    while True:
+        response = await redis_client.xreadgroup(
+            CLICK_GROUP, consumer, {CLICK_STREAM_KEY: start_id}, count=batch_size
+        )
+        entries = response[0][1] if response else []
+        if not entries:
+            if start_id == "0":
+                start_id = ">"
+                continue
+            break
+        groups = defaultdict(list)
+        orphans = []
+        for entry_id, fields in entries:
+            fields = _decode(fields)
+            event = {
+                "link_id": int(fields["l"]),
+                "clicked_at": datetime.utcfromtimestamp(float(fields["t"])),
+                "referrer": fields["r"],
+                "user_agent": fields["a"],
+            }
+            try:
+                groups[shard_set.index_for_id(event["link_id"])].append((entry_id, event))
+            except ValueError:
+                orphans.append(entry_id)
+        results = await asyncio.gather(
+            *(_store_events(shard_set.session_makers[index], [event for _, event in group])
+              for index, group in groups.items()),
+            return_exceptions=True,
+        )
+        acked = orphans
+        for (index, group), result in zip(groups.items(), results):
+            if isinstance(result, Exception):
+                logger.error("Storing %d click events on shard %d failed: %s", len(group), index, result)
+                continue
+            stored += result
+            acked.extend(entry_id for entry_id, _ in group)
+        read += len(entries)
+        if acked:
+            await redis_client.xack(CLICK_STREAM_KEY, CLICK_GROUP, *acked)
+        if len(acked) < len(entries):
+            # The rest stays pending and is claimed again by a later run.
+            break
+        if start_id == ">" and len(entries) < batch_size:
+            break
+    return {"read": read, "stored": stored}
+
+
+async def click_timeseries(db, link_id: int, granularity: str, start: datetime, end: datetime):
+    # The bucket containing start is included.
+    start = _hour(start) if granularity == "hour" else _day(start)
+    stmt = (
+        select(ClickRollup.bucket, ClickRollup.clicks)
+        .filter(ClickRollup.link_id == link_id, ClickRollup.granularity == granularity,
+                ClickRollup.bucket >= start, ClickRollup.bucket <= end)
+        .order_by(ClickRollup.bucket)
+    )
+    points = (await db.execute(stmt)).mappings().all()
+    breakdowns = {}
+    for dimension in ("referrer", "user_agent"):
+        total = func.sum(ClickBreakdown.clicks)
+        stmt = (
+            select(ClickBreakdown.value, total.label("clicks"))
+            .filter(ClickBreakdown.link_id == link_id, ClickBreakdown.dimension == dimension,
+                    ClickBreakdown.day >= _day(start), ClickBreakdown.day <= end)
+            .group_by(ClickBreakdown.value)
+            .order_by(total.desc())
+            .limit(10)
+        )
+        breakdowns[dimension] = (await db.execute(stmt)).mappings().all()
+    return points, breakdowns["referrer"], breakdowns["user_agent"]
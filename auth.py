@@ -1,25 +1,81 @@
+import asyncio
 import jwt
 import logging
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timedelta
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer, HTTPBearer, HTTPAuthorizationCredentials
 from passlib.context import CryptContext
 from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS
+from config import (
+    SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, USER_CACHE_TTL, USER_CACHE_MAXSIZE,
+    BCRYPT_ROUNDS, PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, PASSWORD_HASH_RETRY_AFTER
+)
 from database import get_db
 from models import User
+from cache import LocalCache, register_local_cache, publish_invalidation
 
 logger = logging.getLogger(__name__)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 bearer_scheme = HTTPBearer(description="Use 'Bearer <token>' to authenticate for refresh token.")
 
-def get_password_hash(password: str):
+# Identity of an authenticated request. Tokens carry the user id ("uid") and
+# token version ("ver"); bumping User.token_version revokes every token
+# issued before.
+AuthUser = namedtuple("AuthUser", ["id", "username", "token_version"])
+
+user_cache = LocalCache(USER_CACHE_MAXSIZE, USER_CACHE_TTL)
+register_local_cache("user", user_cache)
+
+# bcrypt takes hundreds of milliseconds per call, so it runs in a bounded pool
+# instead of on the event loop. Requests beyond PASSWORD_HASH_MAX_PENDING are
+# rejected with 503 rather than queued behind each other.
+if PASSWORD_HASH_EXECUTOR == "process":
+    # spawn: the process already runs threads and an event loop, which a
+    # forked child would inherit in an inconsistent state.
+    password_executor = ProcessPoolExecutor(
+        max_workers=PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+else:
+    password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_pending_password_jobs = 0
+
+def _hash_password(password: str):
     return pwd_context.hash(password)
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def _verify_and_update_password(plain_password, hashed_password):
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+async def _run_password_job(func, *args):
+    global _pending_password_jobs
+    if _pending_password_jobs >= PASSWORD_HASH_MAX_PENDING:
+        logger.warning("Password hashing pool saturated, rejecting request")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many concurrent authentication requests",
+            headers={"Retry-After": str(PASSWORD_HASH_RETRY_AFTER)},
+        )
+    _pending_password_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        _pending_password_jobs -= 1
+
+async def get_password_hash(password: str):
+    return await _run_password_job(_hash_password, password)
+
+async def verify_password(plain_password, hashed_password):
+    valid, _ = await verify_and_update_password(plain_password, hashed_password)
+    return valid
+
+# Returns (valid, new_hash); new_hash is set when the stored hash uses
+# outdated settings (e.g. BCRYPT_ROUNDS changed) and should be saved.
+async def verify_and_update_password(plain_password, hashed_password):
+    return await _run_password_job(_verify_and_update_password, plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_delta: timedelta = None, token_type: str = "access"):
     to_encode = data.copy()
@@ -33,6 +89,85 @@ def create_refresh_token(data: dict, expires_delta: timedelta = None):
         expires_delta = timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
     return create_access_token(data, expires_delta, token_type="refresh")
 
+def token_claims(user) -> dict:
+    return {"sub": user.username, "uid": user.id, "ver": user.token_version}
+
+def user_cache_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+async def _load_cached_user(redis_client, user_id: int):
+    user = user_cache.get(str(user_id))
+    if user is not None:
+        return user
+    generation = user_cache.generation
+    try:
+        raw = await redis_client.get(user_cache_key(user_id))
+    except Exception:
+        return None
+    if raw is None:
+        return None
+    version, _, username = raw.decode("utf-8").partition("|")
+    user = AuthUser(user_id, username, int(version))
+    user_cache.set(str(user_id), user, generation=generation)
+    return user
+
+# Stores "<version>|<username>" unless the cached entry carries a newer token
+# version, so a resolve that read the user before a revoke cannot bring the
+# old version back. ARGV: version, username, ttl.
+STORE_USER_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and tonumber(string.match(current, '^(%d+)|')) > tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1] .. '|' .. ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+async def _store_redis_user(redis_client, user: AuthUser):
+    try:
+        await redis_client.eval(
+            STORE_USER_SCRIPT, 1, user_cache_key(user.id), user.token_version, user.username, USER_CACHE_TTL
+        )
+    except Exception:
+        pass
+
+# generation: user_cache.generation from before the user was read, so a copy
+# read before an invalidation is not kept locally.
+async def _store_cached_user(redis_client, user: AuthUser, generation: int):
+    user_cache.set(str(user.id), user, generation=generation)
+    await _store_redis_user(redis_client, user)
+
+# Called after User.token_version was bumped. The new version is written to
+# Redis rather than the key deleted, which lets STORE_USER_SCRIPT reject
+# stale writes; other processes drop their local copy.
+async def invalidate_user(redis_client, user: AuthUser):
+    user_cache.pop(str(user.id))
+    await _store_redis_user(redis_client, user)
+    await publish_invalidation(redis_client, "user", user.id)
+
+async def resolve_user(db: AsyncSession, payload: dict):
+    user_id = payload.get("uid")
+    version = payload.get("ver")
+    # Tokens issued before versioning cannot be revoked and are refused.
+    if not isinstance(user_id, int) or not isinstance(version, int):
+        return None
+    from main import redis_client
+    user = await _load_cached_user(redis_client, user_id)
+    if user is None or user.token_version < version:
+        generation = user_cache.generation
+        stmt = select(User.id, User.username, User.token_version).filter(User.id == user_id)
+        row = (await db.execute(stmt)).one_or_none()
+        # Hand the connection back before the endpoint runs; read-only
+        # endpoints would otherwise hold it while using a replica session.
+        await db.rollback()
+        if row is None:
+            return None
+        user = AuthUser(row.id, row.username, row.token_version)
+        await _store_cached_user(redis_client, user, generation)
+    if user.username != payload.get("sub") or user.token_version != version:
+        return None
+    return user
+
 def decode_access_token(token: str):
     try:
         return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -46,9 +181,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession
     payload = decode_access_token(token)
     if payload is None or payload.get("sub") is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
-    stmt = select(User).filter(User.username == payload.get("sub"))
-    result = await db.execute(stmt)
-    user = result.scalar_one_or_none()
+    user = await resolve_user(db, payload)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
     return user
@@ -58,9 +191,7 @@ async def get_current_user_bearer(credentials: HTTPAuthorizationCredentials = De
     payload = decode_access_token(token)
     if payload is None or payload.get("sub") is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
-    stmt = select(User).filter(User.username == payload.get("sub"))
-    result = await db.execute(stmt)
-    user = result.scalar_one_or_none()
+    user = await resolve_user(db, payload)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
     return user
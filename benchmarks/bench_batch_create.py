@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import time
+import httpx
+
+
+def make_items(count: int, prefix: str):
+    return [{"original_url": f"https://example.com/{prefix}/{i}"} for i in range(count)]
+
+
+async def bench_single(client: httpx.AsyncClient, count: int, concurrency: int) -> float:
+    items = make_items(count, "single")
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            item = queue.get_nowait()
+            r = await client.post("/shorten", json=item)
+            r.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return count / (time.perf_counter() - start)
+
+
+async def bench_batch(client: httpx.AsyncClient, count: int, batch_size: int) -> float:
+    items = make_items(count, "batch")
+    start = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        r = await client.post("/shorten/batch", json={"items": items[offset:offset + batch_size]})
+        r.raise_for_status()
+    return count / (time.perf_counter() - start)
+
+
+# The public endpoints are rate limited per address, so the benchmark creates
+# links as a user; authenticated creation has no quota.
+async def login(client: httpx.AsyncClient, username: str, password: str):
+    r = await client.post("/users/register", json={"username": username, "password": password})
+    if r.status_code != 400:
+        r.raise_for_status()
+    r = await client.post("/users/token", data={"username": username, "password": password})
+    r.raise_for_status()
+    client.headers["Authorization"] = f"Bearer {r.json()['access_token']}"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare links/sec of single and batch link creation.")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--username", default="bench_batch_create")
+    parser.add_argument("--password", default="bench_batch_create")
+    args = parser.parse_args()
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=60) as client:
+        await login(client, args.username, args.password)
+        single = await bench_single(client, args.count, args.concurrency)
+        batch = await bench_batch(client, args.count, args.batch_size)
+    print(f"single: {single:.0f} links/sec (concurrency {args.concurrency})")
+    print(f"batch:  {batch:.0f} links/sec (batch size {args.batch_size})")
+    print(f"speedup: {batch / single:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
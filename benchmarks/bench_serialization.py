@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import List
+import harness
+
+harness.configure(harness.DEFAULT_DATABASE_URL, "fake", 0)
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from models import Link
+from responses import link_list_response
+from schemas import LinkOut
+
+
+def make_rows(count: int):
+    created = datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        rows.append({
+            "id": i + 1,
+            "original_url": f"https://example.com/articles/{i}?utm_source=bench",
+            "short_code": f"c{i:07d}",
+            "created_at": created + timedelta(seconds=i),
+            "expires_at": created + timedelta(days=30) if i % 3 == 0 else None,
+            "redirect_count": i * 7 % 1000,
+            "last_redirect_at": created + timedelta(hours=i % 500) if i % 2 else None,
+            "owner_id": i % 100 + 1,
+            "category": "news" if i % 4 else None,
+            "is_public": bool(i % 2),
+        })
+    return rows
+
+
+async def orm_pydantic(rows, field):
+    # Previous path: ORM instances validated through LinkOut with orm_mode.
+    links = [Link(**row) for row in rows]
+    content = await serialize_response(field=field, response_content=links)
+    return JSONResponse(content).body
+
+
+async def rows_pydantic(rows, field):
+    # Core rows, still validated per row by the response_model.
+    content = await serialize_response(field=field, response_content=rows)
+    return JSONResponse(content).body
+
+
+async def rows_orjson(rows, field):
+    return link_list_response(rows).body
+
+
+PATHS = {"orm_pydantic": orm_pydantic, "rows_pydantic": rows_pydantic, "rows_orjson": rows_orjson}
+
+
+async def main(args):
+    rows = make_rows(args.rows)
+    field = create_response_field(name="links", type_=List[LinkOut])
+    reference = None
+    results = {}
+    for name, path in PATHS.items():
+        body = await path(rows, field)
+        # Every path must produce the same document.
+        if reference is None:
+            reference = json.loads(body)
+        elif json.loads(body) != reference:
+            raise SystemExit(f"{name} output differs from {next(iter(PATHS))}")
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            await path(rows, field)
+            timings.append(time.perf_counter() - started)
+        best = min(timings)
+        results[name] = {
+            "best_ms": round(best * 1000, 2),
+            "median_ms": round(sorted(timings)[len(timings) // 2] * 1000, 2),
+            "rows_per_second": round(args.rows / best),
+            "bytes": len(body),
+        }
+        print(f"{name:<14} {json.dumps(results[name])}", file=sys.stderr)
+    return {"environment": harness.environment(), "rows": args.rows, "repeat": args.repeat, "paths": results}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare rows/sec of the link list serialization paths.")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(main(parse_args())), indent=2))
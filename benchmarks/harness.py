@@ -0,0 +1,114 @@
+import asyncio
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+DEFAULT_DATABASE_URL = "sqlite:////tmp/fastapi_links_bench.db"
+
+
+# Must run before anything from the application is imported: config.py reads
+# the environment at import time.
+def configure(database_url: str, redis_url: str, links: int, shard_database_urls=()):
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.pop("DATABASE_READ_URL", None)
+    os.environ["SHARD_DATABASE_URLS"] = ",".join(shard_database_urls)
+    os.environ.setdefault("DB_ECHO", "false")
+    # Every request comes from one client; quotas would turn scenarios into 429s.
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    # fakeredis copies the whole bitmap on every bit write; size the filter to the data set.
+    os.environ.setdefault("BLOOM_CAPACITY", str(max(2 * links, 100000)))
+    if redis_url == "fake":
+        import fakeredis
+        import redis.asyncio as aioredis
+        server = fakeredis.FakeServer()
+
+        def from_url(*args, **kwargs):
+            return fakeredis.aioredis.FakeRedis(server=server, decode_responses=kwargs.get("decode_responses", False))
+
+        aioredis.from_url = from_url
+    else:
+        os.environ["REDIS_URL"] = redis_url
+
+
+def reset_sqlite(database_url: str):
+    prefix = "sqlite:///"
+    if database_url.startswith(prefix):
+        path = database_url[len(prefix):]
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile.
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, errors: int, seconds: float, items: int = None) -> dict:
+    values = sorted(latencies)
+    summary = {
+        "requests": len(values),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "rps": round(len(values) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+    if items is not None:
+        summary["items_per_second"] = round(items / seconds, 1) if seconds else 0.0
+    return summary
+
+
+# Sends the prepared requests through `concurrency` workers and times each
+# one. `send(client, arg)` returns the response; any status outside `expected`
+# counts as an error.
+async def run_requests(client, send, args, concurrency: int, expected=(200,)):
+    queue = asyncio.Queue()
+    for arg in args:
+        queue.put_nowait(arg)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while True:
+            try:
+                arg = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            response = await send(client, arg)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code not in expected:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def environment() -> dict:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        revision = None
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
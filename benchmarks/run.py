@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from types import SimpleNamespace
+import harness
+
+SCENARIOS = [
+    "redirect_cold", "redirect_warm", "create_single", "create_batch", "search", "user_links", "auth_cached",
+    "auth_uncached", "redirect_during_logins", "qr_cold", "qr_warm",
+]
+
+
+async def redirect_cold(ctx):
+    from cache import invalidate_link
+    # Tail links, each requested once after its cache entry is dropped.
+    codes = ctx.rng.sample(ctx.data.codes[len(ctx.data.codes) // 2:], min(ctx.requests, len(ctx.data.codes) // 2))
+    await invalidate_link(ctx.redis, *codes)
+    return await ctx.run(lambda c, code: c.get(f"/{code}"), codes, expected=(307,))
+
+
+async def redirect_warm(ctx):
+    codes = ctx.data.link_sampler.sample(ctx.requests)
+    for code in set(codes):
+        await ctx.client.get(f"/{code}")
+    return await ctx.run(lambda c, code: c.get(f"/{code}"), codes, expected=(307,))
+
+
+# Warm redirects while other clients keep logging in. Compare the redirect
+# percentiles with redirect_warm: bcrypt runs off the event loop, so they
+# should stay close.
+async def redirect_during_logins(ctx):
+    codes = ctx.data.link_sampler.sample(ctx.requests)
+    for code in set(codes):
+        await ctx.client.get(f"/{code}")
+    stop = asyncio.Event()
+    logins = {"ok": 0, "rejected": 0, "errors": 0}
+
+    async def login_load():
+        while not stop.is_set():
+            form = {"username": ctx.rng.choice(ctx.data.usernames), "password": "bench-password"}
+            response = await ctx.client.post("/users/token", data=form)
+            key = {200: "ok", 503: "rejected"}.get(response.status_code, "errors")
+            logins[key] += 1
+
+    workers = [asyncio.create_task(login_load()) for _ in range(max(1, ctx.args.concurrency // 4))]
+    try:
+        result = await ctx.run(lambda c, code: c.get(f"/{code}"), codes, expected=(307,))
+    finally:
+        stop.set()
+        await asyncio.gather(*workers)
+    result["logins"] = logins
+    return result
+
+
+async def create_single(ctx):
+    items = [{"original_url": f"https://example.com/bench/single/{ctx.run_id}/{i}"} for i in range(ctx.requests)]
+    return await ctx.run(lambda c, item: c.post("/shorten/public", json=item), items)
+
+
+async def create_batch(ctx):
+    size = ctx.args.batch_size
+    batches = [
+        {"items": [{"original_url": f"https://example.com/bench/batch/{ctx.run_id}/{b}/{i}"} for i in range(size)]}
+        for b in range(max(1, ctx.requests // size))
+    ]
+    return await ctx.run(lambda c, batch: c.post("/shorten/batch/public", json=batch), batches,
+                         items=len(batches) * size)
+
+
+async def search(ctx):
+    words = ctx.data.word_sampler.sample(ctx.requests)
+    return await ctx.run(lambda c, word: c.get("/search", params={"query": word, "limit": 10}), words)
+
+
+def auth_headers(ctx):
+    from auth import create_access_token, token_claims
+    users = list(zip(ctx.data.user_ids, ctx.data.usernames))
+    tokens = [
+        create_access_token(token_claims(SimpleNamespace(id=uid, username=name, token_version=0)))
+        for uid, name in users
+    ]
+    return [{"Authorization": f"Bearer {ctx.rng.choice(tokens)}"} for _ in range(ctx.requests)]
+
+
+async def user_links(ctx):
+    headers = auth_headers(ctx)
+    return await ctx.run(lambda c, h: c.get("/users/links", params={"limit": 50}, headers=h), headers)
+
+
+# A cheap authenticated request, so the cost of resolving the user shows.
+def _authenticated_category(c, h):
+    return c.get("/category/news", params={"limit": 1}, headers=h)
+
+
+async def auth_cached(ctx):
+    headers = auth_headers(ctx)
+    for h in headers[:len(ctx.data.user_ids) * 4]:
+        await _authenticated_category(ctx.client, h)
+    return await ctx.run(_authenticated_category, headers)
+
+
+# Same requests with the user cache bypassed: every request loads the user
+# from the database, as before tokens carried the user id.
+async def auth_uncached(ctx):
+    import auth
+    headers = auth_headers(ctx)
+    load_cached_user = auth._load_cached_user
+
+    async def miss(redis_client, user_id):
+        return None
+
+    auth._load_cached_user = miss
+    try:
+        return await ctx.run(_authenticated_category, headers)
+    finally:
+        auth._load_cached_user = load_cached_user
+
+
+async def qr_cold(ctx):
+    from qr import invalidate_qr
+    codes = ctx.rng.sample(ctx.data.codes, min(ctx.requests, len(ctx.data.codes)))
+    for code in codes:
+        await invalidate_qr(ctx.redis, code)
+    return await ctx.run(lambda c, code: c.get(f"/{code}/qrcode"), codes)
+
+
+async def qr_warm(ctx):
+    codes = ctx.data.link_sampler.sample(ctx.requests)
+    for code in set(codes):
+        await ctx.client.get(f"/{code}/qrcode")
+    return await ctx.run(lambda c, code: c.get(f"/{code}/qrcode"), codes)
+
+
+class Context:
+    def __init__(self, args, client, redis, data):
+        self.args = args
+        self.client = client
+        self.redis = redis
+        self.data = data
+        self.requests = args.requests
+        self.rng = random.Random(args.seed)
+        self.run_id = int(time.time() * 1000)
+
+    async def run(self, send, args, expected=(200,), **extra):
+        latencies, errors, seconds = await harness.run_requests(
+            self.client, send, args, self.args.concurrency, expected
+        )
+        return harness.summarize(latencies, errors, seconds, **extra)
+
+
+async def main(args):
+    import httpx
+    import main as app_main
+    import database
+    import sharding
+    from seed import seed
+    from bloom import rebuild_bloom
+
+    await app_main.app.router.startup()
+    try:
+        started = time.perf_counter()
+        data = await seed(database.async_session_maker, sharding.shards, args.users, args.links, args.skew, args.seed)
+        # Seeded rows bypass the API, so the short code filter has to be rebuilt.
+        await rebuild_bloom(app_main.redis_client, sharding.shards)
+        seed_seconds = time.perf_counter() - started
+        transport = httpx.ASGITransport(app=app_main.app)
+        results = {}
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            ctx = Context(args, client, app_main.redis_client, data)
+            for name in args.scenarios:
+                results[name] = await globals()[name](ctx)
+                print(f"{name:<14} {json.dumps(results[name])}", file=sys.stderr)
+    finally:
+        await app_main.app.router.shutdown()
+    return {
+        "environment": harness.environment(),
+        "config": {
+            "database": database.async_engine.dialect.name,
+            "shards": len(sharding.shards),
+            "redis": "fakeredis" if args.redis_url == "fake" else "redis",
+            "users": args.users,
+            "links": args.links,
+            "skew": args.skew,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "batch_size": args.batch_size,
+            "seed_seconds": round(seed_seconds, 3),
+        },
+        "scenarios": results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the in-process benchmark scenarios and print JSON results.")
+    parser.add_argument("--database-url", default=harness.DEFAULT_DATABASE_URL)
+    parser.add_argument("--shard-database-urls", nargs="+", default=[],
+                        help="Databases holding the links; the primary database when omitted")
+    parser.add_argument("--redis-url", default="fake", help='Redis URL, or "fake" for an in-process fakeredis')
+    parser.add_argument("--reset", action="store_true", help="Delete the SQLite database file before seeding")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--links", type=int, default=50000)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of link popularity")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.reset:
+        for url in [args.database_url, *args.shard_database_urls]:
+            harness.reset_sqlite(url)
+    harness.configure(args.database_url, args.redis_url, args.links, args.shard_database_urls)
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
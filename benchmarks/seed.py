@@ -0,0 +1,94 @@
+import random
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import accumulate
+from sqlalchemy import insert
+from sqlalchemy.future import select
+
+DOMAINS = ["example.com", "news.example.org", "shop.example.net", "docs.example.io", "blog.example.dev"]
+WORDS = [
+    "python", "fastapi", "redis", "postgres", "release", "pricing", "docs", "guide", "careers", "status",
+    "weather", "football", "recipes", "travel", "music", "movies", "science", "history", "startup", "design",
+    "security", "cloud", "mobile", "gaming", "finance", "health", "climate", "energy", "education", "sale",
+]
+CATEGORIES = ["news", "shop", "docs", "social", "video", None]
+INSERT_CHUNK = 5000
+# Seeded codes are one character longer than generated ones so create
+# scenarios never collide with them.
+CODE_OFFSET = 62 ** 6
+
+Dataset = namedtuple("Dataset", ["codes", "links", "user_ids", "usernames", "link_sampler", "word_sampler"])
+
+
+class ZipfSampler:
+    # Item at rank r (1-based) is drawn with probability proportional to 1 / r ** s.
+    def __init__(self, items, s: float, rng: random.Random):
+        self.items = items
+        self.rng = rng
+        self.cum_weights = list(accumulate(1 / rank ** s for rank in range(1, len(items) + 1)))
+
+    def sample(self, k: int):
+        return self.rng.choices(self.items, cum_weights=self.cum_weights, k=k)
+
+
+def seeded_code(i: int) -> str:
+    from allocator import encode_base62
+    return encode_base62(CODE_OFFSET + i)
+
+
+def _link_rows(count: int, user_ids, skew: float, rng: random.Random):
+    now = datetime.utcnow()
+    weights = [1 / rank ** skew for rank in range(1, count + 1)]
+    total = sum(weights)
+    for i in range(count):
+        words = rng.sample(WORDS, 2)
+        owner_id = rng.choice(user_ids) if rng.random() < 0.6 else None
+        clicks = int(1000000 * weights[i] / total)
+        yield {
+            "original_url": f"https://{rng.choice(DOMAINS)}/{words[0]}/{words[1]}/{i}",
+            "short_code": seeded_code(i),
+            "created_at": now - timedelta(seconds=rng.randint(0, 90 * 86400)),
+            "expires_at": now + timedelta(days=rng.randint(1, 365)) if rng.random() < 0.1 else None,
+            "redirect_count": clicks,
+            "last_redirect_at": now - timedelta(seconds=rng.randint(0, 86400)) if clicks else None,
+            "owner_id": owner_id,
+            "category": rng.choice(CATEGORIES),
+            "is_public": owner_id is None or rng.random() < 0.3,
+        }
+
+
+# Inserts `users` users and `links` links unless a previous run already did.
+# The link at index i is the i-th most popular; link_sampler draws codes with
+# that Zipf skew, so a small head of links receives most of the traffic.
+# Users go to the primary database, links to the shard of their code.
+async def seed(session_maker, shard_set, users: int, links: int, skew: float = 1.1, seed_value: int = 42) -> Dataset:
+    from auth import get_password_hash
+    from models import User, Link
+    rng = random.Random(seed_value)
+    usernames = [f"bench_user_{i}" for i in range(users)]
+    codes = [seeded_code(i) for i in range(links)]
+    async with shard_set.session_maker_for_code(codes[-1])() as db:
+        existing = await db.scalar(select(Link.id).filter(Link.short_code == codes[-1]))
+    async with session_maker() as db:
+        if existing is None:
+            hashed = await get_password_hash("bench-password")
+            await db.execute(insert(User.__table__), [{"username": name, "hashed_password": hashed} for name in usernames])
+            await db.commit()
+            user_ids = (await db.execute(select(User.id).filter(User.username.in_(usernames)))).scalars().all()
+            batches = defaultdict(list)
+            for row in _link_rows(links, user_ids, skew, rng):
+                batches[shard_set.index_for_code(row["short_code"])].append(row)
+            for index, rows in batches.items():
+                async with shard_set.session_makers[index]() as shard_db:
+                    for start in range(0, len(rows), INSERT_CHUNK):
+                        await shard_db.execute(insert(Link.__table__), rows[start:start + INSERT_CHUNK])
+                    await shard_db.commit()
+        rows = (await db.execute(select(User.id, User.username).filter(User.username.in_(usernames)))).all()
+    return Dataset(
+        codes=codes,
+        links=links,
+        user_ids=[row.id for row in rows],
+        usernames=[row.username for row in rows],
+        link_sampler=ZipfSampler(codes, skew, rng),
+        word_sampler=ZipfSampler(WORDS, skew, rng),
+    )
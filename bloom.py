@@ -0,0 +1,194 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from sqlalchemy.future import select
+from config import BLOOM_ENABLED, BLOOM_CAPACITY, BLOOM_ERROR_RATE
+from models import Link
+
+logger = logging.getLogger(__name__)
+
+BLOOM_KEY = "links:bloom"
+BLOOM_BUILDING_KEY = "links:bloom:building"
+BLOOM_SNAPSHOT_KEY = "links:bloom:snapshot"
+BLOOM_READY_KEY = "links:bloom:ready"
+# Held while a rebuild runs; adds made meanwhile also go to the building key.
+BLOOM_REBUILD_LOCK_KEY = "links:bloom:rebuilding"
+BLOOM_REBUILD_LOCK_TTL = 1800
+REBUILD_BATCH_SIZE = 10000
+# How often a process retries adds that failed while Redis was unreachable.
+UNSYNCED_RETRY_INTERVAL = 1
+
+BITS = math.ceil(-BLOOM_CAPACITY * math.log(BLOOM_ERROR_RATE) / math.log(2) ** 2)
+HASHES = max(1, round(BITS / BLOOM_CAPACITY * math.log(2)))
+# Stored in the ready key, so a filter built with other parameters is ignored.
+PARAMS = f"{BITS}:{HASHES}"
+
+# ARGV: params, then HASHES bit offsets per code. Returns one flag per code:
+# 0 when the code is certainly absent, 1 when it may exist or the filter is
+# not ready.
+CHECK_SCRIPT = """
+local k = tonumber(ARGV[2])
+local result = {}
+local ready = redis.call('GET', KEYS[2]) == ARGV[1]
+for i = 3, #ARGV, k do
+    local found = 1
+    if ready then
+        for j = i, i + k - 1 do
+            if redis.call('GETBIT', KEYS[1], ARGV[j]) == 0 then found = 0 break end
+        end
+    end
+    result[#result + 1] = found
+end
+return result
+"""
+
+ADD_SCRIPT = """
+local building = redis.call('EXISTS', KEYS[3]) == 1
+for i = 1, #ARGV do
+    redis.call('SETBIT', KEYS[1], ARGV[i], 1)
+    if building then redis.call('SETBIT', KEYS[2], ARGV[i], 1) end
+end
+return 1
+"""
+
+# Merges the adds made during the rebuild into the snapshot and swaps it in.
+SWAP_SCRIPT = """
+redis.call('BITOP', 'OR', KEYS[2], KEYS[2], KEYS[3])
+redis.call('RENAME', KEYS[2], KEYS[1])
+redis.call('DEL', KEYS[3], KEYS[5])
+redis.call('SET', KEYS[4], ARGV[1])
+return 1
+"""
+
+
+def bit_offsets(short_code: str):
+    digest = hashlib.blake2b(short_code.encode("utf-8"), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:], "big") | 1
+    return [(h1 + i * h2) % BITS for i in range(HASHES)]
+
+
+# Codes whose add failed (Redis unreachable); replayed before this process
+# next uses the filter and by run_unsynced_replay, since a missing code would
+# be answered with 404.
+_unsynced = set()
+_rebuild_needed = False
+
+
+async def _add_offsets(redis_client, short_codes):
+    offsets = [offset for code in short_codes for offset in bit_offsets(code)]
+    await redis_client.eval(ADD_SCRIPT, 3, BLOOM_KEY, BLOOM_BUILDING_KEY, BLOOM_REBUILD_LOCK_KEY, *offsets)
+
+
+# The filter is shared, and other processes may hold failed adds of their own
+# that they replay late or never (if they exit first). So after an outage the
+# filter is switched off for every process until a rebuild sets all bits.
+async def _replay_unsynced(redis_client):
+    global _rebuild_needed
+    if not _unsynced:
+        return
+    codes = list(_unsynced)
+    await redis_client.delete(BLOOM_READY_KEY)
+    _rebuild_needed = True
+    await _add_offsets(redis_client, codes)
+    _unsynced.difference_update(codes)
+    logger.warning("Replayed %d bloom filter adds; filter bypassed until rebuilt", len(codes))
+
+
+async def bloom_absent(redis_client, *short_codes) -> set:
+    # Codes the filter proves do not exist; empty when it cannot tell.
+    if not BLOOM_ENABLED or not short_codes:
+        return set()
+    args = [PARAMS, HASHES]
+    for code in short_codes:
+        args.extend(bit_offsets(code))
+    try:
+        await _replay_unsynced(redis_client)
+        flags = await redis_client.eval(CHECK_SCRIPT, 2, BLOOM_KEY, BLOOM_READY_KEY, *args)
+    except Exception as e:
+        logger.warning("Bloom filter check failed: %s", e)
+        return set()
+    return {code for code, flag in zip(short_codes, flags) if not int(flag)}
+
+
+async def bloom_add(redis_client, *short_codes):
+    if not BLOOM_ENABLED or not short_codes:
+        return
+    try:
+        await _replay_unsynced(redis_client)
+        await _add_offsets(redis_client, short_codes)
+    except Exception as e:
+        logger.error("Bloom filter add failed, will retry: %s", e)
+        _unsynced.update(short_codes)
+
+
+async def bloom_ready(redis_client) -> bool:
+    try:
+        value = await redis_client.get(BLOOM_READY_KEY)
+    except Exception:
+        return False
+    return value is not None and value.decode("utf-8") == PARAMS
+
+
+# Deleted codes cannot be cleared from a Bloom filter; they stay as false
+# positives until this rebuild, which sets bits for every current code in a
+# local bitmap and swaps it in atomically. Shards are read one at a time.
+async def rebuild_bloom(redis_client, shard_set):
+    if not BLOOM_ENABLED:
+        return {"codes": 0, "seconds": 0.0}
+    if not await redis_client.set(BLOOM_REBUILD_LOCK_KEY, 1, nx=True, ex=BLOOM_REBUILD_LOCK_TTL):
+        logger.info("Bloom filter rebuild already running")
+        return None
+    started = time.monotonic()
+    try:
+        await redis_client.delete(BLOOM_BUILDING_KEY)
+        bits = bytearray((BITS + 7) // 8)
+        count = 0
+        stmt = select(Link.short_code).execution_options(yield_per=REBUILD_BATCH_SIZE)
+        for session_maker in shard_set.session_makers:
+            async with session_maker() as db:
+                result = await db.stream(stmt)
+                async for codes in result.scalars().partitions(REBUILD_BATCH_SIZE):
+                    for code in codes:
+                        for offset in bit_offsets(code):
+                            # Redis numbers bits from the most significant bit of each byte.
+                            bits[offset >> 3] |= 0x80 >> (offset & 7)
+                    count += len(codes)
+        await redis_client.set(BLOOM_SNAPSHOT_KEY, bytes(bits))
+        await redis_client.eval(
+            SWAP_SCRIPT, 5, BLOOM_KEY, BLOOM_SNAPSHOT_KEY, BLOOM_BUILDING_KEY, BLOOM_READY_KEY,
+            BLOOM_REBUILD_LOCK_KEY, PARAMS,
+        )
+    except Exception:
+        await redis_client.delete(BLOOM_BUILDING_KEY, BLOOM_SNAPSHOT_KEY, BLOOM_REBUILD_LOCK_KEY)
+        raise
+    elapsed = time.monotonic() - started
+    logger.info("Rebuilt bloom filter with %d codes in %.2fs (%d bits, %d hashes)", count, elapsed, BITS, HASHES)
+    return {"codes": count, "seconds": round(elapsed, 3)}
+
+
+# Runs at startup; lookups bypass the filter until the first build finishes.
+async def ensure_bloom(redis_client, shard_set):
+    if not BLOOM_ENABLED or await bloom_ready(redis_client):
+        return
+    try:
+        await rebuild_bloom(redis_client, shard_set)
+    except Exception as e:
+        logger.error("Initial bloom filter build failed: %s", e)
+
+
+async def run_unsynced_replay(redis_client, shard_set):
+    global _rebuild_needed
+    while True:
+        await asyncio.sleep(UNSYNCED_RETRY_INTERVAL)
+        try:
+            await _replay_unsynced(redis_client)
+            if _rebuild_needed:
+                _rebuild_needed = False
+                await ensure_bloom(redis_client, shard_set)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Bloom filter adds still pending (%d): %s", len(_unsynced), e)
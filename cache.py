@@ -0,0 +1,440 @@
+import asyncio
+import logging
+import math
+import random
+import struct
+import time
+from calendar import timegm
+from collections import namedtuple, OrderedDict
+from sqlalchemy.future import select
+from config import (
+    LINK_CACHE_TTL, NEGATIVE_CACHE_TTL, LOCAL_CACHE_MAXSIZE, LOCAL_CACHE_TTL, CACHE_INVALIDATION_CHANNEL,
+    CACHE_EARLY_REFRESH_BETA
+)
+from sharding import shards
+from models import Link
+from metrics import LINK_CACHE_REDIS
+from bloom import bloom_absent
+from locks import acquire_lock, release_lock
+
+logger = logging.getLogger(__name__)
+
+LINK_OK = 0
+LINK_NOT_FOUND = 1
+LINK_EXPIRED = 2
+
+# version, status, link id, expires_at as a unix timestamp (0 = never),
+# cached_until as a unix timestamp, seconds the database load took,
+# followed by the utf-8 encoded original url.
+ENTRY_VERSION = 2
+ENTRY_HEADER = struct.Struct("!BBqddf")
+
+CacheEntry = namedtuple(
+    "CacheEntry", ["status", "link_id", "expires_at", "original_url", "cached_until", "delta"], defaults=(0.0, 0.0)
+)
+
+# Bumped by invalidate_link before it deletes the entry. Loads read it before
+# querying and write only if it is unchanged, so a row read before an update
+# is not cached after the update's invalidation. Outlives any load.
+ENTRY_VERSION_TTL = 3600
+
+# KEYS: entry, version. ARGV: version read before the load ("" if none),
+# encoded entry, ttl, "1" for NX.
+STORE_ENTRY_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+if ARGV[4] == '1' then
+    return redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3], 'NX') and 1 or 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+LOAD_LOCK_TTL_MS = 2000
+LOAD_LOCK_POLLS = 10
+LOAD_LOCK_POLL_INTERVAL = 0.02
+
+
+# Bounded per-process LRU cache with a TTL per entry. ``generation`` changes
+# on every invalidation so that a value read from Redis before an
+# invalidation arrived is not written back afterwards.
+class LocalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None, generation: int = None):
+        if generation is not None and generation != self.generation:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        self.generation += 1
+        return self._data.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+link_cache = LocalCache(LOCAL_CACHE_MAXSIZE, LOCAL_CACHE_TTL)
+local_caches = {"link": link_cache}
+
+
+def register_local_cache(namespace: str, local_cache):
+    local_caches[namespace] = local_cache
+
+
+async def publish_invalidation(redis_client, namespace: str, *keys, delete_keys=()):
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        if delete_keys:
+            pipe.delete(*delete_keys)
+        for key in keys:
+            pipe.publish(CACHE_INVALIDATION_CHANNEL, f"{namespace}:{key}")
+        await pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to publish cache invalidation: %s", e)
+
+
+def _dispatch_invalidation(message: bytes):
+    namespace, _, key = message.decode("utf-8").partition(":")
+    local_cache = local_caches.get(namespace)
+    if local_cache is not None:
+        local_cache.pop(key)
+
+
+def _clear_local_caches():
+    for local_cache in local_caches.values():
+        local_cache.clear()
+
+
+async def listen_for_invalidations(redis_client):
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            # Anything published while we were not subscribed is lost.
+            _clear_local_caches()
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    _dispatch_invalidation(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Cache invalidation listener failed, resubscribing: %s", e)
+            _clear_local_caches()
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+
+
+def cache_key(short_code: str) -> str:
+    return f"short_code:{short_code}"
+
+
+def version_key(short_code: str) -> str:
+    return f"short_code_version:{short_code}"
+
+
+# Current entry versions ("" when never invalidated), or None if Redis fails.
+async def entry_versions(redis_client, short_codes):
+    try:
+        values = await redis_client.mget([version_key(code) for code in short_codes])
+    except Exception:
+        return None
+    return [value.decode("utf-8") if value is not None else "" for value in values]
+
+
+def to_timestamp(dt):
+    if dt is None:
+        return None
+    return timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def encode_entry(entry: CacheEntry) -> bytes:
+    header = ENTRY_HEADER.pack(
+        ENTRY_VERSION, entry.status, entry.link_id or 0, entry.expires_at or 0.0, entry.cached_until, entry.delta
+    )
+    return header + (entry.original_url or "").encode("utf-8")
+
+
+def decode_entry(raw: bytes):
+    if not raw or len(raw) < ENTRY_HEADER.size:
+        return None
+    version, status, link_id, expires_at, cached_until, delta = ENTRY_HEADER.unpack_from(raw)
+    if version != ENTRY_VERSION:
+        return None
+    original_url = raw[ENTRY_HEADER.size:].decode("utf-8")
+    return CacheEntry(status, link_id, expires_at or None, original_url, cached_until, delta)
+
+
+def is_expired(entry: CacheEntry, now: float = None) -> bool:
+    if entry.status == LINK_EXPIRED:
+        return True
+    return entry.expires_at is not None and (now or time.time()) >= entry.expires_at
+
+
+def entry_ttl(entry: CacheEntry, now: float = None, ttl: int = LINK_CACHE_TTL) -> int:
+    if entry.status != LINK_OK:
+        return NEGATIVE_CACHE_TTL
+    if entry.expires_at is not None:
+        ttl = min(ttl, math.ceil(entry.expires_at - (now or time.time())))
+    return max(ttl, 1)
+
+
+async def get_cached_entry(redis_client, short_code: str):
+    entry = link_cache.get(short_code)
+    if entry is not None:
+        return entry
+    generation = link_cache.generation
+    try:
+        raw = await redis_client.get(cache_key(short_code))
+    except Exception:
+        LINK_CACHE_REDIS.labels("error").inc()
+        return None
+    entry = decode_entry(raw)
+    if entry is not None:
+        LINK_CACHE_REDIS.labels("hit").inc()
+        link_cache.set(short_code, entry, entry_ttl(entry), generation)
+    else:
+        LINK_CACHE_REDIS.labels("miss").inc()
+    return entry
+
+
+# Probabilistic early expiration (XFetch): the closer an entry is to
+# cached_until, and the slower it was to load, the likelier a read triggers a
+# refresh, so hot entries are reloaded by one request before they expire.
+def should_refresh_early(entry: CacheEntry, now: float = None) -> bool:
+    if entry.status != LINK_OK or not entry.cached_until:
+        return False
+    jitter = -entry.delta * CACHE_EARLY_REFRESH_BETA * math.log(1.0 - random.random())
+    return (now or time.time()) + jitter >= entry.cached_until
+
+
+# generation and version are link_cache.generation and the entry_versions
+# value taken before the entry was read from the database; a write after an
+# invalidation is skipped. Without a version Redis is not written.
+async def store_entry(redis_client, short_code: str, entry: CacheEntry, generation: int, version):
+    ttl = entry_ttl(entry)
+    entry = entry._replace(cached_until=time.time() + ttl)
+    link_cache.set(short_code, entry, ttl, generation)
+    if version is None:
+        return
+    try:
+        await redis_client.eval(
+            STORE_ENTRY_SCRIPT, 2, cache_key(short_code), version_key(short_code), version, encode_entry(entry), ttl, 0
+        )
+    except Exception:
+        pass
+
+
+# Pipelined writes of many entries to Redis only, each with the given base
+# TTL and the version read before it was loaded. With nx, entries already
+# cached (e.g. filled after an update) are kept.
+async def store_entries(redis_client, entries, ttl: int = LINK_CACHE_TTL, nx: bool = False):
+    now = time.time()
+    pipe = redis_client.pipeline(transaction=False)
+    for short_code, entry, version in entries:
+        entry_seconds = entry_ttl(entry, now, ttl)
+        entry = entry._replace(cached_until=now + entry_seconds)
+        pipe.eval(
+            STORE_ENTRY_SCRIPT, 2, cache_key(short_code), version_key(short_code),
+            version, encode_entry(entry), entry_seconds, int(nx),
+        )
+    await pipe.execute()
+
+
+def link_entry(link_id: int, original_url: str, expires_at, delta: float = 0.0) -> CacheEntry:
+    entry = CacheEntry(LINK_OK, link_id, to_timestamp(expires_at), original_url, delta=delta)
+    if is_expired(entry):
+        # The expiry worker deletes the row; until then answer 410 from cache.
+        entry = entry._replace(status=LINK_EXPIRED)
+    return entry
+
+
+async def invalidate_link(redis_client, *short_codes):
+    if not short_codes:
+        return
+    for code in short_codes:
+        link_cache.pop(code)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for code in short_codes:
+            pipe.incr(version_key(code))
+            pipe.expire(version_key(code), ENTRY_VERSION_TTL)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to bump link cache versions: %s", e)
+    await publish_invalidation(
+        redis_client, "link", *short_codes, delete_keys=[cache_key(code) for code in short_codes]
+    )
+
+
+async def _load_from_db(db, redis_client, short_code: str) -> CacheEntry:
+    generation = link_cache.generation
+    [version] = await entry_versions(redis_client, [short_code]) or [None]
+    stmt = select(Link.id, Link.original_url, Link.expires_at).filter(Link.short_code == short_code)
+    started = time.perf_counter()
+    row = (await db.execute(stmt)).one_or_none()
+    delta = time.perf_counter() - started
+    if row is None:
+        entry = CacheEntry(LINK_NOT_FOUND, 0, None, "")
+    else:
+        entry = link_entry(row.id, row.original_url, row.expires_at, delta)
+    await store_entry(redis_client, short_code, entry, generation, version)
+    return entry
+
+
+def _lock_key(short_code: str) -> str:
+    return f"short_code_lock:{short_code}"
+
+
+# Only the worker holding the Redis lock queries the database; the others
+# wait briefly for its result and query themselves if it does not show up.
+async def _load_with_lock(db, redis_client, short_code: str) -> CacheEntry:
+    try:
+        token = await acquire_lock(redis_client, _lock_key(short_code), LOAD_LOCK_TTL_MS)
+    except Exception:
+        return await _load_from_db(db, redis_client, short_code)
+    if token is None:
+        for _ in range(LOAD_LOCK_POLLS):
+            await asyncio.sleep(LOAD_LOCK_POLL_INTERVAL)
+            entry = await get_cached_entry(redis_client, short_code)
+            if entry is not None:
+                return entry
+        return await _load_from_db(db, redis_client, short_code)
+    try:
+        return await _load_from_db(db, redis_client, short_code)
+    finally:
+        try:
+            # A load slower than LOAD_LOCK_TTL_MS leaves the next holder's lock alone.
+            await release_lock(redis_client, _lock_key(short_code), token)
+        except Exception:
+            pass
+
+
+class LoadAborted(Exception):
+    pass
+
+
+# Loads in progress in this worker, so concurrent misses for one code share a
+# single load instead of each querying the database.
+_inflight = {}
+
+
+async def _load_coalesced(db, redis_client, short_code: str) -> CacheEntry:
+    future = _inflight.get(short_code)
+    if future is not None:
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            return await _load_with_lock(db, redis_client, short_code)
+    future = asyncio.get_running_loop().create_future()
+    _inflight[short_code] = future
+    try:
+        entry = await _load_with_lock(db, redis_client, short_code)
+    except BaseException as e:
+        future.set_exception(e if isinstance(e, Exception) else LoadAborted())
+        # Mark the exception retrieved in case nobody was waiting.
+        future.exception()
+        raise
+    else:
+        future.set_result(entry)
+    finally:
+        _inflight.pop(short_code, None)
+    return entry
+
+
+_refreshing = set()
+# Running refresh tasks; the event loop only keeps weak references to them.
+_refresh_tasks = set()
+
+
+async def _refresh(redis_client, short_code: str, stale: CacheEntry):
+    try:
+        # Another worker may already have refreshed the Redis copy.
+        generation = link_cache.generation
+        entry = decode_entry(await redis_client.get(cache_key(short_code)))
+        if entry is not None and entry.cached_until > stale.cached_until:
+            link_cache.set(short_code, entry, entry_ttl(entry), generation)
+            return
+        async with shards.session_maker_for_code(short_code)() as db:
+            await _load_with_lock(db, redis_client, short_code)
+    except Exception as e:
+        logger.warning("Early refresh of %s failed: %s", short_code, e)
+    finally:
+        _refreshing.discard(short_code)
+
+
+def _schedule_refresh(redis_client, short_code: str, stale: CacheEntry):
+    if short_code in _refreshing or short_code in _inflight:
+        return
+    _refreshing.add(short_code)
+    task = asyncio.create_task(_refresh(redis_client, short_code, stale))
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_tasks.discard)
+
+
+async def cancel_refreshes():
+    tasks = list(_refresh_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def load_link_entry(db, redis_client, short_code: str) -> CacheEntry:
+    entry = await get_cached_entry(redis_client, short_code)
+    if entry is None:
+        # Checked before the load lock, so probing unknown codes costs no lock round trips.
+        generation = link_cache.generation
+        [version] = await entry_versions(redis_client, [short_code]) or [None]
+        if await bloom_absent(redis_client, short_code):
+            entry = CacheEntry(LINK_NOT_FOUND, 0, None, "")
+            await store_entry(redis_client, short_code, entry, generation, version)
+            return entry
+        return await _load_coalesced(db, redis_client, short_code)
+    if should_refresh_early(entry):
+        # Keep serving the cached entry while one background load replaces it.
+        _schedule_refresh(redis_client, short_code, entry)
+    return entry
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import update, case
+from config import REDIRECT_COUNTER_FLUSH_INTERVAL, REDIRECT_COUNTER_FLUSH_BATCH_SIZE, DB_POOL_TIMEOUT
+from locks import held_lock
+from sharding import shards
+from models import Link
+
+logger = logging.getLogger(__name__)
+
+PENDING_COUNTS_KEY = "redirect_counts:pending"
+PENDING_LAST_KEY = "redirect_counts:last"
+FLUSHING_COUNTS_KEY = "redirect_counts:flushing"
+FLUSHING_LAST_KEY = "redirect_counts:flushing_last"
+FLUSH_LOCK_KEY = "redirect_counts:flush_lock"
+# Well above a wait for a pooled connection and renewed while the flush runs:
+# a second flusher would claim the same batch and count it twice.
+FLUSH_LOCK_TTL_MS = int(max(60, DB_POOL_TIMEOUT * 4) * 1000)
+
+# Moves the pending hashes aside so new redirects keep counting while the
+# previous batch is written to the database. A batch left over by a failed
+# flush is picked up again instead of being overwritten.
+CLAIM_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 1 then redis.call('RENAME', KEYS[1], KEYS[3]) end
+    if redis.call('EXISTS', KEYS[2]) == 1 then redis.call('RENAME', KEYS[2], KEYS[4]) end
+end
+return {redis.call('HGETALL', KEYS[3]), redis.call('HGETALL', KEYS[4])}
+"""
+
+_local_counts = defaultdict(int)
+_local_last = {}
+# Set while redirects are buffered locally, so the outage is logged once
+# instead of on every redirect.
+_buffering = False
+
+
+async def record_redirect(redis_client, link_id: int):
+    global _buffering
+    now = time.time()
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hincrby(PENDING_COUNTS_KEY, link_id, 1)
+        pipe.hset(PENDING_LAST_KEY, link_id, now)
+        await pipe.execute()
+    except Exception as e:
+        if not _buffering:
+            logger.warning("Redis unavailable for redirect counters, buffering locally: %s", e)
+            _buffering = True
+        _local_counts[link_id] += 1
+        _local_last[link_id] = now
+        return
+    if _buffering:
+        logger.info("Redis available again for redirect counters")
+        _buffering = False
+
+
+async def get_pending(redis_client, link_id: int):
+    delta = _local_counts.get(link_id, 0)
+    last = _local_last.get(link_id)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hget(PENDING_COUNTS_KEY, link_id)
+        pipe.hget(FLUSHING_COUNTS_KEY, link_id)
+        pipe.hget(PENDING_LAST_KEY, link_id)
+        pipe.hget(FLUSHING_LAST_KEY, link_id)
+        pending, flushing, pending_last, flushing_last = await pipe.execute()
+    except Exception:
+        return delta, last
+    delta += int(pending or 0) + int(flushing or 0)
+    for value in (pending_last, flushing_last):
+        if value is not None:
+            last = max(last or 0, float(value))
+    return delta, last
+
+
+def merge_pending(link_out, delta: int, last):
+    link_out.redirect_count += delta
+    if last is not None:
+        last_dt = datetime.utcfromtimestamp(last)
+        if link_out.last_redirect_at is None or last_dt > link_out.last_redirect_at:
+            link_out.last_redirect_at = last_dt
+    return link_out
+
+
+def _pairs(flat):
+    if isinstance(flat, dict):
+        return flat.items()
+    return zip(flat[::2], flat[1::2])
+
+
+async def _apply_shard(session_maker, ids, counts: dict, last: dict):
+    async with session_maker() as db:
+        for start in range(0, len(ids), REDIRECT_COUNTER_FLUSH_BATCH_SIZE):
+            chunk = ids[start:start + REDIRECT_COUNTER_FLUSH_BATCH_SIZE]
+            stmt = (
+                update(Link)
+                .where(Link.id.in_(chunk))
+                .values(
+                    redirect_count=Link.redirect_count + case({i: counts[i] for i in chunk}, value=Link.id, else_=0),
+                    last_redirect_at=case(
+                        {i: datetime.utcfromtimestamp(last[i]) for i in chunk if i in last},
+                        value=Link.id,
+                        else_=Link.last_redirect_at,
+                    ),
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await db.execute(stmt)
+        await db.commit()
+
+
+# Writes each shard's counters separately and returns the ids that could not
+# be applied, so a retry does not count the other shards twice.
+async def _apply(counts: dict, last: dict):
+    groups = shards.group_ids(sorted(counts))
+    results = await asyncio.gather(
+        *(_apply_shard(shards.session_makers[index], ids, counts, last) for index, ids in groups.items()),
+        return_exceptions=True,
+    )
+    failed = []
+    for ids, result in zip(groups.values(), results):
+        if isinstance(result, Exception):
+            logger.error("Redirect counter flush failed for %d links: %s", len(ids), result)
+            failed.extend(ids)
+    return failed
+
+
+async def _flush_local():
+    if not _local_counts:
+        return 0
+    counts = dict(_local_counts)
+    last = dict(_local_last)
+    _local_counts.clear()
+    _local_last.clear()
+    failed = await _apply(counts, last)
+    for link_id in failed:
+        _local_counts[link_id] += counts[link_id]
+        _local_last[link_id] = max(_local_last.get(link_id, 0), last.get(link_id, 0))
+    if failed:
+        raise RuntimeError(f"{len(failed)} local redirect counters not flushed")
+    return len(counts)
+
+
+async def _flush_redis(redis_client):
+    async with held_lock(redis_client, FLUSH_LOCK_KEY, FLUSH_LOCK_TTL_MS) as token:
+        if token is None:
+            return 0
+        raw_counts, raw_last = await redis_client.eval(
+            CLAIM_SCRIPT, 4, PENDING_COUNTS_KEY, PENDING_LAST_KEY, FLUSHING_COUNTS_KEY, FLUSHING_LAST_KEY
+        )
+        counts = {int(k): int(v) for k, v in _pairs(raw_counts)}
+        last = {int(k): float(v) for k, v in _pairs(raw_last)}
+        failed = await _apply(counts, last) if counts else []
+        if failed:
+            # Keeps only the failed shards' counters for the next flush.
+            failed = set(failed)
+            applied = [link_id for link_id in counts if link_id not in failed]
+            if applied:
+                await redis_client.hdel(FLUSHING_COUNTS_KEY, *applied)
+                await redis_client.hdel(FLUSHING_LAST_KEY, *applied)
+            raise RuntimeError(f"{len(failed)} redirect counters not flushed")
+        await redis_client.delete(FLUSHING_COUNTS_KEY, FLUSHING_LAST_KEY)
+        return len(counts)
+
+
+async def flush_counters(redis_client):
+    flushed = await _flush_local()
+    if redis_client is not None:
+        flushed += await _flush_redis(redis_client)
+    if flushed:
+        logger.info("Flushed redirect counters for %d links", flushed)
+    return flushed
+
+
+async def run_flusher(redis_client):
+    while True:
+        await asyncio.sleep(REDIRECT_COUNTER_FLUSH_INTERVAL)
+        try:
+            await flush_counters(redis_client)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Redirect counter flush failed: %s", e)
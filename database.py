@@ -1,9 +1,31 @@
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from config import DATABASE_URL_ASYNC
+from config import (
+    DATABASE_URL_ASYNC, DATABASE_READ_URL_ASYNC, DB_ECHO, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_CACHE_SIZE, DB_PREPARED_STATEMENT_CACHE_SIZE
+)
 
-async_engine = create_async_engine(DATABASE_URL_ASYNC, echo=True, future=True)
+def make_engine(url: str):
+    url = make_url(url)
+    options = {"echo": DB_ECHO, "future": True, "pool_pre_ping": DB_POOL_PRE_PING}
+    # SQLite (local runs and tests) keeps the driver's default pool.
+    if url.get_backend_name() == "postgresql":
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+        if url.get_driver_name() == "asyncpg":
+            url = url.update_query_dict({"prepared_statement_cache_size": str(DB_PREPARED_STATEMENT_CACHE_SIZE)})
+            options["connect_args"] = {"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    return create_async_engine(url, **options)
+
+async_engine = make_engine(DATABASE_URL_ASYNC)
 async_session_maker = sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+read_engine = make_engine(DATABASE_READ_URL_ASYNC) if DATABASE_READ_URL_ASYNC else async_engine
 Base = declarative_base()
 
 async def init_models():
@@ -12,4 +34,15 @@ async def init_models():
 
 async def get_db():
     async with async_session_maker() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+async def dispose_engines():
+    await async_engine.dispose()
+    if read_engine is not async_engine:
+        await read_engine.dispose()
+
+# INSERT construct of the session's dialect, for ON CONFLICT clauses.
+def dialect_insert(db, table):
+    if db.bind.dialect.name == "postgresql":
+        return postgresql.insert(table)
+    return sqlite.insert(table)
@@ -0,0 +1,42 @@
+import logging
+from cache import to_timestamp
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_QUEUE_KEY = "links:expiry"
+
+# Atomically takes up to ARGV[2] codes whose expiry score is <= ARGV[1].
+POP_DUE_SCRIPT = """
+local codes = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+if #codes > 0 then redis.call('ZREM', KEYS[1], unpack(codes)) end
+return codes
+"""
+
+
+async def schedule_expiry(redis_client, links):
+    # links: iterable of (short_code, expires_at); links without an expiry are
+    # removed from the queue.
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for short_code, expires_at in links:
+            if expires_at is None:
+                pipe.zrem(EXPIRY_QUEUE_KEY, short_code)
+            else:
+                pipe.zadd(EXPIRY_QUEUE_KEY, {short_code: to_timestamp(expires_at)})
+        await pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to update expiry queue: %s", e)
+
+
+async def unschedule_expiry(redis_client, *short_codes):
+    if not short_codes:
+        return
+    try:
+        await redis_client.zrem(EXPIRY_QUEUE_KEY, *short_codes)
+    except Exception as e:
+        logger.warning("Failed to update expiry queue: %s", e)
+
+
+async def pop_due(redis_client, now: float, limit: int):
+    codes = await redis_client.eval(POP_DUE_SCRIPT, 1, EXPIRY_QUEUE_KEY, now, limit)
+    return [code.decode("utf-8") if isinstance(code, bytes) else code for code in codes]
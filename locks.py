@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import uuid
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Both only touch the lock while it still holds the caller's token, so a
+# holder that outlived its TTL cannot release or extend the next one's lock.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+# Returns the lock's token, or None when another worker holds it.
+async def acquire_lock(redis_client, key: str, ttl_ms: int):
+    token = uuid.uuid4().hex
+    if await redis_client.set(key, token, nx=True, px=ttl_ms):
+        return token
+    return None
+
+
+async def release_lock(redis_client, key: str, token: str) -> bool:
+    return bool(await redis_client.eval(RELEASE_SCRIPT, 1, key, token))
+
+
+async def renew_lock(redis_client, key: str, token: str, ttl_ms: int) -> bool:
+    return bool(await redis_client.eval(RENEW_SCRIPT, 1, key, token, ttl_ms))
+
+
+# Holds the lock for the body of the block, extending it every third of its
+# TTL, and releases it afterwards. Yields None when the lock is taken.
+@asynccontextmanager
+async def held_lock(redis_client, key: str, ttl_ms: int):
+    token = await acquire_lock(redis_client, key, ttl_ms)
+    if token is None:
+        yield None
+        return
+
+    async def renew():
+        while True:
+            await asyncio.sleep(ttl_ms / 3000)
+            try:
+                if not await renew_lock(redis_client, key, token, ttl_ms):
+                    logger.warning("Lost lock %s", key)
+                    return
+            except Exception as e:
+                logger.warning("Could not renew lock %s: %s", key, e)
+
+    renewer = asyncio.create_task(renew())
+    try:
+        yield token
+    finally:
+        renewer.cancel()
+        await release_lock(redis_client, key, token)
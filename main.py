@@ -1,14 +1,26 @@
+import asyncio
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.openapi.utils import get_openapi
 import redis.asyncio as aioredis
 from config import REDIS_URL
-from database import init_models
+from database import init_models, async_engine, read_engine, dispose_engines
+from sharding import shards, init_shards
 from routers import users, links
+import counters
+import analytics
+from cache import listen_for_invalidations, local_caches, cancel_refreshes
+from metrics import MetricsMiddleware, setup_metrics, render_metrics
+from ratelimit import RateLimitMiddleware, LoadShedMiddleware
+from search import setup_search_backend
+from bloom import ensure_bloom, run_unsynced_replay
+from warmup import warm_cache_safely
+from qr import shutdown_qr_executor
 from tasks import celery_app
 
 logger = logging.getLogger(__name__)
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 def custom_openapi():
     if app.openapi_schema:
@@ -28,12 +40,12 @@ def custom_openapi():
     }
     for path, methods in openapi_schema["paths"].items():
         for method, details in methods.items():
-            if path == "/users/links" and method.lower() == "get":
+            if path in ("/users/links", "/users/links/export") and method.lower() == "get":
                 details["security"] = [{"BearerAuth": []}]
             elif path.startswith("/{") and method.lower() in ["put", "delete"]:
                 details["security"] = [{"BearerAuth": []}]
             elif path.startswith("/shorten") and method.lower() == "post":
-                if path != "/shorten/public":
+                if path not in ("/shorten/public", "/shorten/batch/public"):
                     details["security"] = [{"BearerAuth": []}]
             elif path.startswith("/token/refresh"):
                 details["security"] = [{"BearerAuth": []}]
@@ -42,17 +54,59 @@ def custom_openapi():
 
 app.openapi = custom_openapi
 
+# Added innermost first: metrics see every response, shedding runs before the
+# rate limiter's Redis call.
+app.add_middleware(RateLimitMiddleware, routes=app.router.routes)
+app.add_middleware(LoadShedMiddleware)
+app.add_middleware(MetricsMiddleware)
+engines = {"primary": async_engine}
+if read_engine is not async_engine:
+    engines["replica"] = read_engine
+if shards.engines[0] is not async_engine:
+    engines.update({f"shard{index}": engine for index, engine in enumerate(shards.engines)})
+setup_metrics(engines, local_caches)
+
+@app.get("/metrics", include_in_schema=False, response_class=Response)
+async def metrics():
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
 app.include_router(users.router, prefix="/users", tags=["users"])
 app.include_router(links.router, tags=["links"])
 
 redis_client = None
+background_tasks = []
 
 @app.on_event("startup")
 async def startup():
     await init_models()
+    await init_shards(shards)
+    await setup_search_backend(shards.engines)
     global redis_client
     redis_client = await aioredis.from_url(REDIS_URL, encoding="utf-8", decode_responses=False)
+    background_tasks.append(asyncio.create_task(counters.run_flusher(redis_client)))
+    background_tasks.append(asyncio.create_task(listen_for_invalidations(redis_client)))
+    background_tasks.append(asyncio.create_task(analytics.run_local_drain(redis_client)))
+    background_tasks.append(asyncio.create_task(ensure_bloom(redis_client, shards)))
+    background_tasks.append(asyncio.create_task(run_unsynced_replay(redis_client, shards)))
+    background_tasks.append(asyncio.create_task(warm_cache_safely(redis_client, shards)))
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await cancel_refreshes()
+    try:
+        await counters.flush_counters(redis_client)
+    except Exception as e:
+        logger.error("Final redirect counter flush failed: %s", e)
+    try:
+        await analytics.drain_local_events(redis_client)
+    except Exception as e:
+        logger.error("Dropping %d buffered click events: %s", len(analytics._local_events), e)
+    shutdown_qr_executor()
     await redis_client.close()
+    await dispose_engines()
+    await shards.dispose()
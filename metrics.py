@@ -0,0 +1,220 @@
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import time
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, start_http_server
+)
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from config import PROFILE_HEADER_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_DIR, CELERY_METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route"], buckets=LATENCY_BUCKETS
+)
+REQUEST_DB_QUERIES = Histogram(
+    "http_request_db_queries", "Database statements executed per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Time spent in database statements per request", ["route"], buckets=LATENCY_BUCKETS
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Database statement latency", ["engine", "operation"], buckets=QUERY_BUCKETS
+)
+LINK_CACHE_REDIS = Counter(
+    "link_cache_redis_requests_total", "Lookups of short_code: keys in Redis", ["result"]
+)
+CELERY_TASK_DURATION = Histogram(
+    "celery_task_duration_seconds", "Celery task run time", ["task", "state"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+CELERY_ROWS_DELETED = Counter("celery_task_rows_deleted_total", "Rows deleted by Celery tasks", ["task"])
+
+# Statement count and time of the current request, filled by the engine hooks.
+_request_db = contextvars.ContextVar("request_db", default=None)
+_profiling = False
+
+
+def _operation(statement: str) -> str:
+    return statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+
+
+def instrument_engine(engine, name: str):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_DURATION.labels(name, _operation(statement)).observe(elapsed)
+        stats = _request_db.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+class PoolCollector:
+    def __init__(self, engines: dict):
+        self.engines = engines
+
+    def collect(self):
+        size = GaugeMetricFamily("db_pool_size", "Configured pool size", labels=["engine"])
+        checked_out = GaugeMetricFamily("db_pool_checked_out", "Connections in use", labels=["engine"])
+        overflow = GaugeMetricFamily("db_pool_overflow", "Connections opened beyond the pool size", labels=["engine"])
+        for name, engine in self.engines.items():
+            pool = engine.sync_engine.pool
+            if not hasattr(pool, "checkedout"):
+                continue
+            size.add_metric([name], pool.size())
+            checked_out.add_metric([name], pool.checkedout())
+            overflow.add_metric([name], max(pool.overflow(), 0))
+        yield size
+        yield checked_out
+        yield overflow
+
+
+class LocalCacheCollector:
+    def __init__(self, caches: dict):
+        self.caches = caches
+
+    def collect(self):
+        requests = CounterMetricFamily(
+            "local_cache_requests", "Per-process cache lookups", labels=["cache", "result"]
+        )
+        evictions = CounterMetricFamily("local_cache_evictions", "Per-process cache evictions", labels=["cache"])
+        size = GaugeMetricFamily("local_cache_entries", "Per-process cache entries", labels=["cache"])
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            requests.add_metric([name, "hit"], stats["hits"])
+            requests.add_metric([name, "miss"], stats["misses"])
+            evictions.add_metric([name], stats["evictions"])
+            size.add_metric([name], stats["size"])
+        yield requests
+        yield evictions
+        yield size
+
+
+# Collectors that read state of this process (pools, local caches).
+_process_collectors = []
+
+
+def setup_metrics(engines: dict, caches: dict):
+    for name, engine in engines.items():
+        instrument_engine(engine, name)
+    _process_collectors.extend([PoolCollector(engines), LocalCacheCollector(caches)])
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        for collector in _process_collectors:
+            REGISTRY.register(collector)
+
+
+def _registry():
+    # With PROMETHEUS_MULTIPROC_DIR set every worker process writes its
+    # samples to files there and any process can serve the aggregate.
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    from prometheus_client import multiprocess
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    for collector in _process_collectors:
+        registry.register(collector)
+    return registry
+
+
+def render_metrics():
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def _should_profile(scope) -> bool:
+    if _profiling:
+        return False
+    if PROFILE_HEADER_ENABLED and any(name == b"x-profile" for name, _ in scope.get("headers", ())):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _report_profile(profiler, method: str, route: str, elapsed: float):
+    buf = io.StringIO()
+    stats = pstats.Stats(profiler, stream=buf).sort_stats("cumulative")
+    stats.print_stats(25)
+    logger.info("Profile of %s %s (%.1f ms):\n%s", method, route, elapsed * 1000, buf.getvalue())
+    if PROFILE_DIR:
+        name = f"{int(time.time() * 1000)}-{method}-{route.strip('/').replace('/', '_') or 'root'}.prof"
+        stats.dump_stats(os.path.join(PROFILE_DIR, name))
+
+
+# Records latency, status and database work per route template. cProfile
+# sees every coroutine on the event loop, so only one request is profiled at
+# a time and the result still includes whatever else ran meanwhile.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        global _profiling
+        status = [500]
+        stats = [0, 0.0]
+        token = _request_db.set(stats)
+        profiler = None
+        if _should_profile(scope):
+            _profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_db.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_LATENCY.labels(method, route).observe(elapsed)
+            HTTP_REQUESTS.labels(method, route, str(status[0])).inc()
+            REQUEST_DB_QUERIES.labels(route).observe(stats[0])
+            REQUEST_DB_SECONDS.labels(route).observe(stats[1])
+            if profiler is not None:
+                profiler.disable()
+                _profiling = False
+                _report_profile(profiler, method, route, elapsed)
+
+
+_task_started = {}
+
+
+def task_prerun(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+def task_postrun(task_id=None, task=None, retval=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        CELERY_TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+    if isinstance(retval, dict) and retval.get("deleted"):
+        CELERY_ROWS_DELETED.labels(task.name).inc(retval["deleted"])
+
+
+def start_worker_metrics_server(**kwargs):
+    if CELERY_METRICS_PORT:
+        start_http_server(CELERY_METRICS_PORT, registry=_registry())
+        logger.info("Serving Celery metrics on port %d", CELERY_METRICS_PORT)
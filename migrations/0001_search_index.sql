@@ -0,0 +1,14 @@
+-- Trigram index behind GET /search on PostgreSQL (search.PostgresTrigramSearch).
+-- CONCURRENTLY builds it without blocking writes to links; psql runs each
+-- statement outside a transaction, as CONCURRENTLY requires.
+-- With SHARD_DATABASE_URLS, apply to every shard.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Created at startup by earlier versions and no longer used.
+DROP INDEX CONCURRENTLY IF EXISTS ix_links_original_url_trgm;
+DROP INDEX CONCURRENTLY IF EXISTS ix_links_category_trgm;
+DROP INDEX CONCURRENTLY IF EXISTS ix_links_short_code_trgm;
+
+-- The expression must stay identical to search.SEARCH_DOCUMENT.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_links_search_trgm
+    ON links USING gist ((original_url || ' ' || coalesce(category, '') || ' ' || short_code) gist_trgm_ops);
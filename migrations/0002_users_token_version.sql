@@ -0,0 +1,4 @@
+-- Token version checked against the "ver" claim (auth.resolve_user); bumping
+-- it revokes every token issued before. Adding a column with a constant
+-- default does not rewrite users on PostgreSQL 11+.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0;
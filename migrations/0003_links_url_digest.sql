@@ -0,0 +1,5 @@
+-- Digest used by LINK_DEDUP_ENABLED (allocator.insert_links). The column is
+-- nullable, so adding it does not rewrite links; the partial unique index
+-- stops concurrent requests from creating the same link twice.
+ALTER TABLE links ADD COLUMN IF NOT EXISTS url_digest VARCHAR(64);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_links_url_digest ON links (url_digest) WHERE url_digest IS NOT NULL;
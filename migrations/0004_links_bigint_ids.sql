@@ -0,0 +1,16 @@
+-- Link ids carry the shard index above bit 40 (sharding.SHARD_ID_BITS), so
+-- links.id, its sequence and every link_id become BIGINT. owner_id loses its
+-- foreign key because links may live in another database than users.
+-- Changing a column type rewrites the table under an ACCESS EXCLUSIVE lock:
+-- run this in a maintenance window. Re-running it on BIGINT columns is a no-op.
+BEGIN;
+ALTER TABLE links DROP CONSTRAINT IF EXISTS links_owner_id_fkey;
+ALTER TABLE links ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE click_events ALTER COLUMN link_id TYPE BIGINT;
+ALTER TABLE click_rollups ALTER COLUMN link_id TYPE BIGINT;
+ALTER TABLE click_breakdowns ALTER COLUMN link_id TYPE BIGINT;
+DO $$
+BEGIN
+    EXECUTE format('ALTER SEQUENCE %s AS BIGINT', pg_get_serial_sequence('links', 'id'));
+END $$;
+COMMIT;
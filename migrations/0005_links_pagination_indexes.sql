@@ -0,0 +1,8 @@
+-- Keyset pagination of /users/links and /category/{category} on
+-- (created_at, id), newest first (pagination.paginate_by_created). Names
+-- and columns must match models.Link.__table_args__.
+-- With SHARD_DATABASE_URLS, apply to every shard.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_links_owner_id_created_at
+    ON links (owner_id, created_at, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_links_category_is_public
+    ON links (category, is_public, created_at, id);
@@ -0,0 +1,7 @@
+-- Indexes behind the expiry sweep and the unused-link cleanup in tasks.py.
+-- Names and columns must match models.Link.__table_args__.
+-- With SHARD_DATABASE_URLS, apply to every shard.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_links_expires_at
+    ON links (expires_at) WHERE expires_at IS NOT NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_links_last_redirect_at
+    ON links (last_redirect_at);
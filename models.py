@@ -1,25 +1,94 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, func, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, func, ForeignKey, Sequence, Index
 from sqlalchemy.orm import relationship
+from sqlalchemy.dialects import sqlite
 from database import Base
 
+# SQLite fills server_default=func.now() as "YYYY-MM-DD HH:MM:SS"; bind
+# created_at values in the same format so keyset comparisons line up.
+CreatedAt = DateTime().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
+    token_version = Column(Integer, default=0, server_default="0", nullable=False)
     created_at = Column(DateTime, server_default=func.now(), nullable=False)
-    links = relationship("Link", back_populates="owner")
+    links = relationship("Link", back_populates="owner", primaryjoin="User.id == foreign(Link.owner_id)")
+
+# Link ids carry their shard in the bits above sharding.SHARD_ID_BITS.
+LinkId = BigInteger().with_variant(Integer, "sqlite")
 
 class Link(Base):
     __tablename__ = "links"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(LinkId, primary_key=True, index=True)
     original_url = Column(String, nullable=False)
     short_code = Column(String, unique=True, index=True, nullable=False)
-    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    created_at = Column(CreatedAt, server_default=func.now(), nullable=False)
     expires_at = Column(DateTime, nullable=True)
     redirect_count = Column(Integer, default=0, nullable=False)
     last_redirect_at = Column(DateTime, nullable=True)
-    owner_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    # No foreign key: users stay on the primary database while links may be
+    # sharded across others.
+    owner_id = Column(Integer, nullable=True)
     category = Column(String, nullable=True)
     is_public = Column(Boolean, default=False, nullable=False)
-    owner = relationship("User", back_populates="links")
+    # utils.link_digest of generated links when LINK_DEDUP_ENABLED is set.
+    url_digest = Column(String(64), nullable=True)
+    owner = relationship("User", back_populates="links", primaryjoin="foreign(Link.owner_id) == User.id")
+
+    # Support keyset pagination on (created_at, id) for /users/links and /category/{category},
+    # and the expiry and inactivity sweeps in tasks.py.
+    __table_args__ = (
+        Index("ix_links_owner_id_created_at", "owner_id", "created_at", "id"),
+        Index("ix_links_category_is_public", "category", "is_public", "created_at", "id"),
+        Index(
+            "ix_links_expires_at", "expires_at",
+            postgresql_where=expires_at.isnot(None), sqlite_where=expires_at.isnot(None),
+        ),
+        Index("ix_links_last_redirect_at", "last_redirect_at"),
+        Index(
+            "ix_links_url_digest", "url_digest", unique=True,
+            postgresql_where=url_digest.isnot(None), sqlite_where=url_digest.isnot(None),
+        ),
+        # Never reuse ids of deleted rows, and let sharding.init_shards start
+        # the id counter of each shard at its own base.
+        {"sqlite_autoincrement": True},
+    )
+
+class ClickEvent(Base):
+    __tablename__ = "click_events"
+    id = Column(Integer, primary_key=True)
+    link_id = Column(BigInteger, ForeignKey("links.id", ondelete="CASCADE"), index=True, nullable=False)
+    clicked_at = Column(DateTime, nullable=False)
+    referrer = Column(String, nullable=False)
+    user_agent = Column(String, nullable=False)
+
+# Click counts per link and hour/day bucket, maintained by the ingestion task.
+class ClickRollup(Base):
+    __tablename__ = "click_rollups"
+    link_id = Column(BigInteger, ForeignKey("links.id", ondelete="CASCADE"), primary_key=True)
+    granularity = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    clicks = Column(Integer, default=0, nullable=False)
+
+# Daily click counts per referrer host and user agent family.
+class ClickBreakdown(Base):
+    __tablename__ = "click_breakdowns"
+    link_id = Column(BigInteger, ForeignKey("links.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(DateTime, primary_key=True)
+    dimension = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    clicks = Column(Integer, default=0, nullable=False)
+
+# Columns needed to build schemas.LinkOut without loading ORM instances.
+LINK_OUT_COLUMNS = (
+    Link.id, Link.original_url, Link.short_code, Link.created_at, Link.expires_at,
+    Link.redirect_count, Link.last_redirect_at, Link.owner_id, Link.category, Link.is_public,
+)
+
+# Hands out blocks of ids to the range short code allocator (PostgreSQL only).
+link_code_block_seq = Sequence("link_code_block_seq", metadata=Base.metadata)
@@ -0,0 +1,69 @@
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+from models import Link
+from sharding import merge_desc
+
+
+def encode_cursor(*values) -> str:
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str, size: int) -> list:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+# Checks and converts cursor values that are bound into the query, so a
+# tampered cursor is a 400 rather than a database error.
+def cursor_numbers(values, *types) -> list:
+    converted = []
+    for value, kind in zip(values, types):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and not isinstance(value, int)):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        converted.append(kind(value))
+    return converted
+
+
+# Orders newest first and resumes after the (created_at, id) pair stored in
+# the cursor. Fetches one extra row to know whether there is a next page.
+def paginate_by_created(stmt, cursor: str, limit: int):
+    if cursor:
+        created_at, link_id = decode_cursor(cursor, 2)
+        (link_id,) = cursor_numbers([link_id], int)
+        try:
+            created_at = datetime.fromisoformat(created_at)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        stmt = stmt.filter(or_(
+            Link.created_at < created_at,
+            and_(Link.created_at == created_at, Link.id < link_id),
+        ))
+    return stmt.order_by(Link.created_at.desc(), Link.id.desc()).limit(limit + 1)
+
+
+def page_with_cursor(rows, limit: int):
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+
+
+# Runs the keyset page query on every shard and merges the results; ids are
+# unique across shards, so the (created_at, id) cursor stays exact.
+async def newest_across_shards(shard_set, stmt, cursor: str, limit: int):
+    async def page(db):
+        return (await db.execute(paginate_by_created(stmt, cursor, limit))).mappings().all()
+
+    pages = await shard_set.fan_out(page, read=True)
+    rows = merge_desc(pages, key=lambda row: (row["created_at"], row["id"]), limit=limit + 1)
+    return page_with_cursor(rows, limit)
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+import qrcode
+import qrcode.image.svg
+from config import QR_RENDER_WORKERS, QR_CACHE_TTL, QR_LOCAL_CACHE_MAXSIZE
+from cache import LocalCache, register_local_cache, publish_invalidation
+
+logger = logging.getLogger(__name__)
+
+QR_MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+# Bump when the rendering changes so clients and caches drop old images.
+QR_RENDER_VERSION = 1
+
+
+# Local entries are keyed by (short_code, digest); invalidating a code drops
+# every size and format rendered for it.
+class QrLocalCache(LocalCache):
+    def pop(self, short_code):
+        self.generation += 1
+        for key in [key for key in self._data if key[0] == short_code]:
+            del self._data[key]
+
+
+qr_cache = QrLocalCache(QR_LOCAL_CACHE_MAXSIZE, QR_CACHE_TTL)
+register_local_cache("qr", qr_cache)
+_executor = None
+
+
+def render_qr(data: str, fmt: str, size: int, border: int) -> bytes:
+    qr = qrcode.QRCode(border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buf = io.BytesIO()
+    if fmt == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buf)
+        svg = buf.getvalue().decode("utf-8")
+        return re.sub(r'width="[^"]*" height="[^"]*"', f'width="{size}" height="{size}"', svg, count=1).encode("utf-8")
+    qr.box_size = max(1, size // (qr.modules_count + 2 * border))
+    qr.make_image().save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def qr_digest(short_url: str, fmt: str, size: int, border: int) -> str:
+    key = f"{QR_RENDER_VERSION}|{short_url}|{fmt}|{size}|{border}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def qr_etag(digest: str) -> str:
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(tag.strip() in (etag, "*") for tag in if_none_match.split(","))
+
+
+def _qr_key(short_code: str, digest: str) -> str:
+    return f"qr:{short_code}:{digest}"
+
+
+def _qr_index_key(short_code: str) -> str:
+    return f"qr_index:{short_code}"
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn: forking a process that already runs threads (password pool,
+        # aiosqlite) can deadlock the child.
+        _executor = ProcessPoolExecutor(max_workers=QR_RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+async def get_qr_image(redis_client, short_code: str, short_url: str, fmt: str, size: int, border: int) -> bytes:
+    digest = qr_digest(short_url, fmt, size, border)
+    local_key = (short_code, digest)
+    image = qr_cache.get(local_key)
+    if image is not None:
+        return image
+    generation = qr_cache.generation
+    try:
+        image = await redis_client.get(_qr_key(short_code, digest))
+    except Exception:
+        image = None
+    if image is None:
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(_get_executor(), render_qr, short_url, fmt, size, border)
+        logger.info("Rendered %s QR code for link: %s", fmt, short_code)
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.set(_qr_key(short_code, digest), image, ex=QR_CACHE_TTL)
+            pipe.sadd(_qr_index_key(short_code), digest)
+            pipe.expire(_qr_index_key(short_code), QR_CACHE_TTL)
+            await pipe.execute()
+        except Exception:
+            pass
+    qr_cache.set(local_key, image, generation=generation)
+    return image
+
+
+async def invalidate_qr(redis_client, short_code: str):
+    qr_cache.pop(short_code)
+    try:
+        digests = await redis_client.smembers(_qr_index_key(short_code))
+    except Exception:
+        digests = set()
+    keys = [_qr_key(short_code, d.decode("utf-8")) for d in digests] + [_qr_index_key(short_code)]
+    await publish_invalidation(redis_client, "qr", short_code, delete_keys=keys)
+
+
+def shutdown_qr_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
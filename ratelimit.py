@@ -0,0 +1,187 @@
+import json
+import logging
+import time
+import jwt
+from starlette.routing import Match
+from config import (
+    SECRET_KEY, ALGORITHM, RATE_LIMIT_ENABLED, RATE_LIMIT_SHORTEN_PUBLIC, RATE_LIMIT_SHORTEN_BATCH_PUBLIC,
+    RATE_LIMIT_SEARCH, RATE_LIMIT_REDIRECT, RATE_LIMIT_TRUST_FORWARDED, RATE_LIMIT_LOCAL_MAXSIZE,
+    RATE_LIMIT_REDIS_RETRY, LOAD_SHED_MAX_INFLIGHT, LOAD_SHED_RETRY_AFTER,
+)
+from cache import LocalCache
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_KEY_PREFIX = "ratelimit"
+
+# Refills the bucket for the time since its last request and takes one token.
+# ARGV: capacity, refill rate (tokens per second), now. Returns allowed (0/1),
+# tokens left and seconds until the next token; floats are returned as
+# strings since Redis truncates Lua numbers to integers.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens), tostring(wait)}
+"""
+
+
+def parse_rate(value: str):
+    requests, _, seconds = value.partition("/")
+    return int(requests), float(seconds or 1)
+
+
+# (method, route template) -> (bucket name, requests, seconds); routes with an
+# empty rate are not limited.
+ROUTE_LIMITS = {
+    route: (name, *parse_rate(rate))
+    for route, name, rate in (
+        (("POST", "/shorten/public"), "shorten_public", RATE_LIMIT_SHORTEN_PUBLIC),
+        (("POST", "/shorten/batch/public"), "shorten_batch_public", RATE_LIMIT_SHORTEN_BATCH_PUBLIC),
+        (("GET", "/search"), "search", RATE_LIMIT_SEARCH),
+        (("GET", "/{short_code}"), "redirect", RATE_LIMIT_REDIRECT),
+    )
+    if rate
+}
+
+
+# Used while Redis is unreachable. Buckets are per process, so the effective
+# quota is multiplied by the number of workers until Redis is back.
+class LocalTokenBuckets:
+    def __init__(self, maxsize: int = RATE_LIMIT_LOCAL_MAXSIZE):
+        self._buckets = LocalCache(maxsize, 86400)
+
+    def take(self, key: str, capacity: int, rate: float, now: float):
+        tokens, ts = self._buckets.get(key) or (capacity, now)
+        tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+        if tokens >= 1:
+            self._buckets.set(key, (tokens - 1, now), ttl=capacity / rate + 1)
+            return True, tokens - 1, 0.0
+        self._buckets.set(key, (tokens, now), ttl=capacity / rate + 1)
+        return False, tokens, (1 - tokens) / rate
+
+
+local_buckets = LocalTokenBuckets()
+_redis_retry_at = 0.0
+
+
+async def take_token(redis_client, key: str, capacity: int, rate: float):
+    global _redis_retry_at
+    now = time.time()
+    if redis_client is not None and now >= _redis_retry_at:
+        try:
+            allowed, tokens, wait = await redis_client.eval(TOKEN_BUCKET_SCRIPT, 1, key, capacity, rate, now)
+            return bool(int(allowed)), float(tokens), float(wait)
+        except Exception as e:
+            # Skip Redis for a while instead of paying for a timeout per request.
+            logger.warning("Rate limiter falling back to local buckets: %s", e)
+            _redis_retry_at = now + RATE_LIMIT_REDIS_RETRY
+    return local_buckets.take(key, capacity, rate, now)
+
+
+def _header(scope, name: bytes):
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+# Users are identified by the uid claim of a valid access token, checked
+# without a database lookup; everyone else by address.
+def client_identity(scope) -> str:
+    authorization = _header(scope, b"authorization")
+    if authorization and authorization[:7].lower() == "bearer ":
+        try:
+            payload = jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM])
+        except jwt.PyJWTError:
+            payload = {}
+        if payload.get("type") == "access" and payload.get("uid") is not None:
+            return f"user:{payload['uid']}"
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = _header(scope, b"x-forwarded-for")
+        if forwarded:
+            return f"ip:{forwarded.split(',')[0].strip()}"
+    client = scope.get("client")
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+def match_route(routes, scope):
+    for route in routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+async def _reject(send, status_code: int, detail: str, headers: dict):
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    raw_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    raw_headers.extend((name.lower().encode(), value.encode()) for name, value in headers.items())
+    await send({"type": "http.response.start", "status": status_code, "headers": raw_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+# Token buckets per client and route from ROUTE_LIMITS. Runs before routing
+# and dependencies, so a limited request never opens a database session.
+class RateLimitMiddleware:
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            return await self.app(scope, receive, send)
+        route = match_route(self.routes, scope)
+        limit = ROUTE_LIMITS.get((scope["method"], getattr(route, "path", None)))
+        if limit is None:
+            return await self.app(scope, receive, send)
+        name, requests, seconds = limit
+        from main import redis_client
+        key = f"{RATE_LIMIT_KEY_PREFIX}:{name}:{client_identity(scope)}"
+        allowed, tokens, wait = await take_token(redis_client, key, requests, requests / seconds)
+        if allowed:
+            return await self.app(scope, receive, send)
+        # Lets MetricsMiddleware label the rejection with the route.
+        scope["route"] = route
+        await _reject(send, 429, "Too many requests", {
+            "Retry-After": str(max(1, int(wait + 0.999))),
+            "X-RateLimit-Limit": f"{requests};w={int(seconds)}",
+            "X-RateLimit-Remaining": str(int(tokens)),
+        })
+
+
+# Rejects requests with 503 while LOAD_SHED_MAX_INFLIGHT are already being
+# handled by this process, so overload fails fast instead of queueing for a
+# pooled connection until DB_POOL_TIMEOUT.
+class LoadShedMiddleware:
+    exempt_paths = ("/metrics",)
+
+    def __init__(self, app, max_inflight: int = LOAD_SHED_MAX_INFLIGHT):
+        self.app = app
+        self.max_inflight = max_inflight
+        self.inflight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_inflight or scope["path"] in self.exempt_paths:
+            return await self.app(scope, receive, send)
+        if self.inflight >= self.max_inflight:
+            return await _reject(send, 503, "Server overloaded", {"Retry-After": str(LOAD_SHED_RETRY_AFTER)})
+        self.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.inflight -= 1
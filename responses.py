@@ -0,0 +1,34 @@
+from fastapi.responses import ORJSONResponse
+from models import LINK_OUT_COLUMNS
+
+LINK_OUT_FIELDS = tuple(column.key for column in LINK_OUT_COLUMNS)
+
+
+# Rows selected with LINK_OUT_COLUMNS already have the shape of
+# schemas.LinkOut, so list endpoints skip per-row pydantic validation and
+# hand plain dicts to orjson, which encodes datetimes itself.
+def link_dicts(rows):
+    return [{field: row[field] for field in LINK_OUT_FIELDS} for row in rows]
+
+
+def link_list_response(rows, next_cursor: str = None):
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return ORJSONResponse(link_dicts(rows), headers=headers)
+
+
+# Parses the q-values of an Accept-Encoding header, so "gzip;q=0" refuses
+# gzip; "*" covers gzip when gzip itself is not listed.
+def accepts_gzip(accept_encoding: str) -> bool:
+    qualities = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[coding.strip()] = q
+    return qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0))) > 0
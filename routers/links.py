@@ -1,117 +1,245 @@
 import logging
-from fastapi import APIRouter, Depends, HTTPException, Query, Request
-from fastapi.responses import RedirectResponse, StreamingResponse
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import RedirectResponse
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import insert
 from sqlalchemy.future import select
+import asyncio
 from typing import Optional, List
-import io
-import qrcode
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from schemas import LinkCreate, LinkOut
-from models import Link
+from schemas import LinkCreate, LinkOut, LinkBatchCreate, LinkBatchOut, ClickTimeseriesOut, MessageOut
+from models import Link, ClickRollup, ClickBreakdown, LINK_OUT_COLUMNS
+from pagination import newest_across_shards
+from responses import link_list_response
 from auth import get_current_user, get_optional_current_user
-from database import get_db
-from utils import get_unique_short_code
+from database import dialect_insert
+from sharding import ShardSessions, shards, get_shard_db, get_read_shard_db
+from utils import validate_alias
+from allocator import insert_links
+from cache import LINK_OK, LINK_NOT_FOUND, load_link_entry, invalidate_link, is_expired
+from expiry import schedule_expiry, unschedule_expiry
+from bloom import bloom_absent, bloom_add
+from search import search_shards
+from qr import QR_MEDIA_TYPES, qr_digest, qr_etag, etag_matches, get_qr_image, invalidate_qr
+from config import QR_DEFAULT_SIZE, PUBLIC_BASE_URL
+from counters import record_redirect, get_pending, merge_pending
+from analytics import record_click, click_timeseries
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+async def _insert_link(db: ShardSessions, link: LinkCreate, owner_id: Optional[int], is_public: bool) -> dict:
+    alias = validate_alias(link.custom_alias) if link.custom_alias else None
+    row = {
+        "original_url": str(link.original_url),
+        "expires_at": link.expires_at,
+        "owner_id": owner_id,
+        "category": link.category,
+        "is_public": is_public,
+    }
+    [result] = await insert_links(db, [row], [alias])
+    if result.error:
+        status_code = 400 if alias else 503
+        raise HTTPException(status_code=status_code, detail=result.error)
+    if not result.created:
+        return result.link
+    from main import redis_client
+    await bloom_add(redis_client, result.link["short_code"])
+    await invalidate_link(redis_client, result.link["short_code"])
+    if result.link["expires_at"]:
+        await schedule_expiry(redis_client, [(result.link["short_code"], result.link["expires_at"])])
+    return result.link
+
 @router.post("/shorten", response_model=LinkOut)
-async def create_link(link: LinkCreate, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
-    short_code = await get_unique_short_code(db, link.custom_alias)
+async def create_link(link: LinkCreate, db: ShardSessions = Depends(get_shard_db), current_user=Depends(get_current_user)):
     is_public = link.is_public if link.is_public is not None else False
-    new_link = Link(
-        original_url=str(link.original_url),
-        short_code=short_code,
-        expires_at=link.expires_at,
-        owner_id=current_user.id,
-        category=link.category,
-        is_public=is_public
-    )
-    db.add(new_link)
-    await db.commit()
-    await db.refresh(new_link)
-    logger.info("Link created by %s: %s", current_user.username, new_link.short_code)
+    new_link = await _insert_link(db, link, current_user.id, is_public)
+    logger.info("Link created by %s: %s", current_user.username, new_link["short_code"])
     return new_link
 
 @router.post("/shorten/public", response_model=LinkOut)
-async def create_link_public(link: LinkCreate, db: AsyncSession = Depends(get_db)):
-    short_code = await get_unique_short_code(db, link.custom_alias)
-    new_link = Link(
-        original_url=str(link.original_url),
-        short_code=short_code,
-        expires_at=link.expires_at,
-        owner_id=None,
-        category=link.category,
-        is_public=True
-    )
-    db.add(new_link)
-    await db.commit()
-    await db.refresh(new_link)
-    logger.info("Public link created: %s", new_link.short_code)
+async def create_link_public(link: LinkCreate, db: ShardSessions = Depends(get_shard_db)):
+    new_link = await _insert_link(db, link, None, True)
+    logger.info("Public link created: %s", new_link["short_code"])
     return new_link
 
-@router.get("/search", response_model=List[LinkOut])
-async def search_links(query: str, skip: int = Query(0, ge=0), limit: int = Query(10, gt=0),
-                       current_user=Depends(get_optional_current_user), db: AsyncSession = Depends(get_db)):
+async def _taken_codes(db: ShardSessions, codes) -> set:
+    async def taken_on(session, shard_codes):
+        result = await session.execute(select(Link.short_code).filter(Link.short_code.in_(shard_codes)))
+        return result.scalars().all()
+    found = await asyncio.gather(*(
+        db.run_committed(index, taken_on, group) for index, group in shards.group_codes(codes).items()
+    ))
+    return {code for codes in found for code in codes}
+
+async def _insert_batch(db: ShardSessions, items: List[LinkCreate], owner_id: Optional[int]) -> dict:
+    errors = {}
+    aliases = []
+    for i, item in enumerate(items):
+        alias = None
+        if item.custom_alias:
+            try:
+                alias = validate_alias(item.custom_alias)
+            except HTTPException as e:
+                errors[i] = e.detail
+        aliases.append(alias)
+    from main import redis_client
+    requested = {alias for i, alias in enumerate(aliases) if alias and i not in errors}
+    requested -= await bloom_absent(redis_client, *requested)
+    if requested:
+        taken = await _taken_codes(db, requested)
+        for i, alias in enumerate(aliases):
+            if alias in taken:
+                errors[i] = "Custom alias already exists"
+    indexes = [i for i in range(len(items)) if i not in errors]
+    rows = [{
+        "original_url": str(items[i].original_url),
+        "expires_at": items[i].expires_at,
+        "owner_id": owner_id,
+        "category": items[i].category,
+        "is_public": True if owner_id is None else bool(items[i].is_public),
+    } for i in indexes]
+    inserted = await insert_links(db, rows, [aliases[i] for i in indexes]) if rows else []
+    links = {}
+    new_links = []
+    reused = 0
+    for i, result in zip(indexes, inserted):
+        if result.error:
+            errors[i] = result.error
+        else:
+            links[i] = result.link
+            if result.created:
+                new_links.append(result.link)
+            else:
+                reused += 1
+    await bloom_add(redis_client, *(link["short_code"] for link in new_links))
+    await invalidate_link(redis_client, *(link["short_code"] for link in new_links))
+    await schedule_expiry(redis_client, [
+        (link["short_code"], link["expires_at"]) for link in new_links if link["expires_at"]
+    ])
+    return {
+        "created": len(new_links),
+        "reused": reused,
+        "failed": len(errors),
+        "results": [{"index": i, "link": links.get(i), "error": errors.get(i)} for i in range(len(items))],
+    }
+
+@router.post("/shorten/batch", response_model=LinkBatchOut)
+async def create_links_batch(batch: LinkBatchCreate, db: ShardSessions = Depends(get_shard_db), current_user=Depends(get_current_user)):
+    result = await _insert_batch(db, batch.items, current_user.id)
+    logger.info(
+        "Batch of %d links created by %s (%d reused, %d failed)",
+        result["created"], current_user.username, result["reused"], result["failed"],
+    )
+    return result
+
+@router.post("/shorten/batch/public", response_model=LinkBatchOut)
+async def create_links_batch_public(batch: LinkBatchCreate, db: ShardSessions = Depends(get_shard_db)):
+    result = await _insert_batch(db, batch.items, None)
+    logger.info("Public batch of %d links created (%d reused, %d failed)", result["created"], result["reused"], result["failed"])
+    return result
+
+def _visible_to(current_user):
     if current_user:
-        stmt = select(Link).filter(
-            ((Link.is_public == True) | (Link.owner_id == current_user.id)),
-            ((Link.original_url.ilike(f"%{query}%")) | (Link.short_code.ilike(f"%{query}%")))
-        ).offset(skip).limit(limit)
-    else:
-        stmt = select(Link).filter(
-            (Link.is_public == True),
-            ((Link.original_url.ilike(f"%{query}%")) | (Link.short_code.ilike(f"%{query}%")))
-        ).offset(skip).limit(limit)
-    result = await db.execute(stmt)
+        return (Link.is_public == True) | (Link.owner_id == current_user.id)
+    return Link.is_public == True
+
+@router.get("/search", response_model=List[LinkOut])
+async def search_links(query: str = Query(..., min_length=1), limit: int = Query(10, gt=0, le=100),
+                       cursor: Optional[str] = None, current_user=Depends(get_optional_current_user)):
+    rows, next_cursor = await search_shards(shards, query, _visible_to(current_user), limit, cursor)
     logger.info("Searched links with query: '%s'", query)
-    return result.scalars().all()
+    return link_list_response(rows, next_cursor)
 
 @router.get("/category/{category}", response_model=List[LinkOut])
-async def get_links_by_category(category: str, current_user=Depends(get_optional_current_user), db: AsyncSession = Depends(get_db)):
-    if current_user:
-        stmt = select(Link).filter(
-            ((Link.is_public == True) | (Link.owner_id == current_user.id)),
-            (Link.category == category)
-        )
-    else:
-        stmt = select(Link).filter(
-            (Link.is_public == True),
-            (Link.category == category)
-        )
-    result = await db.execute(stmt)
+async def get_links_by_category(category: str, limit: int = Query(100, gt=0, le=1000),
+                                cursor: Optional[str] = None, current_user=Depends(get_optional_current_user)):
+    stmt = select(*LINK_OUT_COLUMNS).filter(Link.category == category, _visible_to(current_user))
+    rows, next_cursor = await newest_across_shards(shards, stmt, cursor, limit)
     logger.info("Fetched links for category: %s", category)
-    return result.scalars().all()
+    return link_list_response(rows, next_cursor)
 
 @router.get("/{short_code}/stats", response_model=LinkOut)
-async def get_stats(short_code: str, db: AsyncSession = Depends(get_db)):
+async def get_stats(short_code: str, read_db: ShardSessions = Depends(get_read_shard_db)):
     stmt = select(Link).filter(Link.short_code == short_code)
-    result = await db.execute(stmt)
+    result = await read_db.for_code(short_code).execute(stmt)
     link = result.scalar_one_or_none()
     if not link:
         raise HTTPException(status_code=404, detail="Link not found")
+    from main import redis_client
+    delta, last = await get_pending(redis_client, link.id)
     logger.info("Fetched stats for link: %s", short_code)
-    return link
+    return merge_pending(LinkOut.from_orm(link), delta, last)
 
-@router.get("/{short_code}/qrcode")
-async def get_qrcode(short_code: str, request: Request, db: AsyncSession = Depends(get_db)):
-    stmt = select(Link).filter(Link.short_code == short_code)
-    result = await db.execute(stmt)
-    link = result.scalar_one_or_none()
-    if not link:
+TIMESERIES_DEFAULT_RANGE = {"hour": timedelta(hours=48), "day": timedelta(days=30)}
+
+@router.get("/{short_code}/stats/timeseries", response_model=ClickTimeseriesOut)
+async def get_stats_timeseries(short_code: str, granularity: str = Query("hour", regex="^(hour|day)$"),
+                               start: Optional[datetime] = None, end: Optional[datetime] = None,
+                               db: ShardSessions = Depends(get_shard_db),
+                               read_db: ShardSessions = Depends(get_read_shard_db)):
+    from main import redis_client
+    # Resolved through the link cache on the primary so replica lag is never cached as a 404.
+    entry = await load_link_entry(db.for_code(short_code), redis_client, short_code)
+    await db.close()
+    if entry.status == LINK_NOT_FOUND:
+        raise HTTPException(status_code=404, detail="Link not found")
+    end = end or datetime.utcnow()
+    start = start or end - TIMESERIES_DEFAULT_RANGE[granularity]
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    points, referrers, user_agents = await click_timeseries(
+        read_db.for_code(short_code), entry.link_id, granularity, start, end
+    )
+    logger.info("Fetched click timeseries for link: %s", short_code)
+    return {
+        "short_code": short_code, "granularity": granularity, "start": start, "end": end,
+        "points": points, "referrers": referrers, "user_agents": user_agents,
+    }
+
+@router.get("/{short_code}/qrcode", response_class=Response, responses={
+    200: {"content": {media_type: {} for media_type in QR_MEDIA_TYPES.values()}},
+    304: {"description": "Not modified"},
+})
+async def get_qrcode(short_code: str, request: Request, format: str = Query("png", regex="^(png|svg)$"),
+                     size: int = Query(QR_DEFAULT_SIZE, ge=64, le=2048), border: int = Query(4, ge=0, le=16),
+                     db: ShardSessions = Depends(get_shard_db)):
+    from main import redis_client
+    entry = await load_link_entry(db.for_code(short_code), redis_client, short_code)
+    if entry.status != LINK_OK:
         raise HTTPException(status_code=404, detail="Link not found")
-    short_url = request.url_for("redirect_link", short_code=link.short_code)
-    img = qrcode.make(short_url)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    logger.info("Generated QR code for link: %s", short_code)
-    return StreamingResponse(buf, media_type="image/png")
+    short_url = f"{PUBLIC_BASE_URL}/{short_code}"
+    etag = qr_etag(qr_digest(short_url, format, size, border))
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    image = await get_qr_image(redis_client, short_code, short_url, format, size, border)
+    return Response(content=image, media_type=QR_MEDIA_TYPES[format], headers=headers)
+
+# The new alias routes to another shard: the link and its click rollups are
+# copied there under a new id and removed from the old shard. Raw click
+# events and redirects not yet flushed to the old id stay behind.
+async def _move_link(source: AsyncSession, target: AsyncSession, link: Link, new_code: str) -> Link:
+    values = {column.key: getattr(link, column.key) for column in Link.__table__.c if column.key != "id"}
+    values["short_code"] = new_code
+    stmt = dialect_insert(target, Link.__table__).values(values).on_conflict_do_nothing().returning(Link.id)
+    new_id = (await target.execute(stmt)).scalar()
+    if new_id is None:
+        raise HTTPException(status_code=400, detail="Custom alias already exists")
+    for table in (ClickRollup.__table__, ClickBreakdown.__table__):
+        rows = (await source.execute(select(table).filter(table.c.link_id == link.id))).mappings().all()
+        if rows:
+            await target.execute(insert(table), [{**row, "link_id": new_id} for row in rows])
+    await target.commit()
+    await source.delete(link)
+    await source.commit()
+    return await target.get(Link, new_id)
 
 @router.put("/{short_code}", response_model=LinkOut)
-async def update_link(short_code: str, link_data: LinkCreate, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
+async def update_link(short_code: str, link_data: LinkCreate, shard_db: ShardSessions = Depends(get_shard_db),
+                      current_user=Depends(get_current_user)):
+    db = shard_db.for_code(short_code)
     stmt = select(Link).filter(Link.short_code == short_code)
     result = await db.execute(stmt)
     link = result.scalar_one_or_none()
@@ -122,26 +250,40 @@ async def update_link(short_code: str, link_data: LinkCreate, db: AsyncSession =
     link.original_url = str(link_data.original_url)
     link.expires_at = link_data.expires_at
     link.category = link_data.category
-    if link_data.custom_alias and link_data.custom_alias != link.short_code:
-        if not link_data.custom_alias.isalnum():
-            raise HTTPException(status_code=400, detail="Custom alias must be alphanumeric")
-        stmt = select(Link).filter(Link.short_code == link_data.custom_alias)
-        result = await db.execute(stmt)
-        if result.scalar_one_or_none():
-            raise HTTPException(status_code=400, detail="Custom alias already exists")
-        link.short_code = link_data.custom_alias
-    await db.commit()
-    await db.refresh(link)
-    try:
-        from main import redis_client
-        await redis_client.delete(f"short_code:{short_code}")
-    except Exception:
-        pass
+    # An edited link is no longer returned for equivalent create requests.
+    link.url_digest = None
+    from main import redis_client
+    new_code = link_data.custom_alias
+    target = db
+    if new_code and new_code != link.short_code:
+        validate_alias(new_code)
+        if not await bloom_absent(redis_client, new_code):
+            stmt = select(Link).filter(Link.short_code == new_code)
+            result = await shard_db.for_code(new_code).execute(stmt)
+            if result.scalar_one_or_none():
+                raise HTTPException(status_code=400, detail="Custom alias already exists")
+        target = shard_db.for_code(new_code)
+        if target is db:
+            link.short_code = new_code
+        else:
+            link = await _move_link(db, target, link, new_code)
+    if target is db:
+        await db.commit()
+        await db.refresh(link)
+    await invalidate_link(redis_client, short_code, link.short_code)
+    if link.short_code != short_code:
+        await bloom_add(redis_client, link.short_code)
+        await invalidate_qr(redis_client, short_code)
+        await unschedule_expiry(redis_client, short_code)
+    await schedule_expiry(redis_client, [(link.short_code, link.expires_at)])
+    delta, last = await get_pending(redis_client, link.id)
     logger.info("Link updated by %s: %s", current_user.username, link.short_code)
-    return link
+    return merge_pending(LinkOut.from_orm(link), delta, last)
 
-@router.delete("/{short_code}")
-async def delete_link(short_code: str, db: AsyncSession = Depends(get_db), current_user=Depends(get_current_user)):
+@router.delete("/{short_code}", response_model=MessageOut)
+async def delete_link(short_code: str, shard_db: ShardSessions = Depends(get_shard_db),
+                      current_user=Depends(get_current_user)):
+    db = shard_db.for_code(short_code)
     stmt = select(Link).filter(Link.short_code == short_code)
     result = await db.execute(stmt)
     link = result.scalar_one_or_none()
@@ -151,61 +293,24 @@ async def delete_link(short_code: str, db: AsyncSession = Depends(get_db), curre
         raise HTTPException(status_code=403, detail="Not authorized to delete this link")
     await db.delete(link)
     await db.commit()
-    try:
-        from main import redis_client
-        await redis_client.delete(f"short_code:{short_code}")
-    except Exception:
-        pass
+    from main import redis_client
+    await invalidate_link(redis_client, short_code)
+    await invalidate_qr(redis_client, short_code)
+    await unschedule_expiry(redis_client, short_code)
     logger.info("Link deleted by %s: %s", current_user.username, short_code)
     return {"message": "Link deleted"}
 
-@router.get("/{short_code}", name="redirect_link")
-async def redirect_link(short_code: str, db: AsyncSession = Depends(get_db)):
-    from main import redis_client  
-    cache_key = f"short_code:{short_code}"
-    try:
-        cached_data = await redis_client.get(cache_key)
-    except Exception:
-        cached_data = None
-    if cached_data:
-        try:
-            link_id_str, original_url = cached_data.decode("utf-8").split("|", 1)
-            link_id = int(link_id_str)
-        except Exception:
-            stmt = select(Link).filter(Link.short_code == short_code)
-            result = await db.execute(stmt)
-            link = result.scalar_one_or_none()
-            if not link:
-                raise HTTPException(status_code=404, detail="Link not found")
-            original_url = link.original_url
-            link_id = link.id
-    else:
-        stmt = select(Link).filter(Link.short_code == short_code)
-        result = await db.execute(stmt)
-        link = result.scalar_one_or_none()
-        if not link:
-            raise HTTPException(status_code=404, detail="Link not found")
-        if link.expires_at and datetime.utcnow() > link.expires_at:
-            await db.delete(link)
-            await db.commit()
-            raise HTTPException(status_code=410, detail="Link expired")
-        original_url = link.original_url
-        link_id = link.id
-        try:
-            await redis_client.setex(cache_key, 60, f"{link_id}|{original_url}")
-        except Exception:
-            pass
-    stmt = select(Link).filter(Link.id == link_id)
-    result = await db.execute(stmt)
-    link = result.scalar_one_or_none()
-    if not link:
+@router.get("/{short_code}", name="redirect_link", response_class=RedirectResponse, status_code=307)
+async def redirect_link(short_code: str, request: Request, background_tasks: BackgroundTasks,
+                        db: ShardSessions = Depends(get_shard_db)):
+    from main import redis_client
+    entry = await load_link_entry(db.for_code(short_code), redis_client, short_code)
+    if entry.status == LINK_NOT_FOUND:
         raise HTTPException(status_code=404, detail="Link not found")
-    if link.expires_at and datetime.utcnow() > link.expires_at:
-        await db.delete(link)
-        await db.commit()
+    if is_expired(entry):
         raise HTTPException(status_code=410, detail="Link expired")
-    link.redirect_count += 1
-    link.last_redirect_at = datetime.utcnow()
-    await db.commit()
-    logger.info("Redirected link %s, new count: %d", short_code, link.redirect_count)
-    return RedirectResponse(url=original_url)
+    await record_redirect(redis_client, entry.link_id)
+    background_tasks.add_task(record_click, redis_client, entry.link_id,
+                              request.headers.get("referer"), request.headers.get("user-agent"))
+    logger.info("Redirected link %s", short_code)
+    return RedirectResponse(url=entry.original_url)
@@ -1,15 +1,28 @@
+import csv
+import io
 import logging
-from fastapi import APIRouter, Depends, HTTPException, status
+import zlib
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import update
 from sqlalchemy.future import select
 from datetime import timedelta
+from typing import List, Optional
 
-from models import User
-from schemas import UserCreate, UserOut, Token, RefreshTokenRequest
-from auth import get_password_hash, verify_password, create_access_token, create_refresh_token, get_current_user, decode_access_token
+from models import User, Link, LINK_OUT_COLUMNS
+from schemas import UserCreate, UserOut, Token, RefreshTokenRequest, LinkOut, MessageOut
+from responses import LINK_OUT_FIELDS, accepts_gzip, link_dicts, link_list_response
+from auth import (
+    get_password_hash, verify_and_update_password, create_access_token, create_refresh_token, get_current_user,
+    decode_access_token, resolve_user, invalidate_user, token_claims
+)
 from database import get_db
-from config import ACCESS_TOKEN_EXPIRE_MINUTES
+from sharding import shards
+from config import ACCESS_TOKEN_EXPIRE_MINUTES, EXPORT_BATCH_SIZE
+from pagination import newest_across_shards
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
@@ -20,7 +33,7 @@ async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     result = await db.execute(stmt)
     if result.scalar_one_or_none():
         raise HTTPException(status_code=400, detail="Username already registered")
-    new_user = User(username=user.username, hashed_password=get_password_hash(user.password))
+    new_user = User(username=user.username, hashed_password=await get_password_hash(user.password))
     db.add(new_user)
     await db.commit()
     await db.refresh(new_user)
@@ -32,11 +45,18 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     stmt = select(User).filter(User.username == form_data.username)
     result = await db.execute(stmt)
     user = result.scalar_one_or_none()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
+    valid, new_hash = await verify_and_update_password(form_data.password, user.hashed_password)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Incorrect username or password")
+    if new_hash:
+        user.hashed_password = new_hash
+        await db.commit()
+        logger.info("Password rehashed for user: %s", user.username)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token({"sub": user.username}, expires_delta=access_token_expires)
-    refresh_token = create_refresh_token({"sub": user.username})
+    access_token = create_access_token(token_claims(user), expires_delta=access_token_expires)
+    refresh_token = create_refresh_token(token_claims(user))
     logger.info("User logged in: %s", user.username)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
@@ -45,20 +65,91 @@ async def refresh_access_token(refresh_req: RefreshTokenRequest, db: AsyncSessio
     payload = decode_access_token(refresh_req.refresh_token)
     if payload is None or payload.get("type") != "refresh" or payload.get("sub") is None:
         raise HTTPException(status_code=401, detail="Invalid refresh token")
-    stmt = select(User).filter(User.username == payload.get("sub"))
-    result = await db.execute(stmt)
-    if result.scalar_one_or_none() is None:
+    user = await resolve_user(db, payload)
+    if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token({"sub": payload.get("sub")}, expires_delta=access_token_expires)
-    refresh_token = create_refresh_token({"sub": payload.get("sub")})
-    logger.info("Token refreshed for user: %s", payload.get("sub"))
+    access_token = create_access_token(token_claims(user), expires_delta=access_token_expires)
+    refresh_token = create_refresh_token(token_claims(user))
+    logger.info("Token refreshed for user: %s", user.username)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
-@router.get("/links", response_model=list)
-async def get_user_links(current_user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
-    from models import Link
-    stmt = select(Link).filter(Link.owner_id == current_user.id)
-    result = await db.execute(stmt)
+@router.post("/token/revoke", response_model=MessageOut)
+async def revoke_tokens(current_user=Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    stmt = (
+        update(User)
+        .where(User.id == current_user.id)
+        .values(token_version=User.token_version + 1)
+        .returning(User.token_version)
+    )
+    version = (await db.execute(stmt)).scalar_one()
+    await db.commit()
+    from main import redis_client
+    await invalidate_user(redis_client, current_user._replace(token_version=version))
+    logger.info("Tokens revoked for user: %s", current_user.username)
+    return {"message": "Tokens revoked"}
+
+@router.get("/links", response_model=List[LinkOut])
+async def get_user_links(limit: int = Query(100, gt=0, le=1000), cursor: Optional[str] = None,
+                         current_user=Depends(get_current_user)):
+    stmt = select(*LINK_OUT_COLUMNS).filter(Link.owner_id == current_user.id)
+    rows, next_cursor = await newest_across_shards(shards, stmt, cursor, limit)
     logger.info("Fetched links for user: %s", current_user.username)
-    return result.scalars().all()
+    return link_list_response(rows, next_cursor)
+
+def _export_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+def _encode_ndjson(rows):
+    return b"".join(orjson.dumps(row) + b"\n" for row in link_dicts(rows))
+
+def _encode_csv(rows, header: bool):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(LINK_OUT_FIELDS)
+    for row in rows:
+        writer.writerow(_export_value(row[field]) for field in LINK_OUT_FIELDS)
+    return buf.getvalue()
+
+# The request-scoped session is closed before a streaming body is sent, so the
+# generator owns its own sessions and reads through server-side cursors. Shards
+# are read one after another; their id ranges ascend with the shard index, so
+# the output stays ordered by id.
+async def _export_links(owner_id: int, fmt: str, compress: bool):
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    stmt = (
+        select(*LINK_OUT_COLUMNS)
+        .filter(Link.owner_id == owner_id)
+        .order_by(Link.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    first = True
+    for session_maker in shards.read_session_makers:
+        async with session_maker() as db:
+            result = await db.stream(stmt)
+            async for rows in result.mappings().partitions(EXPORT_BATCH_SIZE):
+                chunk = _encode_ndjson(rows) if fmt == "ndjson" else _encode_csv(rows, first).encode("utf-8")
+                first = False
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+    if fmt == "csv" and first:
+        chunk = _encode_csv([], True).encode("utf-8")
+        yield compressor.compress(chunk) if compressor else chunk
+    if compressor:
+        yield compressor.flush()
+
+@router.get("/links/export", response_class=StreamingResponse, responses={
+    200: {"content": {"application/x-ndjson": {}, "text/csv": {}}},
+})
+async def export_user_links(request: Request, format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+                            current_user=Depends(get_current_user)):
+    compress = accepts_gzip(request.headers.get("accept-encoding", ""))
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    headers = {"Content-Disposition": f'attachment; filename="links.{format}"', "Vary": "Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    logger.info("Exporting links for user %s as %s", current_user.username, format)
+    return StreamingResponse(_export_links(current_user.id, format, compress), media_type=media_type, headers=headers)
@@ -1,6 +1,7 @@
 from datetime import datetime
-from typing import Optional
-from pydantic import BaseModel, HttpUrl, validator
+from typing import Optional, List
+from pydantic import BaseModel, HttpUrl, validator, conlist
+from config import BATCH_MAX_ITEMS
 
 class UserCreate(BaseModel):
     username: str
@@ -21,6 +22,9 @@ class Token(BaseModel):
 class RefreshTokenRequest(BaseModel):
     refresh_token: str
 
+class MessageOut(BaseModel):
+    message: str
+
 class LinkCreate(BaseModel):
     original_url: HttpUrl
     custom_alias: Optional[str] = None
@@ -62,3 +66,34 @@ class LinkOut(BaseModel):
 
     class Config:
         orm_mode = True
+
+class LinkBatchCreate(BaseModel):
+    items: conlist(LinkCreate, min_items=1, max_items=BATCH_MAX_ITEMS)
+
+class LinkBatchItemOut(BaseModel):
+    index: int
+    link: Optional[LinkOut] = None
+    error: Optional[str] = None
+
+class LinkBatchOut(BaseModel):
+    created: int
+    reused: int
+    failed: int
+    results: List[LinkBatchItemOut]
+
+class ClickPoint(BaseModel):
+    bucket: datetime
+    clicks: int
+
+class ClickBreakdownItem(BaseModel):
+    value: str
+    clicks: int
+
+class ClickTimeseriesOut(BaseModel):
+    short_code: str
+    granularity: str
+    start: datetime
+    end: datetime
+    points: List[ClickPoint]
+    referrers: List[ClickBreakdownItem]
+    user_agents: List[ClickBreakdownItem]
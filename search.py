@@ -0,0 +1,182 @@
+import logging
+from sqlalchemy import and_, or_, func, literal, literal_column, table, column, text
+from sqlalchemy.future import select
+from models import Link, LINK_OUT_COLUMNS
+from pagination import encode_cursor, decode_cursor, cursor_numbers
+from sharding import merge_desc
+
+logger = logging.getLogger(__name__)
+
+# Trigram indexes cannot help with queries shorter than one trigram.
+MIN_INDEXED_QUERY_LENGTH = 3
+
+
+def _like_pattern(query: str) -> str:
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _substring_match(query: str):
+    pattern = _like_pattern(query)
+    return or_(
+        Link.original_url.ilike(pattern, escape="\\"),
+        Link.category.ilike(pattern, escape="\\"),
+        Link.short_code.ilike(pattern, escape="\\"),
+    )
+
+
+# Results are ordered by (score, id desc) and paged with an opaque cursor
+# holding the last (score, id) pair instead of an offset. Scores rank
+# descending unless the backend's score is a distance.
+class SearchBackend:
+    name = "like"
+    score_ascending = False
+
+    async def setup(self, conn):
+        pass
+
+    def score(self, query: str):
+        return literal(0.0)
+
+    def statement(self, query: str):
+        return select(*LINK_OUT_COLUMNS, self.score(query).label("score")).filter(_substring_match(query))
+
+    def sort_key(self, row):
+        return (-row["score"] if self.score_ascending else row["score"], row["id"])
+
+    async def search(self, db, query: str, visibility, limit: int, cursor: str = None):
+        stmt = self.statement(query)
+        score = stmt.selected_columns.score
+        if cursor:
+            last_score, last_id = cursor_numbers(decode_cursor(cursor, 2), float, int)
+            after = score > last_score if self.score_ascending else score < last_score
+            stmt = stmt.filter(or_(after, and_(score == last_score, Link.id < last_id)))
+        order = score.asc() if self.score_ascending else score.desc()
+        stmt = stmt.filter(visibility).order_by(order, Link.id.desc()).limit(limit + 1)
+        rows = (await db.execute(stmt)).mappings().all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["score"], rows[-1]["id"])
+        return rows, next_cursor
+
+
+# Must match the expression of ix_links_search_trgm in
+# migrations/0001_search_index.sql, or the index is not used.
+SEARCH_DOCUMENT = literal_column("(original_url || ' ' || coalesce(category, '') || ' ' || short_code)")
+
+
+# Ranks by word-similarity distance to one document made of the searchable
+# columns. The GiST index returns rows in distance order (a KNN scan), so a
+# page reads about `limit` index entries however many rows match; later
+# pages re-walk the rows before the cursor.
+class PostgresTrigramSearch(SearchBackend):
+    name = "pg_trgm"
+    score_ascending = True
+
+    async def setup(self, conn):
+        # The index is built by a migration; creating it here would lock links.
+        if not (await conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"))).first():
+            raise RuntimeError("pg_trgm is not installed, apply migrations/0001_search_index.sql")
+        if not (await conn.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_links_search_trgm'"))).first():
+            logger.warning("ix_links_search_trgm is missing, /search scans links; apply migrations/0001_search_index.sql")
+
+    def score(self, query: str):
+        return literal(query).op("<<->")(SEARCH_DOCUMENT)
+
+    def statement(self, query: str):
+        return (
+            select(*LINK_OUT_COLUMNS, self.score(query).label("score"))
+            .filter(SEARCH_DOCUMENT.ilike(_like_pattern(query), escape="\\"))
+        )
+
+
+links_fts = table("links_fts", column("rowid"), column("links_fts"))
+
+
+class SqliteFtsSearch(SearchBackend):
+    name = "fts5"
+
+    async def setup(self, conn):
+        exists = (await conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'links_fts'"
+        ))).first()
+        if exists:
+            return
+        await conn.execute(text(
+            "CREATE VIRTUAL TABLE links_fts USING fts5("
+            "original_url, category, short_code, content='links', content_rowid='id', tokenize='trigram')"
+        ))
+        await conn.execute(text(
+            "CREATE TRIGGER links_fts_ai AFTER INSERT ON links BEGIN "
+            "INSERT INTO links_fts(rowid, original_url, category, short_code) "
+            "VALUES (new.id, new.original_url, new.category, new.short_code); END"
+        ))
+        await conn.execute(text(
+            "CREATE TRIGGER links_fts_ad AFTER DELETE ON links BEGIN "
+            "INSERT INTO links_fts(links_fts, rowid, original_url, category, short_code) "
+            "VALUES ('delete', old.id, old.original_url, old.category, old.short_code); END"
+        ))
+        await conn.execute(text(
+            "CREATE TRIGGER links_fts_au AFTER UPDATE OF original_url, category, short_code ON links BEGIN "
+            "INSERT INTO links_fts(links_fts, rowid, original_url, category, short_code) "
+            "VALUES ('delete', old.id, old.original_url, old.category, old.short_code); "
+            "INSERT INTO links_fts(rowid, original_url, category, short_code) "
+            "VALUES (new.id, new.original_url, new.category, new.short_code); END"
+        ))
+        await conn.execute(text("INSERT INTO links_fts(links_fts) VALUES ('rebuild')"))
+
+    def statement(self, query: str):
+        if len(query) < MIN_INDEXED_QUERY_LENGTH:
+            return super().statement(query)
+        phrase = '"' + query.replace('"', '""') + '"'
+        score = -func.bm25(literal_column("links_fts"))
+        return (
+            select(*LINK_OUT_COLUMNS, score.label("score"))
+            .join(links_fts, links_fts.c.rowid == Link.id)
+            .filter(links_fts.c.links_fts.op("MATCH")(phrase))
+        )
+
+
+_backend = SearchBackend()
+
+
+async def setup_search_backend(engines):
+    global _backend
+    dialect = engines[0].dialect.name
+    if dialect == "postgresql":
+        backend = PostgresTrigramSearch()
+    elif dialect == "sqlite":
+        backend = SqliteFtsSearch()
+    else:
+        backend = SearchBackend()
+    try:
+        for engine in engines:
+            async with engine.begin() as conn:
+                await backend.setup(conn)
+    except Exception as e:
+        logger.error("Search backend %s unavailable, falling back to LIKE scans: %s", backend.name, e)
+        backend = SearchBackend()
+    _backend = backend
+    logger.info("Using %s search backend", backend.name)
+
+
+def get_search_backend() -> SearchBackend:
+    return _backend
+
+
+# Searches every shard for one page and merges the pages by (score, id).
+# Scores are computed per shard; pg_trgm distances are comparable across
+# shards, SQLite bm25 only roughly, as it depends on each shard's contents.
+async def search_shards(shard_set, query: str, visibility, limit: int, cursor: str = None):
+    async def search(db):
+        return await _backend.search(db, query, visibility, limit, cursor)
+
+    pages = await shard_set.fan_out(search, read=True)
+    if len(pages) == 1:
+        return pages[0]
+    rows = merge_desc([rows for rows, _ in pages], key=_backend.sort_key, limit=limit + 1)
+    if len(rows) <= limit and not any(next_cursor for _, next_cursor in pages):
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1]["score"], rows[-1]["id"])
@@ -0,0 +1,193 @@
+import asyncio
+import bisect
+import hashlib
+import heapq
+import logging
+from collections import defaultdict
+from itertools import islice
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from config import DATABASE_URL_ASYNC, SHARD_DATABASE_URLS, SHARD_VNODES
+from database import Base, async_engine, read_engine, make_engine
+from models import Link, ClickEvent, ClickRollup, ClickBreakdown
+
+logger = logging.getLogger(__name__)
+
+# Link ids are <shard index> << SHARD_ID_BITS | <id within the shard>, so
+# anything keyed by link id (redirect counters, click events) finds its shard
+# without a lookup. Unsharded ids are all below 2 ** 40, i.e. shard 0.
+SHARD_ID_BITS = 40
+# Tables that live next to the links; users stay on the primary database.
+SHARDED_TABLES = [Link.__table__, ClickEvent.__table__, ClickRollup.__table__, ClickBreakdown.__table__]
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+# Each shard owns `vnodes` points on the ring and a key belongs to the next
+# point clockwise. Points depend only on the shard index, so appending a
+# shard moves just the keys its points take over; their rows are not moved.
+class HashRing:
+    def __init__(self, nodes: int, vnodes: int = SHARD_VNODES):
+        points = sorted((_point(f"shard-{node}-{vnode}"), node) for node in range(nodes) for vnode in range(vnodes))
+        self.size = nodes
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str) -> int:
+        if self.size == 1:
+            return 0
+        return self._nodes[bisect.bisect(self._points, _point(key)) % len(self._points)]
+
+
+class ShardSet:
+    def __init__(self, engines, read_engines=None):
+        self.engines = list(engines)
+        self.read_engines = list(read_engines or engines)
+        self.session_makers = [self._maker(engine) for engine in self.engines]
+        self.read_session_makers = [
+            maker if read is engine else self._maker(read)
+            for engine, read, maker in zip(self.engines, self.read_engines, self.session_makers)
+        ]
+        self.ring = HashRing(len(self.engines))
+
+    @staticmethod
+    def _maker(engine):
+        return sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    def __len__(self):
+        return len(self.engines)
+
+    def index_for_code(self, short_code: str) -> int:
+        return self.ring.node_for(short_code)
+
+    def index_for_id(self, link_id: int) -> int:
+        index = link_id >> SHARD_ID_BITS
+        if index >= len(self.engines):
+            raise ValueError(f"Link id {link_id} belongs to unknown shard {index}")
+        return index
+
+    def session_maker_for_code(self, short_code: str, read: bool = False):
+        makers = self.read_session_makers if read else self.session_makers
+        return makers[self.index_for_code(short_code)]
+
+    def group_codes(self, short_codes) -> dict:
+        groups = defaultdict(list)
+        for code in short_codes:
+            groups[self.index_for_code(code)].append(code)
+        return groups
+
+    def group_ids(self, link_ids) -> dict:
+        groups = defaultdict(list)
+        for link_id in link_ids:
+            groups[self.index_for_id(link_id)].append(link_id)
+        return groups
+
+    # Runs func(session) on every shard concurrently, each with its own
+    # session, and returns the results in shard order.
+    async def fan_out(self, func, read: bool = False):
+        makers = self.read_session_makers if read else self.session_makers
+
+        async def run(maker):
+            async with maker() as db:
+                return await func(db)
+
+        return await asyncio.gather(*(run(maker) for maker in makers))
+
+    async def dispose(self):
+        for engine in {*self.engines, *self.read_engines}:
+            await engine.dispose()
+
+
+# Sessions of one request, opened on first use of a shard. Commits are per
+# shard; a request writing to several shards is not atomic across them.
+class ShardSessions:
+    def __init__(self, shard_set: ShardSet, read: bool = False):
+        self.shard_set = shard_set
+        self._makers = shard_set.read_session_makers if read else shard_set.session_makers
+        self._sessions = {}
+
+    def for_index(self, index: int) -> AsyncSession:
+        session = self._sessions.get(index)
+        if session is None:
+            session = self._sessions[index] = self._makers[index]()
+        return session
+
+    def for_code(self, short_code: str) -> AsyncSession:
+        return self.for_index(self.shard_set.index_for_code(short_code))
+
+    # Runs func(session, *args) on one shard and commits at once, so a request
+    # never holds one shard's locks while it waits on another's; concurrent
+    # requests would otherwise take them in different orders.
+    async def run_committed(self, index: int, func, *args):
+        session = self.for_index(index)
+        result = await func(session, *args)
+        await session.commit()
+        return result
+
+    async def commit(self):
+        for session in self._sessions.values():
+            await session.commit()
+
+    async def close(self):
+        await asyncio.gather(*(session.close() for session in self._sessions.values()))
+        self._sessions.clear()
+
+
+def create_shard_set() -> ShardSet:
+    return ShardSet([make_engine(url) for url in SHARD_DATABASE_URLS or [DATABASE_URL_ASYNC]])
+
+
+# Without SHARD_DATABASE_URLS the primary (and its read replica) is the only shard.
+shards = create_shard_set() if SHARD_DATABASE_URLS else ShardSet([async_engine], [read_engine])
+
+
+async def get_shard_db():
+    sessions = ShardSessions(shards)
+    try:
+        yield sessions
+    finally:
+        await sessions.close()
+
+
+async def get_read_shard_db():
+    sessions = ShardSessions(shards, read=True)
+    try:
+        yield sessions
+    finally:
+        await sessions.close()
+
+
+# First `limit` rows of per-shard results that are each sorted by key descending.
+def merge_desc(results, key, limit: int):
+    return list(islice(heapq.merge(*results, key=key, reverse=True), limit))
+
+
+async def _set_id_base(conn, base: int):
+    if conn.dialect.name == "postgresql":
+        seq = (await conn.execute(text("SELECT pg_get_serial_sequence('links', 'id')"))).scalar()
+        await conn.execute(text(
+            "SELECT setval(CAST(:seq AS regclass), :base, false) "
+            "WHERE COALESCE(pg_sequence_last_value(CAST(:seq AS regclass)), 0) < :base"
+        ), {"seq": seq, "base": base})
+    elif conn.dialect.name == "sqlite":
+        # Needs the AUTOINCREMENT table created from models.Link.
+        await conn.execute(text("UPDATE sqlite_sequence SET seq = :base WHERE name = 'links' AND seq < :base"), {"base": base})
+        await conn.execute(text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'links', :base "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'links')"
+        ), {"base": base})
+    else:
+        raise RuntimeError(f"Cannot set the link id base on {conn.dialect.name}")
+
+
+async def init_shards(shard_set: ShardSet):
+    for index, engine in enumerate(shard_set.engines):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=SHARDED_TABLES)
+            if index:
+                await _set_id_base(conn, index << SHARD_ID_BITS)
+    if len(shard_set) > 1:
+        logger.info("Links sharded across %d databases", len(shard_set))
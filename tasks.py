@@ -1,56 +1,194 @@
 import logging
 import asyncio
+import time
 from datetime import datetime, timedelta
 from celery import Celery
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from celery.signals import worker_process_init, worker_init, task_prerun, task_postrun
+import redis.asyncio as aioredis
+from sqlalchemy import delete
 from sqlalchemy.future import select
-from config import DATABASE_URL_ASYNC, INACTIVE_DAYS_THRESHOLD, REDIS_URL
+from config import (
+    INACTIVE_DAYS_THRESHOLD, REDIS_URL, CLEANUP_CHUNK_SIZE,
+    EXPIRY_POLL_INTERVAL, EXPIRY_BATCH_SIZE, EXPIRY_SWEEP_INTERVAL, INACTIVE_CLEANUP_INTERVAL, CLICK_INGEST_INTERVAL,
+    BLOOM_REBUILD_INTERVAL, WARMUP_INTERVAL
+)
 from models import Link
+from sharding import create_shard_set
+from cache import invalidate_link
+from expiry import pop_due, unschedule_expiry
+from analytics import ingest_clicks
+from bloom import rebuild_bloom
+from warmup import warm_cache
+import metrics
 
 logger = logging.getLogger(__name__)
 celery_app = Celery(__name__, broker=REDIS_URL)
+celery_app.conf.beat_schedule = {
+    "process-expirations": {"task": "tasks.process_expirations_task", "schedule": EXPIRY_POLL_INTERVAL},
+    "cleanup-expired-links": {"task": "tasks.cleanup_expired_links_task", "schedule": EXPIRY_SWEEP_INTERVAL},
+    "cleanup-inactive-links": {"task": "tasks.cleanup_inactive_links_task", "schedule": INACTIVE_CLEANUP_INTERVAL},
+    "ingest-clicks": {"task": "tasks.ingest_clicks_task", "schedule": CLICK_INGEST_INTERVAL},
+    "rebuild-bloom-filter": {"task": "tasks.rebuild_bloom_task", "schedule": BLOOM_REBUILD_INTERVAL},
+    "warm-link-cache": {"task": "tasks.warm_cache_task", "schedule": WARMUP_INTERVAL},
+}
+
+# Each worker process keeps one event loop, one pooled engine per shard and
+# one Redis client for its whole life; asyncpg connections are bound to the
+# loop that created them, so the loop is reused instead of created per task.
+_loop = None
+_shards = None
+_redis_client = None
+
+task_prerun.connect(metrics.task_prerun)
+task_postrun.connect(metrics.task_postrun)
+worker_init.connect(metrics.start_worker_metrics_server)
+
+@worker_process_init.connect
+def _reset_worker_state(**kwargs):
+    global _loop, _shards, _redis_client
+    _loop = _shards = _redis_client = None
+
+def _run(coro):
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop.run_until_complete(coro)
+
+def _get_shards():
+    global _shards
+    if _shards is None:
+        _shards = create_shard_set()
+        for index, engine in enumerate(_shards.engines):
+            metrics.instrument_engine(engine, f"worker{index}" if index else "worker")
+    return _shards
+
+def _get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = aioredis.from_url(REDIS_URL, decode_responses=False)
+    return _redis_client
+
+async def _delete_shard_in_chunks(session_maker, condition, label: str):
+    redis_client = _get_redis()
+    deleted = 0
+    chunks = 0
+    started = time.monotonic()
+    while True:
+        ids = select(Link.id).filter(condition).limit(CLEANUP_CHUNK_SIZE)
+        stmt = (
+            delete(Link)
+            .where(Link.id.in_(ids))
+            .returning(Link.short_code)
+            .execution_options(synchronize_session=False)
+        )
+        async with session_maker() as db:
+            codes = (await db.execute(stmt)).scalars().all()
+            await db.commit()
+        if not codes:
+            break
+        await invalidate_link(redis_client, *codes)
+        await unschedule_expiry(redis_client, *codes)
+        deleted += len(codes)
+        chunks += 1
+        elapsed = time.monotonic() - started
+        logger.info("Celery %s: chunk %d removed %d links (%d total, %.0f rows/s)",
+                    label, chunks, len(codes), deleted, deleted / elapsed if elapsed else 0)
+        if len(codes) < CLEANUP_CHUNK_SIZE:
+            break
+    return deleted, chunks
+
+# Shards are swept concurrently, each in its own chunks.
+async def _delete_in_chunks(condition, label: str):
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *(_delete_shard_in_chunks(session_maker, condition, label) for session_maker in _get_shards().session_makers)
+    )
+    deleted = sum(shard_deleted for shard_deleted, _ in results)
+    elapsed = time.monotonic() - started
+    stats = {
+        "deleted": deleted,
+        "chunks": sum(shard_chunks for _, shard_chunks in results),
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(deleted / elapsed, 1) if elapsed else 0.0,
+    }
+    logger.info("Celery %s: %d links removed in %.2fs", label, deleted, elapsed)
+    return stats
+
+# Deletes links whose expiry came due in the Redis expiry queue. Codes are
+# popped before the delete, so a failed batch is left to the periodic
+# expired-links sweep, which also covers links the queue never saw.
+async def _process_expirations():
+    shard_set = _get_shards()
+    redis_client = _get_redis()
+    deleted = 0
+    popped = 0
+    started = time.monotonic()
+    while True:
+        codes = await pop_due(redis_client, time.time(), EXPIRY_BATCH_SIZE)
+        if not codes:
+            break
+        popped += len(codes)
+        removed = []
+        for index, shard_codes in shard_set.group_codes(codes).items():
+            stmt = (
+                delete(Link)
+                .where(Link.short_code.in_(shard_codes), Link.expires_at != None, Link.expires_at <= datetime.utcnow())
+                .returning(Link.short_code)
+                .execution_options(synchronize_session=False)
+            )
+            async with shard_set.session_makers[index]() as db:
+                removed.extend((await db.execute(stmt)).scalars().all())
+                await db.commit()
+        await invalidate_link(redis_client, *removed)
+        deleted += len(removed)
+        if len(codes) < EXPIRY_BATCH_SIZE:
+            break
+    elapsed = time.monotonic() - started
+    if popped:
+        logger.info("Celery expiry: %d of %d due links removed in %.2fs", deleted, popped, elapsed)
+    return {"due": popped, "deleted": deleted, "seconds": round(elapsed, 3)}
+
+@celery_app.task
+def process_expirations_task():
+    return _run(_process_expirations())
 
 async def _cleanup_expired_links():
-    new_engine = create_async_engine(DATABASE_URL_ASYNC, echo=True, future=True)
-    NewSessionMaker = sessionmaker(new_engine, class_=AsyncSession, expire_on_commit=False)
-    async with NewSessionMaker() as db:
-        stmt = select(Link).filter(Link.expires_at != None, Link.expires_at < datetime.utcnow())
-        result = await db.execute(stmt)
-        expired_links = result.scalars().all()
-        for link in expired_links:
-            await db.delete(link)
-        await db.commit()
-        logger.info("Celery cleanup: %d expired links removed", len(expired_links))
-    await new_engine.dispose()
+    condition = (Link.expires_at != None) & (Link.expires_at < datetime.utcnow())
+    return await _delete_in_chunks(condition, "cleanup")
 
 @celery_app.task
 def cleanup_expired_links_task():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(_cleanup_expired_links())
-    loop.close()
+    return _run(_cleanup_expired_links())
 
 async def _cleanup_inactive_links():
-    new_engine = create_async_engine(DATABASE_URL_ASYNC, echo=True, future=True)
-    NewSessionMaker = sessionmaker(new_engine, class_=AsyncSession, expire_on_commit=False)
-    async with NewSessionMaker() as db:
-        threshold_date = datetime.utcnow() - timedelta(days=INACTIVE_DAYS_THRESHOLD)
-        stmt = select(Link).filter(
-            ((Link.last_redirect_at != None) & (Link.last_redirect_at < threshold_date)) |
-            ((Link.last_redirect_at == None) & (Link.created_at < threshold_date))
-        )
-        result = await db.execute(stmt)
-        inactive_links = result.scalars().all()
-        for link in inactive_links:
-            await db.delete(link)
-        await db.commit()
-        logger.info("Celery inactive cleanup: %d inactive links removed", len(inactive_links))
-    await new_engine.dispose()
+    threshold_date = datetime.utcnow() - timedelta(days=INACTIVE_DAYS_THRESHOLD)
+    condition = (
+        ((Link.last_redirect_at != None) & (Link.last_redirect_at < threshold_date)) |
+        ((Link.last_redirect_at == None) & (Link.created_at < threshold_date))
+    )
+    return await _delete_in_chunks(condition, "inactive cleanup")
 
 @celery_app.task
 def cleanup_inactive_links_task():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(_cleanup_inactive_links())
-    loop.close()
+    return _run(_cleanup_inactive_links())
+
+async def _ingest_clicks():
+    started = time.monotonic()
+    stats = await ingest_clicks(_get_redis(), _get_shards())
+    stats["seconds"] = round(time.monotonic() - started, 3)
+    if stats["read"]:
+        logger.info("Celery clicks: %d events read, %d stored in %.2fs", stats["read"], stats["stored"], stats["seconds"])
+    return stats
+
+@celery_app.task
+def ingest_clicks_task():
+    return _run(_ingest_clicks())
+
+@celery_app.task
+def rebuild_bloom_task():
+    return _run(rebuild_bloom(_get_redis(), _get_shards()))
+
+@celery_app.task
+def warm_cache_task():
+    return _run(warm_cache(_get_redis(), _get_shards()))
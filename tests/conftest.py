@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# config.py reads the environment at import time, so this runs before any
+# application module is imported.
+DB_DIR = tempfile.mkdtemp(prefix="shortener-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_DIR}/test.db"
+os.environ.pop("DATABASE_READ_URL", None)
+os.environ.pop("SHARD_DATABASE_URLS", None)
+os.environ["RATE_LIMIT_ENABLED"] = "false"
+os.environ["WARMUP_ENABLED"] = "false"
+os.environ["BLOOM_CAPACITY"] = "100000"
+# Keeps background flushes and early refreshes from issuing SQL mid-test.
+os.environ["REDIRECT_COUNTER_FLUSH_INTERVAL"] = "3600"
+os.environ["CACHE_EARLY_REFRESH_BETA"] = "0"
+
+import fakeredis
+import redis.asyncio as aioredis
+
+_redis_server = fakeredis.FakeServer()
+
+
+def _fake_from_url(*args, **kwargs):
+    return fakeredis.aioredis.FakeRedis(server=_redis_server, decode_responses=kwargs.get("decode_responses", False))
+
+
+aioredis.from_url = _fake_from_url
+
+
+@pytest.fixture(scope="session")
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def client(run):
+    import httpx
+    import main
+    run(main.app.router.startup())
+    transport = httpx.ASGITransport(app=main.app)
+    client = httpx.AsyncClient(transport=transport, base_url="http://test")
+    yield client
+    run(client.aclose())
+    run(main.app.router.shutdown())
+
+
+@pytest.fixture(scope="session")
+def auth_headers(run, client):
+    run(client.post("/users/register", json={"username": "tester", "password": "secret"}))
+    response = run(client.post("/users/token", data={"username": "tester", "password": "secret"}))
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+# SQL statements sent to any link database while the test runs.
+@pytest.fixture
+def statements(client):
+    from sqlalchemy import event
+    from sharding import shards
+    executed = []
+
+    def record(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    engines = {engine.sync_engine for engine in shards.engines}
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", record)
+    yield executed
+    for engine in engines:
+        event.remove(engine, "before_cursor_execute", record)
@@ -0,0 +1,18 @@
+import allocator
+
+
+def test_range_codes_survive_redirect_to_blocks(run, client, auth_headers, monkeypatch):
+    import main
+    run(main.redis_client.set(allocator.LEGACY_CODE_BLOCK_KEY, 5000))
+    monkeypatch.setattr(allocator, "_allocator", allocator.RangeCodeAllocator(allocator.reserve_redis_block, block_size=10))
+    codes = set()
+    for i in range(15):
+        if i == 1:
+            assert run(client.get("/blocks")).status_code == 404
+        response = run(client.post("/shorten", json={"original_url": f"https://example.com/range/{i}"}, headers=auth_headers))
+        assert response.status_code == 200
+        codes.add(response.json()["short_code"])
+    assert len(codes) == 15
+    # Continues after the legacy counter instead of restarting from zero.
+    assert int(run(main.redis_client.get(allocator.CODE_BLOCK_KEY))) == 5020
+    assert run(client.get("/blocks")).status_code == 404
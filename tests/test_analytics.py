@@ -0,0 +1,81 @@
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from analytics import CLICK_STREAM_KEY, ingest_clicks
+from models import Link, ClickRollup, ClickBreakdown
+from sharding import shards
+
+FIREFOX = "Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0"
+
+
+def _hour(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _day(ts):
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _params(start):
+    return {"start": start.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def test_clicks_roll_up_and_feed_the_timeseries(run, client, auth_headers):
+    import main
+    response = run(client.post("/shorten", json={"original_url": "https://example.com/analytics"}, headers=auth_headers))
+    short_code = response.json()["short_code"]
+
+    async def link_id():
+        async with shards.session_makers[0]() as db:
+            return await db.scalar(select(Link.id).filter(Link.short_code == short_code))
+    link_id = run(link_id())
+
+    for headers in ({"Referer": "https://news.example/a", "User-Agent": FIREFOX},
+                    {"Referer": "https://news.example/b", "User-Agent": FIREFOX},
+                    {"User-Agent": "curl/8.5.0"}):
+        assert run(client.get(f"/{short_code}", headers=headers, follow_redirects=False)).status_code == 307
+    now = datetime.utcnow()
+    # A click from two days ago lands in its own hour and day buckets.
+    earlier = now - timedelta(days=2)
+    run(main.redis_client.xadd(CLICK_STREAM_KEY, {
+        "l": link_id, "t": f"{time.time() - 2 * 86400:.3f}", "r": "direct", "a": "firefox",
+    }))
+    run(ingest_clicks(main.redis_client, shards))
+    # A later run adds to the existing buckets instead of replacing them.
+    assert run(client.get(f"/{short_code}", headers={"User-Agent": "curl/8.5.0"}, follow_redirects=False)).status_code == 307
+    run(ingest_clicks(main.redis_client, shards))
+
+    async def rollups():
+        async with shards.session_makers[0]() as db:
+            rows = (await db.execute(select(ClickRollup.granularity, ClickRollup.bucket, ClickRollup.clicks)
+                                     .filter(ClickRollup.link_id == link_id))).all()
+            breakdowns = (await db.execute(select(ClickBreakdown.day, ClickBreakdown.dimension,
+                                                  ClickBreakdown.value, ClickBreakdown.clicks)
+                                           .filter(ClickBreakdown.link_id == link_id))).all()
+            return {tuple(row[:-1]): row[-1] for row in rows}, {tuple(row[:-1]): row[-1] for row in breakdowns}
+    rollups, breakdowns = run(rollups())
+
+    assert rollups[("hour", _hour(earlier))] == 1
+    assert rollups[("day", _day(earlier))] == 1
+    assert sum(clicks for (granularity, _), clicks in rollups.items() if granularity == "day") == 5
+    assert sum(clicks for (granularity, _), clicks in rollups.items() if granularity == "hour") == 5
+    today = _day(now)
+    assert breakdowns[(today, "referrer", "news.example")] == 2
+    assert breakdowns[(today, "referrer", "direct")] == 2
+    assert breakdowns[(today, "user_agent", "firefox")] == 2
+    assert breakdowns[(today, "user_agent", "curl")] == 2
+    assert breakdowns[(_day(earlier), "referrer", "direct")] == 1
+
+    response = run(client.get(f"/{short_code}/stats/timeseries",
+                              params={"granularity": "day", **_params(earlier - timedelta(days=1))}))
+    assert response.status_code == 200
+    body = response.json()
+    points = {datetime.fromisoformat(point["bucket"]): point["clicks"] for point in body["points"]}
+    assert points == {_day(earlier): 1, today: 4}
+    assert {item["value"]: item["clicks"] for item in body["referrers"]} == {"direct": 3, "news.example": 2}
+    assert {item["value"]: item["clicks"] for item in body["user_agents"]} == {"firefox": 3, "curl": 2}
+
+    # The hourly series only covers its range, leaving out the older click.
+    response = run(client.get(f"/{short_code}/stats/timeseries",
+                              params={"granularity": "hour", **_params(now - timedelta(hours=1))}))
+    assert sum(point["clicks"] for point in response.json()["points"]) == 4
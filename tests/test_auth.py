@@ -0,0 +1,90 @@
+from datetime import timedelta
+from auth import create_access_token, create_refresh_token
+
+
+def _login(run, client, username):
+    run(client.post("/users/register", json={"username": username, "password": "secret"}))
+    return run(client.post("/users/token", data={"username": username, "password": "secret"})).json()
+
+
+def test_revoke_rejects_issued_tokens(run, client):
+    tokens = _login(run, client, "revoker")
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+    assert run(client.get("/users/links", headers=headers)).status_code == 200
+    assert run(client.post("/users/token/revoke", headers=headers)).status_code == 200
+    assert run(client.get("/users/links", headers=headers)).status_code == 401
+    refresh = run(client.post("/users/token/refresh", json={"refresh_token": tokens["refresh_token"]}))
+    assert refresh.status_code == 401
+
+
+def test_tokens_without_version_are_rejected(run, client):
+    _login(run, client, "legacy")
+    access = create_access_token({"sub": "legacy"}, expires_delta=timedelta(minutes=5))
+    refresh = create_refresh_token({"sub": "legacy"})
+    assert run(client.get("/users/links", headers={"Authorization": f"Bearer {access}"})).status_code == 401
+    assert run(client.post("/users/token/refresh", json={"refresh_token": refresh})).status_code == 401
+
+
+def test_revoke_racing_a_resolve_is_not_undone(run, client):
+    import main
+    from auth import decode_access_token, resolve_user, user_cache, user_cache_key
+    from database import async_session_maker
+    tokens = _login(run, client, "racer")
+    headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+    payload = decode_access_token(tokens["access_token"])
+    user_cache.pop(str(payload["uid"]))
+    run(main.redis_client.delete(user_cache_key(payload["uid"])))
+
+    # The revoke commits after resolve_user read the user and before it
+    # caches what it read.
+    class RevokingSession:
+        def __init__(self, db):
+            self.db = db
+
+        async def execute(self, stmt):
+            return await self.db.execute(stmt)
+
+        async def rollback(self):
+            await self.db.rollback()
+            assert (await client.post("/users/token/revoke", headers=headers)).status_code == 200
+
+    async def resolve():
+        async with async_session_maker() as db:
+            return await resolve_user(RevokingSession(db), payload)
+
+    assert run(resolve()) is not None
+    assert run(client.get("/users/links", headers=headers)).status_code == 401
+    user_cache.pop(str(payload["uid"]))
+    assert run(client.get("/users/links", headers=headers)).status_code == 401
+
+
+def test_redirects_keep_answering_during_saturated_logins(run, client, auth_headers, monkeypatch):
+    import asyncio
+    import time
+    import auth
+    monkeypatch.setattr(auth, "PASSWORD_HASH_MAX_PENDING", 2)
+    _login(run, client, "busy")
+    code = run(client.post("/shorten", json={"original_url": "https://example.com/busy"}, headers=auth_headers)).json()["short_code"]
+    run(client.get(f"/{code}"))
+
+    async def scenario():
+        logins = [
+            asyncio.create_task(client.post("/users/token", data={"username": "busy", "password": "secret"}))
+            for _ in range(6)
+        ]
+        await asyncio.sleep(0)
+        latencies = []
+        for _ in range(20):
+            started = time.perf_counter()
+            response = await client.get(f"/{code}")
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 307
+        logins_running = not all(task.done() for task in logins)
+        return latencies, logins_running, await asyncio.gather(*logins)
+
+    latencies, logins_running, logins = run(scenario())
+    assert logins_running, "redirects should finish while bcrypt is still busy"
+    assert max(latencies) < 0.2
+    statuses = sorted(response.status_code for response in logins)
+    assert statuses == [200, 200, 503, 503, 503, 503]
+    assert all(response.headers["retry-after"] for response in logins if response.status_code == 503)
@@ -0,0 +1,12 @@
+import allocator
+
+
+def test_batch_counts_reused_links_separately(run, client, auth_headers, monkeypatch):
+    monkeypatch.setattr(allocator, "LINK_DEDUP_ENABLED", True)
+    existing = run(client.post("/shorten", json={"original_url": "https://example.com/dedup"}, headers=auth_headers)).json()
+    items = [{"original_url": "https://example.com/dedup"}, {"original_url": "https://example.com/fresh"}]
+    response = run(client.post("/shorten/batch", json={"items": items}, headers=auth_headers))
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["reused"], body["failed"]) == (1, 1, 0)
+    assert body["results"][0]["link"]["short_code"] == existing["short_code"]
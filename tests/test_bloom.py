@@ -0,0 +1,40 @@
+import asyncio
+import bloom
+import cache
+
+
+def _wait_ready(run, redis_client):
+    from sharding import shards
+    # A rebuild started by the app's background tasks may hold the lock.
+    for _ in range(50):
+        run(bloom.ensure_bloom(redis_client, shards))
+        if run(bloom.bloom_ready(redis_client)):
+            return
+        run(asyncio.sleep(0.05))
+    raise AssertionError("bloom filter never became ready")
+
+
+def test_unknown_code_skips_load_lock(run, client, statements, monkeypatch):
+    import main
+    _wait_ready(run, main.redis_client)
+
+    async def no_load(*args):
+        raise AssertionError("unknown code reached the load lock")
+
+    monkeypatch.setattr(cache, "_load_coalesced", no_load)
+    assert run(client.get("/neverissued")).status_code == 404
+    assert statements == []
+
+
+def test_replayed_adds_bypass_filter_until_rebuilt(run, client, auth_headers):
+    import main
+    _wait_ready(run, main.redis_client)
+    code = run(client.post("/shorten", json={"original_url": "https://example.com/outage"}, headers=auth_headers)).json()["short_code"]
+    # As if the add had failed: the bits are missing from the shared filter.
+    run(main.redis_client.delete(bloom.BLOOM_KEY))
+    bloom._unsynced.add(code)
+    assert run(bloom.bloom_absent(main.redis_client, code)) == set()
+    assert not run(bloom.bloom_ready(main.redis_client))
+    assert bloom._rebuild_needed
+    _wait_ready(run, main.redis_client)
+    assert run(bloom.bloom_absent(main.redis_client, code)) == set()
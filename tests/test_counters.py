@@ -0,0 +1,48 @@
+import asyncio
+from sqlalchemy import select
+import counters
+from models import Link
+from sharding import shards
+
+
+def _redirect_count(run, link_id):
+    async def load():
+        async with shards.session_makers[0]() as db:
+            return await db.scalar(select(Link.redirect_count).filter(Link.id == link_id))
+    return run(load())
+
+
+def test_flush_overrunning_its_lock_is_not_applied_twice(run, client, auth_headers, monkeypatch):
+    import main
+    link = run(client.post("/shorten", json={"original_url": "https://example.com/counted"}, headers=auth_headers)).json()
+    run(counters.flush_counters(main.redis_client))
+    for _ in range(3):
+        assert run(client.get(f"/{link['short_code']}")).status_code == 307
+
+    apply = counters._apply
+
+    async def slow_apply(counts, last):
+        await asyncio.sleep(0.5)
+        return await apply(counts, last)
+
+    # The first flush runs well past the lock's TTL; the second starts meanwhile.
+    monkeypatch.setattr(counters, "FLUSH_LOCK_TTL_MS", 150)
+    monkeypatch.setattr(counters, "_apply", slow_apply)
+
+    async def overlapping():
+        async def late():
+            await asyncio.sleep(0.3)
+            return await counters.flush_counters(main.redis_client)
+        return await asyncio.gather(counters.flush_counters(main.redis_client), late())
+
+    assert run(overlapping()) == [1, 0]
+    assert _redirect_count(run, link["id"]) == 3
+    assert run(main.redis_client.exists(counters.FLUSH_LOCK_KEY)) == 0
+
+
+def test_flush_leaves_a_lock_it_does_not_own(run, client):
+    import main
+    run(main.redis_client.set(counters.FLUSH_LOCK_KEY, "other", px=5000))
+    assert run(counters.flush_counters(main.redis_client)) == 0
+    assert run(main.redis_client.get(counters.FLUSH_LOCK_KEY)) == b"other"
+    run(main.redis_client.delete(counters.FLUSH_LOCK_KEY))
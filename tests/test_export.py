@@ -0,0 +1,42 @@
+import gzip
+import orjson
+import pytest
+from responses import accepts_gzip
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip", True),
+    ("gzip, deflate, br", True),
+    ("br;q=1.0, gzip;q=0.5", True),
+    ("GZIP", True),
+    ("*", True),
+    ("", False),
+    ("identity", False),
+    ("gzip;q=0", False),
+    ("gzip; q=0.000, br", False),
+    ("*;q=0.5, gzip;q=0", False),
+    ("br, *;q=0", False),
+    ("x-gzip", True),
+])
+def test_accepts_gzip_honours_q_values(header, expected):
+    assert accepts_gzip(header) is expected
+
+
+def test_export_is_compressed_only_when_gzip_is_accepted(run, client, auth_headers):
+    run(client.post("/shorten", json={"original_url": "https://example.com/export"}, headers=auth_headers))
+
+    def export(accept_encoding):
+        return run(client.get("/users/links/export", headers={**auth_headers, "Accept-Encoding": accept_encoding}))
+
+    compressed = export("gzip")
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert compressed.headers["vary"] == "Accept-Encoding"
+    rows = [orjson.loads(line) for line in compressed.content.splitlines()]
+    assert "https://example.com/export" in {row["original_url"] for row in rows}
+
+    refused = export("gzip;q=0, identity")
+    assert "content-encoding" not in refused.headers
+    assert refused.headers["vary"] == "Accept-Encoding"
+    assert [orjson.loads(line) for line in refused.content.splitlines()] == rows
+    with pytest.raises(OSError):
+        gzip.decompress(refused.content)
@@ -0,0 +1,35 @@
+import pytest
+from pagination import encode_cursor
+
+
+def test_category_pages_cover_all_links(run, client):
+    for i in range(5):
+        response = run(client.post("/shorten/public", json={"original_url": f"https://paged.example/{i}", "category": "paged"}))
+        assert response.status_code == 200
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = run(client.get("/category/paged", params=params))
+        assert response.status_code == 200
+        seen += [link["short_code"] for link in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 5
+
+
+@pytest.mark.parametrize("cursor", [
+    encode_cursor("2024-01-01T00:00:00", "x"),
+    encode_cursor("2024-01-01T00:00:00", 1.5),
+    encode_cursor("yesterday", 1),
+    encode_cursor(1),
+])
+def test_category_rejects_malformed_cursor(run, client, cursor):
+    assert run(client.get("/category/paged", params={"cursor": cursor})).status_code == 400
+
+
+def test_user_links_rejects_malformed_cursor(run, client, auth_headers):
+    cursor = encode_cursor("2024-01-01T00:00:00", "x")
+    assert run(client.get("/users/links", params={"cursor": cursor}, headers=auth_headers)).status_code == 400
@@ -0,0 +1,46 @@
+import main
+from config import PUBLIC_BASE_URL
+from qr import qr_digest, qr_etag
+
+
+def _create(run, client, auth_headers, url):
+    response = run(client.post("/shorten", json={"original_url": url}, headers=auth_headers))
+    assert response.status_code == 200
+    return response.json()["short_code"]
+
+
+def test_qr_etag_round_trip(run, client, auth_headers):
+    code = _create(run, client, auth_headers, "https://example.com/qr")
+    first = run(client.get(f"/{code}/qrcode", params={"format": "svg"}))
+    assert first.status_code == 200
+    assert first.headers["content-type"] == "image/svg+xml"
+    etag = first.headers["etag"]
+    assert etag == qr_etag(qr_digest(f"{PUBLIC_BASE_URL}/{code}", "svg", 290, 4))
+
+    cached = run(client.get(f"/{code}/qrcode", params={"format": "svg"}, headers={"If-None-Match": etag}))
+    assert cached.status_code == 304
+    assert cached.headers["etag"] == etag and not cached.content
+    other_size = run(client.get(f"/{code}/qrcode", params={"format": "svg", "size": 128}, headers={"If-None-Match": etag}))
+    assert other_size.status_code == 200 and other_size.headers["etag"] != etag
+
+    # The image encodes the short URL, so only a new alias changes it.
+    run(client.put(f"/{code}", json={"original_url": "https://example.com/qr-edited"}, headers=auth_headers))
+    assert run(client.get(f"/{code}/qrcode", params={"format": "svg"}, headers={"If-None-Match": etag})).status_code == 304
+    alias = f"{code}qr"
+    response = run(client.put(f"/{code}", json={"original_url": "https://example.com/qr-edited", "custom_alias": alias},
+                              headers=auth_headers))
+    assert response.status_code == 200
+    assert run(client.get(f"/{code}/qrcode", params={"format": "svg"}, headers={"If-None-Match": etag})).status_code == 404
+    renamed = run(client.get(f"/{alias}/qrcode", params={"format": "svg"}, headers={"If-None-Match": etag}))
+    assert renamed.status_code == 200 and renamed.headers["etag"] != etag
+
+
+def test_qr_ignores_the_host_header(run, client, auth_headers):
+    code = _create(run, client, auth_headers, "https://example.com/qr-host")
+    etags = {
+        run(client.get(f"/{code}/qrcode", params={"format": "svg"}, headers={"Host": host})).headers["etag"]
+        for host in ("test", "evil.example", "another.example:8080")
+    }
+    assert etags == {qr_etag(qr_digest(f"{PUBLIC_BASE_URL}/{code}", "svg", 290, 4))}
+    keys = run(main.redis_client.smembers(f"qr_index:{code}"))
+    assert len(keys) == 1
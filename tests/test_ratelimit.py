@@ -0,0 +1,75 @@
+import asyncio
+import time
+import httpx
+import pytest
+import ratelimit
+
+
+@pytest.fixture
+def limited(monkeypatch, request):
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_ENABLED", True)
+
+    # Gives the public shorten route its own bucket per test.
+    def limit(requests, seconds):
+        limits = dict(ratelimit.ROUTE_LIMITS)
+        limits[("POST", "/shorten/public")] = (f"test_{request.node.name}", requests, seconds)
+        monkeypatch.setattr(ratelimit, "ROUTE_LIMITS", limits)
+    return limit
+
+
+def _shorten_public(run, client, i):
+    return run(client.post("/shorten/public", json={"original_url": f"https://limited.example/{i}"}))
+
+
+def test_redirect_limit_is_opt_in():
+    assert ("GET", "/{short_code}") not in ratelimit.ROUTE_LIMITS
+    assert ratelimit.ROUTE_LIMITS[("POST", "/shorten/public")] == ("shorten_public", 20, 60.0)
+
+
+def test_burst_is_rejected_with_retry_after(run, client, limited):
+    limited(3, 60)
+    assert [_shorten_public(run, client, i).status_code for i in range(3)] == [200] * 3
+    response = _shorten_public(run, client, 3)
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    assert response.headers["x-ratelimit-limit"] == "3;w=60"
+    assert response.headers["x-ratelimit-remaining"] == "0"
+
+
+def test_bucket_refills_over_time(run, client, limited):
+    limited(2, 0.2)
+    assert [_shorten_public(run, client, i).status_code for i in range(3)] == [200, 200, 429]
+    time.sleep(0.15)
+    assert _shorten_public(run, client, 3).status_code == 200
+
+
+def test_authenticated_creation_is_not_limited(run, client, auth_headers, limited):
+    limited(1, 60)
+    for i in range(5):
+        response = run(client.post("/shorten", json={"original_url": f"https://limited.example/user/{i}"}, headers=auth_headers))
+        assert response.status_code == 200
+
+
+def test_load_is_shed_beyond_max_inflight(run):
+    release = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    app = ratelimit.LoadShedMiddleware(slow_app, max_inflight=2)
+
+    async def overload():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            held = [asyncio.create_task(client.get("/")) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            shed = await client.get("/")
+            release.set()
+            return shed, await asyncio.gather(*held)
+
+    shed, held = run(overload())
+    assert shed.status_code == 503
+    assert shed.headers["retry-after"] == str(ratelimit.LOAD_SHED_RETRY_AFTER)
+    assert [response.status_code for response in held] == [200, 200]
+    assert app.inflight == 0
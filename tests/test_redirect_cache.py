@@ -0,0 +1,134 @@
+from cache import link_cache
+
+
+def _create(run, client, auth_headers, url):
+    response = run(client.post("/shorten", json={"original_url": url}, headers=auth_headers))
+    assert response.status_code == 200
+    return response.json()["short_code"]
+
+
+def test_warm_redirect_runs_no_sql(run, client, auth_headers, statements):
+    code = _create(run, client, auth_headers, "https://example.com/warm")
+    statements.clear()
+    assert run(client.get(f"/{code}")).status_code == 307
+    assert statements, "the cold redirect should load the link"
+    statements.clear()
+    response = run(client.get(f"/{code}"))
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://example.com/warm"
+    assert statements == []
+
+
+def test_redis_hit_runs_no_sql(run, client, auth_headers, statements):
+    code = _create(run, client, auth_headers, "https://example.com/redis")
+    run(client.get(f"/{code}"))
+    link_cache.pop(code)
+    statements.clear()
+    assert run(client.get(f"/{code}")).status_code == 307
+    assert statements == []
+
+
+def test_unknown_code_is_cached(run, client, statements):
+    assert run(client.get("/doesnotexist")).status_code == 404
+    statements.clear()
+    assert run(client.get("/doesnotexist")).status_code == 404
+    assert statements == []
+
+
+def test_update_invalidates_cached_redirect(run, client, auth_headers):
+    code = _create(run, client, auth_headers, "https://example.com/before")
+    assert run(client.get(f"/{code}")).headers["location"] == "https://example.com/before"
+    response = run(client.put(f"/{code}", json={"original_url": "https://example.com/after"}, headers=auth_headers))
+    assert response.status_code == 200
+    assert run(client.get(f"/{code}")).headers["location"] == "https://example.com/after"
+
+
+def test_delete_invalidates_cached_redirect(run, client, auth_headers):
+    code = _create(run, client, auth_headers, "https://example.com/deleted")
+    assert run(client.get(f"/{code}")).status_code == 307
+    assert run(client.delete(f"/{code}", headers=auth_headers)).status_code == 200
+    assert run(client.get(f"/{code}")).status_code == 404
+
+
+def test_load_racing_an_update_does_not_cache_the_old_url(run, client, auth_headers):
+    import main
+    import cache
+    from sharding import shards
+    code = _create(run, client, auth_headers, "https://example.com/before")
+
+    # The update commits and invalidates after the load read the old row.
+    class UpdatingSession:
+        def __init__(self, db):
+            self.db = db
+
+        async def execute(self, stmt):
+            result = await self.db.execute(stmt)
+            await self.db.rollback()
+            response = await client.put(f"/{code}", json={"original_url": "https://example.com/after"}, headers=auth_headers)
+            assert response.status_code == 200
+            return result
+
+    async def load():
+        async with shards.session_maker_for_code(code)() as db:
+            return await cache._load_from_db(UpdatingSession(db), main.redis_client, code)
+
+    assert run(load()).original_url == "https://example.com/before"
+    assert link_cache.get(code) is None
+    assert run(main.redis_client.get(cache.cache_key(code))) is None
+    assert run(client.get(f"/{code}")).headers["location"] == "https://example.com/after"
+
+
+def test_slow_load_leaves_the_next_lock_holder_alone(run, client, auth_headers, monkeypatch):
+    import asyncio
+    import main
+    import cache
+    from sharding import shards
+    code = _create(run, client, auth_headers, "https://example.com/slow")
+    lock_key = cache._lock_key(code)
+    monkeypatch.setattr(cache, "LOAD_LOCK_TTL_MS", 50)
+
+    # The load outlives its lock, which another worker then takes.
+    class SlowSession:
+        def __init__(self, db):
+            self.db = db
+
+        async def execute(self, stmt):
+            await asyncio.sleep(0.1)
+            assert await main.redis_client.set(lock_key, "other", nx=True, px=5000)
+            return await self.db.execute(stmt)
+
+    async def load():
+        async with shards.session_maker_for_code(code)() as db:
+            return await cache._load_with_lock(SlowSession(db), main.redis_client, code)
+
+    assert run(load()).original_url == "https://example.com/slow"
+    assert run(main.redis_client.get(lock_key)) == b"other"
+    run(main.redis_client.delete(lock_key))
+
+
+def test_early_refreshes_are_tracked_and_cancelled(run, client, monkeypatch):
+    import asyncio
+    import main
+    import cache
+    started = asyncio.Event()
+
+    async def hanging_refresh(redis_client, short_code, stale):
+        try:
+            started.set()
+            await asyncio.sleep(3600)
+        finally:
+            cache._refreshing.discard(short_code)
+
+    monkeypatch.setattr(cache, "_refresh", hanging_refresh)
+
+    async def schedule_and_cancel():
+        cache._schedule_refresh(main.redis_client, "refreshing", cache.CacheEntry(cache.LINK_OK, 1, None, "x"))
+        await started.wait()
+        assert len(cache._refresh_tasks) == 1
+        [task] = cache._refresh_tasks
+        await cache.cancel_refreshes()
+        return task
+
+    task = run(schedule_and_cancel())
+    assert task.cancelled()
+    assert not cache._refresh_tasks and "refreshing" not in cache._refreshing
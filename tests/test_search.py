@@ -0,0 +1,32 @@
+import pytest
+from pagination import encode_cursor
+
+
+def test_search_pages_cover_all_matches(run, client):
+    for i in range(7):
+        response = run(client.post("/shorten/public", json={"original_url": f"https://searchable.example/{i}"}))
+        assert response.status_code == 200
+    seen, cursor = [], None
+    while True:
+        params = {"query": "searchable", "limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        response = run(client.get("/search", params=params))
+        assert response.status_code == 200
+        seen += [link["short_code"] for link in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 7
+
+
+@pytest.mark.parametrize("cursor", [
+    encode_cursor(1.0, "x"),
+    encode_cursor("high", 5),
+    encode_cursor(1.0, True),
+    encode_cursor(1.0),
+    "not-a-cursor",
+])
+def test_search_rejects_malformed_cursor(run, client, cursor):
+    response = run(client.get("/search", params={"query": "searchable", "cursor": cursor}))
+    assert response.status_code == 400
@@ -0,0 +1,134 @@
+import asyncio
+from datetime import datetime
+import pytest
+from sqlalchemy import func, select
+from analytics import ingest_clicks
+from counters import flush_counters
+from config import async_url
+from conftest import DB_DIR
+from database import make_engine
+from models import Link, ClickRollup
+from sharding import SHARD_ID_BITS, HashRing, ShardSet, init_shards, merge_desc, shards
+
+SHARD_ATTRIBUTES = ("engines", "read_engines", "session_makers", "read_session_makers", "ring")
+
+
+# Points the application's shard set at three SQLite databases for one test.
+@pytest.fixture
+def sharded(run, client, monkeypatch, request):
+    shard_set = ShardSet([make_engine(async_url(f"sqlite:///{DB_DIR}/{request.node.name}-{i}.db")) for i in range(3)])
+    run(init_shards(shard_set))
+    for attribute in SHARD_ATTRIBUTES:
+        monkeypatch.setattr(shards, attribute, getattr(shard_set, attribute))
+    yield shard_set
+    # Applies redirects and clicks of these links while their shards are set.
+    import main
+    run(flush_counters(main.redis_client))
+    run(ingest_clicks(main.redis_client, shards))
+    run(shard_set.dispose())
+
+
+def _stored_on(run, shard_set, short_code):
+    async def count(engine):
+        async with engine.connect() as conn:
+            return await conn.scalar(select(func.count()).select_from(Link).filter(Link.short_code == short_code))
+    return [index for index, engine in enumerate(shard_set.engines) if run(count(engine))]
+
+
+def test_ring_routing_is_stable_and_spread():
+    ring = HashRing(3)
+    codes = [f"code{i}" for i in range(3000)]
+    nodes = [ring.node_for(code) for code in codes]
+    assert nodes == [HashRing(3).node_for(code) for code in codes]
+    assert all(nodes.count(node) > 500 for node in range(3))
+    assert {HashRing(1).node_for(code) for code in codes} == {0}
+
+
+def test_ids_map_to_shards(sharded):
+    assert sharded.index_for_id(5) == 0
+    assert sharded.index_for_id((2 << SHARD_ID_BITS) + 5) == 2
+    with pytest.raises(ValueError):
+        sharded.index_for_id(3 << SHARD_ID_BITS)
+    assert sharded.group_ids([1, (1 << SHARD_ID_BITS) + 1, 2]) == {0: [1, 2], 1: [(1 << SHARD_ID_BITS) + 1]}
+
+
+def test_batch_create_places_links_on_their_shards(run, client, auth_headers, sharded):
+    batches = [
+        {"items": [{"original_url": f"https://sharded.example/{b}/{i}"} for i in range(30)]}
+        for b in range(4)
+    ]
+    # Concurrent batches write to the same shards in different orders.
+    async def create_all():
+        return await asyncio.gather(*(client.post("/shorten/batch", json=batch, headers=auth_headers) for batch in batches))
+    responses = run(create_all())
+    assert [response.status_code for response in responses] == [200] * 4
+    links = [item["link"] for response in responses for item in response.json()["results"]]
+    assert len(links) == 120
+    for link in links:
+        index = sharded.index_for_code(link["short_code"])
+        assert _stored_on(run, sharded, link["short_code"]) == [index]
+        assert link["id"] >> SHARD_ID_BITS == index
+    assert len({link["id"] >> SHARD_ID_BITS for link in links}) == 3
+    response = run(client.get(f"/{links[0]['short_code']}"))
+    assert response.headers["location"] == links[0]["original_url"]
+
+
+def test_alias_update_moves_link_to_its_shard(run, client, auth_headers, sharded):
+    link = run(client.post("/shorten", json={"original_url": "https://sharded.example/move"}, headers=auth_headers)).json()
+    source = sharded.index_for_code(link["short_code"])
+    alias = next(f"moved{i}" for i in range(100) if sharded.index_for_code(f"moved{i}") != source)
+
+    async def add_rollup():
+        async with sharded.session_makers[source]() as db:
+            db.add(ClickRollup(link_id=link["id"], granularity="day", bucket=datetime(2024, 1, 1), clicks=7))
+            await db.commit()
+    run(add_rollup())
+
+    response = run(client.put(
+        f"/{link['short_code']}",
+        json={"original_url": "https://sharded.example/moved", "custom_alias": alias},
+        headers=auth_headers,
+    ))
+    assert response.status_code == 200
+    moved = response.json()
+    assert moved["short_code"] == alias
+    assert moved["id"] >> SHARD_ID_BITS == sharded.index_for_code(alias)
+    assert _stored_on(run, sharded, alias) == [sharded.index_for_code(alias)]
+    assert _stored_on(run, sharded, link["short_code"]) == []
+
+    async def rollup_clicks():
+        async with sharded.session_makers[sharded.index_for_code(alias)]() as db:
+            return await db.scalar(select(ClickRollup.clicks).filter(ClickRollup.link_id == moved["id"]))
+    assert run(rollup_clicks()) == 7
+    assert run(client.get(f"/{link['short_code']}")).status_code == 404
+    assert run(client.get(f"/{alias}")).headers["location"] == "https://sharded.example/moved"
+
+
+def test_user_links_pages_merge_across_shards(run, client, sharded):
+    run(client.post("/users/register", json={"username": "sharded", "password": "secret"}))
+    token = run(client.post("/users/token", data={"username": "sharded", "password": "secret"})).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    created = [
+        run(client.post("/shorten", json={"original_url": f"https://sharded.example/page/{i}"}, headers=headers)).json()
+        for i in range(12)
+    ]
+    assert len({link["id"] >> SHARD_ID_BITS for link in created}) > 1
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 5}
+        if cursor:
+            params["cursor"] = cursor
+        response = run(client.get("/users/links", params=params, headers=headers))
+        assert response.status_code == 200
+        seen += response.json()
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert sorted(link["short_code"] for link in seen) == sorted(link["short_code"] for link in created)
+    keys = [(link["created_at"], link["id"]) for link in seen]
+    assert keys == sorted(keys, reverse=True)
+
+
+def test_merge_desc_takes_the_newest_across_shards():
+    results = [[9, 4, 1], [8, 7], [], [6, 5, 3]]
+    assert merge_desc(results, key=lambda value: value, limit=5) == [9, 8, 7, 6, 5]
@@ -0,0 +1,83 @@
+import time
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import select, update
+import tasks
+from cache import cache_key
+from expiry import EXPIRY_QUEUE_KEY
+from models import Link
+from sharding import shards
+
+
+@pytest.fixture
+def worker(client, monkeypatch):
+    import main
+    monkeypatch.setattr(tasks, "_shards", shards)
+    monkeypatch.setattr(tasks, "_redis_client", main.redis_client)
+    return main.redis_client
+
+
+def _create(run, client, auth_headers, url, **fields):
+    response = run(client.post("/shorten", json={"original_url": url, **fields}, headers=auth_headers))
+    assert response.status_code == 200
+    return response.json()["short_code"]
+
+
+def _set(run, codes, **values):
+    async def apply():
+        async with shards.session_makers[0]() as db:
+            await db.execute(update(Link).where(Link.short_code.in_(codes)).values(**values))
+            await db.commit()
+    run(apply())
+
+
+def _existing(run, codes):
+    async def load():
+        async with shards.session_makers[0]() as db:
+            return set((await db.scalars(select(Link.short_code).filter(Link.short_code.in_(codes)))).all())
+    return run(load())
+
+
+def test_expiry_sweep_removes_only_expired_links(run, client, auth_headers, worker):
+    soon = (datetime.utcnow() + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
+    expired = [_create(run, client, auth_headers, f"https://example.com/expired/{i}", expires_at=soon) for i in range(3)]
+    live = _create(run, client, auth_headers, "https://example.com/live", expires_at=soon)
+    forever = _create(run, client, auth_headers, "https://example.com/forever")
+    _set(run, expired, expires_at=datetime.utcnow() - timedelta(minutes=1))
+    # A cached copy from before expiry must not outlive the row.
+    run(client.get(f"/{expired[0]}"))
+
+    stats = run(tasks._cleanup_expired_links())
+    assert stats["deleted"] >= 3
+    assert _existing(run, expired + [live, forever]) == {live, forever}
+    assert run(worker.get(cache_key(expired[0]))) is None
+    assert run(worker.zscore(EXPIRY_QUEUE_KEY, expired[0])) is None
+    assert run(worker.zscore(EXPIRY_QUEUE_KEY, live)) is not None
+
+
+def test_due_expirations_are_processed_from_the_queue(run, client, auth_headers, worker):
+    soon = (datetime.utcnow() + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
+    due, live = (_create(run, client, auth_headers, f"https://example.com/due/{i}", expires_at=soon) for i in range(2))
+    _set(run, [due], expires_at=datetime.utcnow() - timedelta(minutes=1))
+    run(worker.zadd(EXPIRY_QUEUE_KEY, {due: time.time() - 60}))
+
+    stats = run(tasks._process_expirations())
+    assert stats["deleted"] == 1
+    assert _existing(run, [due, live]) == {live}
+    assert run(client.get(f"/{due}")).status_code == 404
+
+
+@pytest.mark.parametrize("rows, chunks", [(10, 3), (8, 2)])
+def test_chunked_cleanup_removes_every_row_and_stops(run, client, auth_headers, worker, monkeypatch, rows, chunks):
+    monkeypatch.setattr(tasks, "CLEANUP_CHUNK_SIZE", 4)
+    soon = (datetime.utcnow() + timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%S")
+    run(tasks._cleanup_expired_links())
+    stale = [_create(run, client, auth_headers, f"https://example.com/stale/{rows}/{i}", expires_at=soon) for i in range(rows)]
+    live = _create(run, client, auth_headers, f"https://example.com/fresh/{rows}", expires_at=soon)
+    _set(run, stale, expires_at=datetime.utcnow() - timedelta(minutes=1))
+
+    stats = run(tasks._cleanup_expired_links())
+    # A short chunk ends the loop; after full chunks one empty query does.
+    assert (stats["deleted"], stats["chunks"]) == (rows, chunks)
+    assert _existing(run, stale + [live]) == {live}
+    assert run(tasks._cleanup_expired_links())["deleted"] == 0
@@ -0,0 +1,47 @@
+from sqlalchemy import update
+import cache
+import counters
+import warmup
+from analytics import ingest_clicks
+from config import LINK_CACHE_TTL
+from models import Link
+from sharding import shards
+
+
+def test_warmup_writes_current_rows_without_overwriting(run, client, auth_headers, monkeypatch):
+    import main
+    created = [
+        run(client.post("/shorten", json={"original_url": f"https://example.com/hot/{i}"}, headers=auth_headers)).json()
+        for i in range(3)
+    ]
+    changed, deleted, cached = (link["short_code"] for link in created)
+    for link in created:
+        run(client.get(f"/{link['short_code']}"))
+    run(counters.flush_counters(main.redis_client))
+    # Ranked by rollups once any exist, so the clicks are ingested too.
+    run(ingest_clicks(main.redis_client, shards))
+    run(cache.invalidate_link(main.redis_client, changed, deleted, cached))
+    run(main.redis_client.set(cache.cache_key(cached), cache.encode_entry(cache.link_entry(created[2]["id"], "https://cached.example", None))))
+
+    select_hot_links = warmup.select_hot_links
+
+    # An update and a delete land between ranking and writing.
+    async def ranked_then_modified(db, limit):
+        result = await select_hot_links(db, limit)
+        async with shards.session_maker_for_code(changed)() as other:
+            await other.execute(update(Link).where(Link.short_code == changed).values(original_url="https://example.com/new"))
+            await other.commit()
+        assert (await client.delete(f"/{deleted}", headers=auth_headers)).status_code == 200
+        return result
+
+    monkeypatch.setattr(warmup, "WARMUP_ENABLED", True)
+    monkeypatch.setattr(warmup, "select_hot_links", ranked_then_modified)
+    stats = run(warmup.warm_cache(main.redis_client, shards))
+    assert stats["selected"] >= 3
+
+    entry = cache.decode_entry(run(main.redis_client.get(cache.cache_key(changed))))
+    assert entry.original_url == "https://example.com/new"
+    assert run(main.redis_client.ttl(cache.cache_key(changed))) <= LINK_CACHE_TTL
+    assert run(main.redis_client.get(cache.cache_key(deleted))) is None
+    entry = cache.decode_entry(run(main.redis_client.get(cache.cache_key(cached))))
+    assert entry.original_url == "https://cached.example"
@@ -1,26 +1,38 @@
+import hashlib
 import random
 import string
+from urllib.parse import urlsplit, urlunsplit
 from fastapi import HTTPException
-from sqlalchemy.future import select
-from sqlalchemy.ext.asyncio import AsyncSession
-from models import Link
 
 def generate_short_code(length: int = 6) -> str:
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
 
-async def get_unique_short_code(db: AsyncSession, custom_alias: str = None) -> str:
-    if custom_alias:
-        if not custom_alias.isalnum():
-            raise HTTPException(status_code=400, detail="Custom alias must be alphanumeric")
-        stmt = select(Link).filter(Link.short_code == custom_alias)
-        result = await db.execute(stmt)
-        if result.scalar_one_or_none():
-            raise HTTPException(status_code=400, detail="Custom alias already exists")
-        return custom_alias
-    else:
-        while True:
-            code = generate_short_code()
-            stmt = select(Link).filter(Link.short_code == code)
-            result = await db.execute(stmt)
-            if not result.scalar_one_or_none():
-                return code
+def validate_alias(custom_alias: str) -> str:
+    if not custom_alias.isalnum():
+        raise HTTPException(status_code=400, detail="Custom alias must be alphanumeric")
+    return custom_alias
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        userinfo = parts.username + (f":{parts.password}" if parts.password else "")
+        host = f"{userinfo}@{host}"
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, parts.fragment))
+
+# Identifies equivalent links: the same normalized URL created by the same
+# owner with the same category, expiry and visibility.
+def link_digest(original_url: str, owner_id, category, expires_at, is_public: bool) -> str:
+    key = "\x1f".join([
+        normalize_url(original_url),
+        str(owner_id or ""),
+        category or "",
+        expires_at.isoformat() if expires_at else "",
+        "1" if is_public else "0",
+    ])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
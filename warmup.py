@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, or_
+from sqlalchemy.future import select
+from config import (
+    WARMUP_ENABLED, WARMUP_TOP_N, WARMUP_TIME_BUDGET, WARMUP_CACHE_TTL, WARMUP_BATCH_SIZE, WARMUP_WINDOW_HOURS
+)
+from cache import entry_versions, link_entry, store_entries
+from models import Link, ClickRollup
+
+logger = logging.getLogger(__name__)
+
+WARMUP_LOCK_KEY = "cache:warmup:lock"
+
+LINK_COLUMNS = (Link.id, Link.short_code, Link.original_url, Link.expires_at)
+
+
+def _not_expired(now: datetime):
+    return or_(Link.expires_at == None, Link.expires_at > now)
+
+
+# Hottest links by clicks in the hourly rollups of the window, with the click
+# total of the window for the coverage figure.
+async def _hot_by_rollups(db, limit: int, since: datetime, now: datetime):
+    clicks = func.sum(ClickRollup.clicks).label("clicks")
+    in_window = (ClickRollup.granularity == "hour", ClickRollup.bucket >= since)
+    stmt = (
+        select(*LINK_COLUMNS, clicks)
+        .join(ClickRollup, ClickRollup.link_id == Link.id)
+        .filter(*in_window, _not_expired(now))
+        .group_by(*LINK_COLUMNS)
+        .order_by(clicks.desc())
+        .limit(limit)
+    )
+    rows = (await db.execute(stmt)).all()
+    total = await db.scalar(select(func.sum(ClickRollup.clicks)).filter(*in_window))
+    return rows, total or 0
+
+
+# Without rollups, links redirected to within the window ranked by their
+# lifetime redirect_count.
+async def _hot_by_counts(db, limit: int, since: datetime, now: datetime):
+    recent = Link.last_redirect_at >= since
+    stmt = (
+        select(*LINK_COLUMNS, Link.redirect_count.label("clicks"))
+        .filter(recent, _not_expired(now))
+        .order_by(Link.redirect_count.desc())
+        .limit(limit)
+    )
+    rows = (await db.execute(stmt)).all()
+    total = await db.scalar(select(func.sum(Link.redirect_count)).filter(recent))
+    return rows, total or 0
+
+
+async def select_hot_links(db, limit: int = WARMUP_TOP_N):
+    now = datetime.utcnow()
+    since = now - timedelta(hours=WARMUP_WINDOW_HOURS)
+    rows, total = await _hot_by_rollups(db, limit, since, now)
+    source = "rollups"
+    if not rows:
+        rows, total = await _hot_by_counts(db, limit, since, now)
+        source = "redirect_count"
+    return rows, total, source
+
+
+# Current state of the given hot links on the primary; deleted or expired
+# links are left out.
+async def _reload(shard_set, rows):
+    now = datetime.utcnow()
+
+    async def load(index, ids):
+        async with shard_set.session_makers[index]() as db:
+            stmt = select(*LINK_COLUMNS).filter(Link.id.in_(ids), _not_expired(now))
+            return (await db.execute(stmt)).all()
+
+    groups = shard_set.group_ids([row.id for row in rows])
+    results = await asyncio.gather(*(load(index, ids) for index, ids in groups.items()))
+    return [row for shard_rows in results for row in shard_rows]
+
+
+# Preloads the top links into Redis with pipelined writes, stopping when the
+# time budget runs out. Only one process warms at a time. Every shard ranks
+# its own links and the overall top `limit` is taken from their union.
+# Each batch is re-read from the primary right before it is written and
+# written with SET NX, only if its cache version did not change since before
+# the read, so an update or delete during the run is not overwritten by a
+# copy read earlier. Warmed entries live no longer than LINK_CACHE_TTL.
+async def warm_cache(redis_client, shard_set, limit: int = WARMUP_TOP_N, budget: float = WARMUP_TIME_BUDGET):
+    if not WARMUP_ENABLED:
+        return None
+    if not await redis_client.set(WARMUP_LOCK_KEY, 1, nx=True, ex=max(int(budget), 1) * 2):
+        logger.info("Cache warm-up already running elsewhere")
+        return None
+    started = time.monotonic()
+    try:
+        results = await shard_set.fan_out(lambda db: select_hot_links(db, limit))
+        rows = heapq.nlargest(limit, (row for shard_rows, _, _ in results for row in shard_rows),
+                              key=lambda row: row.clicks or 0)
+        total = sum(shard_total for _, shard_total, _ in results)
+        source = "+".join(sorted({shard_source for _, _, shard_source in results}))
+        warmed = 0
+        covered = 0
+        for start in range(0, len(rows), WARMUP_BATCH_SIZE):
+            if time.monotonic() - started > budget:
+                logger.warning("Cache warm-up stopped by its %.0fs time budget", budget)
+                break
+            batch = rows[start:start + WARMUP_BATCH_SIZE]
+            clicks = {row.id: row.clicks or 0 for row in batch}
+            versions = await entry_versions(redis_client, [row.short_code for row in batch])
+            versions = dict(zip((row.short_code for row in batch), versions or ()))
+            current = await _reload(shard_set, batch)
+            await store_entries(
+                redis_client,
+                [
+                    (row.short_code, link_entry(row.id, row.original_url, row.expires_at), versions[row.short_code])
+                    for row in current if row.short_code in versions
+                ],
+                WARMUP_CACHE_TTL,
+                nx=True,
+            )
+            warmed += len(current)
+            covered += sum(clicks[row.id] for row in current)
+    finally:
+        await redis_client.delete(WARMUP_LOCK_KEY)
+    elapsed = time.monotonic() - started
+    stats = {
+        "source": source,
+        "selected": len(rows),
+        "warmed": warmed,
+        "seconds": round(elapsed, 3),
+        "links_per_second": round(warmed / elapsed, 1) if elapsed else 0.0,
+        "click_coverage": round(covered / total, 4) if total else 0.0,
+    }
+    logger.info(
+        "Cache warm-up: %d/%d links in %.2fs (%.0f links/s), covering %.1f%% of recent clicks by %s",
+        warmed, len(rows), elapsed, stats["links_per_second"], stats["click_coverage"] * 100, source,
+    )
+    return stats
+
+
+async def warm_cache_safely(redis_client, shard_set):
+    try:
+        await warm_cache(redis_client, shard_set)
+    except Exception as e:
+        logger.error("Cache warm-up failed: %s", e)